@@ -1,8 +1,20 @@
+import os
 import re
+import math
+from datetime import datetime, timedelta
+from functools import lru_cache
 from pyparsing import (
-    Word, White, alphanums, Keyword, Group, Forward,
-    Suppress, OneOrMore, oneOf, ParseResults, ParseException
+    Word, White, alphanums, Keyword, Group, Forward, ParserElement,
+    Suppress, OneOrMore, one_of, ParseResults
 )
+from . import odata
+
+
+# The and/or rules re-parse the same sub-expressions on every alternative,
+# memoizing them avoids the exponential backtracking.
+ParserElement.enable_packrat()
+
+FILTER_CACHE_SIZE = int(os.environ.get('AZEMULATOR_FILTER_CACHE_SIZE', '1024'))
 
 
 OP_REGEXPS = {
@@ -20,6 +32,39 @@ UNSUPPORTED_PARAMS = (
     'highlightPreTag',
     'highlight'
 )
+UNSUPPORTED_SUGGEST_PARAMS = (
+    'minimumCoverage',
+    'highlightPostTag',
+    'highlightPreTag'
+)
+WORD_REGEXP = re.compile(r'\w+')
+FACET_SORTS = {
+    'count': 'count desc',
+    '-count': 'count asc',
+    'value': 'index asc',
+    '-value': 'index desc'
+}
+# The SOLR date math gap of each date interval
+DATE_GAPS = {
+    'minute': '+1MINUTE',
+    'hour': '+1HOUR',
+    'day': '+1DAY',
+    'week': '+7DAYS',
+    'month': '+1MONTH',
+    'quarter': '+3MONTHS',
+    'year': '+1YEAR'
+}
+GAP_REGEXP = re.compile(r'^\+(\d+)(MINUTE|HOUR|DAY|MONTH|YEAR)S?$')
+DATE_REGEXP = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})'
+    r'(?:T(\d{2}):(\d{2})(?::(\d{2})(?:\.\d+)?)?)?'
+    r'(Z|[+-]\d{2}:?\d{2})?$'
+)
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# Beyond that, an interval facet is rejected rather than sent to SOLR
+FACET_MAX_INTERVALS = int(
+    os.environ.get('AZEMULATOR_FACET_MAX_INTERVALS', '1000')
+)
 
 
 def simple_to_lucene(query):
@@ -49,6 +94,11 @@ def simple_to_lucene(query):
 
 
 class ODataQueryParser(object):
+    """Reference pyparsing implementation of the OData filter grammar.
+
+    The hot path uses the equivalent hand-written compiler in ``odata``:
+    see ``tests/test_odata.py`` for a differential check of the two.
+    """
 
     def __init__(self):
         self._parser = self.parser()
@@ -58,7 +108,7 @@ class ODataQueryParser(object):
 
         operatorWord = Group(
             Word(alphanums + '._')
-        ).setResultsName('word')
+        ).set_results_name('word')
 
         operatorQuotesContent = Forward()
         operatorQuotesContent << (
@@ -67,9 +117,9 @@ class ODataQueryParser(object):
 
         operatorQuotes = Group(
             Suppress('"') + operatorQuotesContent + Suppress('"')
-        ).setResultsName("quotes") | Group(
+        ).set_results_name("quotes") | Group(
             Suppress("'") + operatorQuotesContent + Suppress("'")
-        ).setResultsName("quotes") | operatorWord
+        ).set_results_name("quotes") | operatorWord
 
         ws = White()
 
@@ -77,34 +127,34 @@ class ODataQueryParser(object):
             operatorQuotes + Suppress(ws) +
             Suppress(Keyword('eq', caseless=True)) +
             Suppress(ws) + operatorQuotes
-        ).setResultsName('eq')
+        ).set_results_name('eq')
         operatorNeq = Group(
             operatorQuotes + Suppress(ws) +
             Suppress(Keyword('neq', caseless=True)) +
             Suppress(ws) + operatorQuotes
-        ).setResultsName('neq')
+        ).set_results_name('neq')
 
         operatorLt = Group(
             operatorQuotes + Suppress(ws) +
             Suppress(Keyword('lt', caseless=True)) +
             Suppress(ws) + operatorQuotes
-        ).setResultsName('lt')
+        ).set_results_name('lt')
         operatorLte = Group(
             operatorQuotes + Suppress(ws) +
             Suppress(Keyword('lte', caseless=True)) +
             Suppress(ws) + operatorQuotes
-        ).setResultsName('lte')
+        ).set_results_name('lte')
 
         operatorGt = Group(
             operatorQuotes + Suppress(ws) +
             Suppress(Keyword('gt', caseless=True)) +
             Suppress(ws) + operatorQuotes
-        ).setResultsName('gt')
+        ).set_results_name('gt')
         operatorGte = Group(
             operatorQuotes + Suppress(ws) +
             Suppress(Keyword('gte', caseless=True)) +
             Suppress(ws) + operatorQuotes
-        ).setResultsName('gte')
+        ).set_results_name('gte')
 
         operatorCondition = (
             operatorEq | operatorNeq |
@@ -114,30 +164,30 @@ class ODataQueryParser(object):
 
         operatorParenthesis = Group(
             Suppress("(") + OneOrMore(operatorOr) + Suppress(")")
-        ).setResultsName("parenthesis") | operatorCondition
+        ).set_results_name("parenthesis") | operatorCondition
 
         operatorNot = Forward()
         operatorNot << (Group(
             Suppress(Keyword("not", caseless=True)) + operatorNot
-        ).setResultsName("not") | operatorParenthesis)
+        ).set_results_name("not") | operatorParenthesis)
 
         operatorAnd = Forward()
         operatorAnd << (Group(
             operatorNot + Suppress(Keyword("and", caseless=True)) + operatorAnd
-        ).setResultsName("and") | Group(
-            operatorNot + OneOrMore(~oneOf("and or") + operatorAnd)
-        ).setResultsName("and") | operatorNot)
+        ).set_results_name("and") | Group(
+            operatorNot + OneOrMore(~one_of("and or") + operatorAnd)
+        ).set_results_name("and") | operatorNot)
 
         operatorOr << (Group(
             operatorAnd + Suppress(Keyword("or", caseless=True)) + operatorOr
-        ).setResultsName("or") | operatorAnd)
+        ).set_results_name("or") | operatorAnd)
 
-        return operatorOr.parseString
+        return operatorOr.parse_string
 
     def _transform(self, value):
         if not isinstance(value, ParseResults):
             return value
-        name = value.getName()
+        name = value.get_name()
         if name in ('and', 'or'):
             return '{} {} {}'.format(
                 self._transform(value[0]),
@@ -206,57 +256,341 @@ class ODataParseFailure(Exception):
         )
 
 
+@lru_cache(maxsize=FILTER_CACHE_SIZE)
+def odata_filter(query):
+    """Parses an OData filter into its AST (see ``odata``).
+
+    Parses are memoized like translations: the AST is shared,
+    and must not be modified.
+    """
+    try:
+        return odata.parse(query)
+    except odata.FilterSyntaxError as e:
+        raise ODataParseFailure(e)
+
+
+@lru_cache(maxsize=FILTER_CACHE_SIZE)
 def odata_to_lucene(query):
-    parser = ODataQueryParser()
+    """Turns an OData filter into a Lucene query.
+
+    Translations are memoized: use ``odata_to_lucene.cache_info()``
+    to get the hit/miss counters.
+    """
     try:
-        return parser.transform(query)
-    except ParseException as e:
+        return odata.translate(query)
+    except odata.FilterSyntaxError as e:
         raise ODataParseFailure(e)
 
 
+def parse_facet(expr):
+    """Splits an Azure Search facet expression in field and options."""
+    expr_components = expr.split(',')
+    options = {}
+    for opt in expr_components[1:]:
+        c = opt.split(':', 1)
+        if len(c) != 2:
+            raise ValueError('Invalid facet option {}'.format(opt))
+        options[c[0]] = c[1]
+    return expr_components[0], options
+
+
+def facet_bound(value):
+    """Returns a facet bound as a number, or as a date string."""
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def facet_range_query(field, start, end):
+    """The Lucene range query of a ``values`` bucket, from included."""
+    def bound(value):
+        if value is None:
+            return '*'
+        if isinstance(value, str):
+            return '"{}"'.format(value)
+        return str(value)
+    return '{}:[{} TO {}{}'.format(
+        field, bound(start), bound(end), ']' if end is None else '}'
+    )
+
+
+def facet_buckets(options):
+    """Returns the ``(from, to)`` buckets of a ``values`` facet."""
+    values = [facet_bound(v) for v in options['values'].split('|')]
+    return list(zip([None] + values, values + [None]))
+
+
+def parse_timeoffset(offset):
+    """Parses a ``[+-]hh:mm`` time offset in minutes."""
+    match = re.match(r'^([+-]?)(\d{1,2}):(\d{2})$', offset)
+    if match is None:
+        raise ValueError('Invalid timeoffset {}'.format(offset))
+    minutes = int(match.group(2)) * 60 + int(match.group(3))
+    return -minutes if match.group(1) == '-' else minutes
+
+
+def parse_date(text):
+    """Parses an ISO 8601 date, returning it in UTC."""
+    match = DATE_REGEXP.match(text)
+    if match is None:
+        raise ValueError('Invalid date {}'.format(text))
+    parts = [int(part or 0) for part in match.groups()[:6]]
+    value = datetime(*parts)
+    zone = match.group(7)
+    if zone and zone != 'Z':
+        offset = timedelta(hours=int(zone[1:3]), minutes=int(zone[-2:]))
+        value = value - offset if zone[0] == '+' else value + offset
+    return value
+
+
+def add_date_gap(value, gap):
+    """Adds a SOLR date math gap such as ``+1MONTH`` to a date."""
+    match = GAP_REGEXP.match(gap)
+    if match is None:
+        raise ValueError('Unsupported date gap {}'.format(gap))
+    count, unit = int(match.group(1)), match.group(2)
+    if unit in ('MONTH', 'YEAR'):
+        months = value.month - 1 + count * (12 if unit == 'YEAR' else 1)
+        return value.replace(
+            year=value.year + months // 12, month=months % 12 + 1
+        )
+    return value + timedelta(**{unit.lower() + 's': count})
+
+
+def date_bucket(value, interval):
+    """The start of the date interval including a date."""
+    value = value.replace(second=0, microsecond=0)
+    if interval != 'minute':
+        value = value.replace(minute=0)
+    if interval not in ('minute', 'hour'):
+        value = value.replace(hour=0)
+    if interval == 'week':
+        value -= timedelta(days=value.weekday())
+    elif interval == 'month':
+        value = value.replace(day=1)
+    elif interval == 'quarter':
+        value = value.replace(day=1, month=(value.month - 1) // 3 * 3 + 1)
+    elif interval == 'year':
+        value = value.replace(day=1, month=1)
+    return value
+
+
+def timezone(offset):
+    """The SOLR ``TZ`` of a time offset in minutes."""
+    return 'GMT{}{:02d}:{:02d}'.format(
+        '-' if offset < 0 else '+', abs(offset) // 60, abs(offset) % 60
+    )
+
+
+def interval_range(field, options, low, high):
+    """The range facet of an ``interval`` facet, from its value bounds.
+
+    Bounds are aligned on the interval, in the time zone given by
+    ``timeoffset`` for dates, so that buckets start where Azure's do.
+    """
+    interval = options['interval']
+    if interval in DATE_GAPS:
+        gap = DATE_GAPS[interval]
+        offset = timedelta(
+            minutes=parse_timeoffset(options.get('timeoffset', '00:00'))
+        )
+        # Local times, as SOLR adds gaps in the ``TZ`` of the request
+        start = date_bucket(parse_date(low) + offset, interval)
+        last = parse_date(high) + offset
+        end = start
+        intervals = 0
+        while end <= last and intervals <= FACET_MAX_INTERVALS:
+            end = add_date_gap(end, gap)
+            intervals += 1
+        start, end = [
+            (value - offset).strftime(DATE_FORMAT) for value in (start, end)
+        ]
+    else:
+        gap = facet_bound(interval)
+        start = math.floor(low / gap) * gap
+        intervals = int((high - start) // gap) + 1
+        end = start + intervals * gap
+    if intervals > FACET_MAX_INTERVALS:
+        raise ValueError('Facet {} has more than {} intervals'.format(
+            field, FACET_MAX_INTERVALS
+        ))
+    return {
+        'range': {
+            'field': field,
+            'start': start,
+            'end': end,
+            'gap': gap,
+            'mincount': 1
+        }
+    }
+
+
+def interval_facets(intervals, facets):
+    """Turns the bounds found by a first query into range facets.
+
+    The ``min_<field>`` and ``max_<field>`` facets are replaced in
+    ``facets`` by empty ``interval_<field>`` ones, and the range facets
+    to query are returned by time offset: SOLR applies a single
+    time zone to a request.
+    """
+    groups = {}
+    for field, options in sorted(intervals.items()):
+        low = facets.pop('min_{}'.format(field), None)
+        high = facets.pop('max_{}'.format(field), None)
+        name = 'interval_{}'.format(field)
+        facets[name] = {'buckets': []}
+        if low is None or high is None:
+            continue
+        offset = parse_timeoffset(options.get('timeoffset', '00:00'))
+        groups.setdefault(offset, {})[name] = interval_range(
+            field, options, low, high
+        )
+    return groups
+
+
+def interval_options(facets):
+    """Returns the options of the ``interval`` facets, by field."""
+    intervals = {}
+    for expr in facets or []:
+        field, options = parse_facet(expr)
+        if 'interval' in options and 'values' not in options:
+            intervals[field] = options
+    return intervals or None
+
+
 def az_facets_to_solr(facets):
+    """Translates facets in a single SOLR JSON facet block.
+
+    ``values`` facets become query facets, one for each bucket;
+    ``interval`` facets get the bounds of their values (``min_<field>``
+    and ``max_<field>``), since SOLR range facets need them in advance:
+    see ``interval_facets``.
+    """
     if not facets:
         return None
     params = {}
     for expr in facets:
-        expr_components = expr.split(',')
-        field = expr_components[0]
-        options = expr_components[1:]
+        field, options_dict = parse_facet(expr)
+        if 'values' in options_dict:
+            params['values_{}'.format(field)] = {
+                'query': {
+                    'q': '*:*',
+                    'facet': {
+                        str(position): {
+                            'query': {
+                                'q': facet_range_query(field, start, end)
+                            }
+                        }
+                        for position, (start, end) in enumerate(
+                            facet_buckets(options_dict)
+                        )
+                    }
+                }
+            }
+            continue
+        if 'interval' in options_dict:
+            interval = options_dict['interval']
+            if interval not in DATE_GAPS:
+                size = facet_bound(interval)
+                if isinstance(size, str) or size <= 0:
+                    raise ValueError(
+                        'Invalid facet interval {}'.format(interval)
+                    )
+            if 'timeoffset' in options_dict:
+                if interval not in DATE_GAPS:
+                    raise ValueError(
+                        'timeoffset can only be used with date intervals'
+                    )
+                parse_timeoffset(options_dict['timeoffset'])
+            params['min_{}'.format(field)] = 'min({})'.format(field)
+            params['max_{}'.format(field)] = 'max({})'.format(field)
+            continue
+        if 'timeoffset' in options_dict:
+            raise ValueError('timeoffset can only be used with intervals')
         params['top_{}'.format(field)] = {
             'terms': {
                 'field': field
             }
         }
         field_opts = params['top_{}'.format(field)]['terms']
-        if len(options) > 0:
-            options_dict = {}
-            for opt in options:
-                c = opt.split(':')
-                options_dict[c[0]] = c[1]
-            if 'count' in options_dict:
-                field_opts['limit'] = int(options_dict['count'])
-            if 'sort' in options_dict:
-                if options_dict['sort'] == 'count':
-                    field_opts['sort'] = 'count'
-                elif options_dict['sort'] == '-count':
-                    raise NotImplementedError(
-                        '-count facet sorting not implemented'
-                    )
-                if options_dict['sort'] == 'value':
-                    field_opts['sort'] = 'index'
-                elif options_dict['sort'] == '-value':
-                    raise NotImplementedError(
-                        '-value facet sorting not implemented'
-                    )
-            if 'values' in options_dict:
-                raise NotImplementedError('values facet not implemented')
-            if 'interval' in options_dict:
-                raise NotImplementedError('interval facet not implemented')
-            if 'timeoffset' in options_dict:
-                raise NotImplementedError('timeoffset facet not implemented')
+        if 'count' in options_dict:
+            field_opts['limit'] = int(options_dict['count'])
+        if 'sort' in options_dict:
+            if options_dict['sort'] not in FACET_SORTS:
+                raise ValueError(
+                    'Invalid facet sort {}'.format(options_dict['sort'])
+                )
+            field_opts['sort'] = FACET_SORTS[options_dict['sort']]
     return params
 
 
+def parse_suggest(request, suggesters, is_post=False):
+    """Parses the parameters of suggest and autocomplete requests."""
+    for unsupported in UNSUPPORTED_SUGGEST_PARAMS:
+        if unsupported in request:
+            raise NotImplementedError(
+                'Parameter {} not implemented'.format(unsupported)
+            )
+    if str(request.get('fuzzy', False)).lower() == 'true':
+        raise NotImplementedError('Fuzzy suggestions not implemented')
+    mode = request.get('autocompleteMode', 'oneTerm')
+    if mode == 'twoTerms':
+        raise NotImplementedError('twoTerms autocomplete not implemented')
+    name = request.get('suggesterName')
+    suggester = {s['name']: s for s in suggesters}.get(name)
+    if suggester is None:
+        raise ValueError('Unknown suggester {}'.format(name))
+    fields = list(suggester['sourceFields'])
+    search_fields = request.get('searchFields')
+    if search_fields:
+        search_fields = search_fields.split(',')
+        if not set(search_fields).issubset(fields):
+            raise ValueError(
+                'searchFields must be source fields of the suggester'
+            )
+        fields = search_fields
+    search = request.get('search', '')
+    tokens = [token.lower() for token in WORD_REGEXP.findall(search)]
+    if not tokens:
+        raise ValueError('The search text must contain at least a word')
+    select = request.get('select' if is_post else '$select')
+    if select is not None:
+        select = select.split(',')
+    filter_query = request.get('filter' if is_post else '$filter')
+    return {
+        'tokens': tokens,
+        # Autocomplete completes the last word, after the others
+        'prefix': tokens[-1],
+        'context': search[:search.lower().rfind(tokens[-1])],
+        'fields': fields,
+        'limit': int(request.get('top' if is_post else '$top', '5')),
+        'select': select,
+        'filter_query': (
+            odata_to_lucene(filter_query) if filter_query else None
+        ),
+        'odata_filter': filter_query
+    }
+
+
+def page_cursor(token, skip):
+    """Returns the SOLR cursor mark to get results from ``skip``.
+
+    Tokens, put in the next page links by ``azresponse.format``,
+    are ``<skip>:<cursor mark>``: a token for another ``skip`` is ignored
+    and offsets are used instead.
+    """
+    if skip == 0:
+        return '*'
+    if token:
+        position, _, mark = str(token).partition(':')
+        if mark and position == str(skip):
+            return mark
+    return None
+
+
 def parse(request, is_post=False):
     for unsupported in UNSUPPORTED_PARAMS:
         if unsupported in request:
@@ -292,6 +626,7 @@ def parse(request, is_post=False):
     else:
         facets = request.getall('facet', [])
     filter_query = request.get('filter' if is_post else '$filter')
+    cursor = page_cursor(request.get('cursor' if is_post else '$cursor'), skip)
     return {
         'mode': mode,
         'search_fields': search_fields,
@@ -302,8 +637,11 @@ def parse(request, is_post=False):
         'order_by': order_by,
         'select': select,
         'facets': az_facets_to_solr(facets),
+        'intervals': interval_options(facets),
         'fields': search_fields,
         'filter_query': (
             odata_to_lucene(filter_query) if filter_query else None
-        )
+        ),
+        'odata_filter': filter_query,
+        'cursor': cursor
     }
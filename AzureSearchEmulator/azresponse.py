@@ -1,13 +1,40 @@
+import re
+from collections import OrderedDict
 from logging import getLogger
 from urllib.parse import urlencode
+from . import azquery
 
 
 logger = getLogger(__name__)
 
 
+def format_document(doc):
+    # The SOLR result may be cached, so it must not be modified
+    item = {'@search.score': doc['score']}
+    item.update(doc)
+    del item['score']
+    item.pop('_version_', None)
+    return item
+
+
+def format_values_facet(facet, options):
+    items = []
+    for position, (start, end) in enumerate(
+        azquery.facet_buckets(options)
+    ):
+        item = OrderedDict()
+        if start is not None:
+            item['from'] = start
+        if end is not None:
+            item['to'] = end
+        item['count'] = facet.get(str(position), {}).get('count', 0)
+        items.append(item)
+    return items
+
+
 def format(request, result, raw_parameters, is_post):
     final = {}
-    logger.debug("Got response from SOLR: {}".format(result))
+    logger.debug("Got response from SOLR: %s", result)
     if is_post:
         count = raw_parameters.get('count', False)
         if isinstance(count, str):
@@ -21,36 +48,86 @@ def format(request, result, raw_parameters, is_post):
     result_count = result['response']['numFound']
     if count:
         final['@odata.count'] = result_count
-    final['value'] = []
-    for doc in result['response']['docs']:
-        item = {
-            '@search.score': doc['score']
-        }
-        item.update({
-            k: v for k, v in doc.items()
-            if k not in ('score', '_version_')
-        })
-        final['value'].append(item)
+    final['value'] = [
+        format_document(doc) for doc in result['response']['docs']
+    ]
     if 'facets' in result:
         final_facets = {}
         final['@search.facets'] = final_facets
+        if is_post:
+            facets = raw_parameters.get('facets') or []
+        else:
+            facets = raw_parameters.getall('facet', [])
+        facet_options = dict(azquery.parse_facet(expr) for expr in facets)
         for k, v in result['facets'].items():
             if k == 'count':
                 continue
-            final_facets[k[4:]] = [
-                {'value': i['val'], 'count': i['count']}
-                for i in v['buckets']
-            ]
+            kind, field = k.split('_', 1)
+            options = facet_options.get(field, {})
+            if kind == 'values':
+                final_facets[field] = format_values_facet(v, options)
+            else:
+                # Terms, and the range facets of intervals
+                final_facets[field] = [
+                    {'value': i['val'], 'count': i['count']}
+                    for i in v['buckets']
+                ]
     if (skip + limit) < result_count:
+        # The SOLR cursor for the next page, if SOLR gave one
+        cursor = None
+        if 'nextCursorMark' in result:
+            cursor = '{}:{}'.format(skip + limit, result['nextCursorMark'])
         if is_post:
             final['@odata.nextLink'] = str(request.url)
             next_params = raw_parameters.copy()
             next_params['skip'] = skip + limit
+            next_params.pop('cursor', None)
+            if cursor is not None:
+                next_params['cursor'] = cursor
             final['@odata.nextPageParameters'] = next_params
         else:
             next_params = request.query.copy()
             next_params['$skip'] = str(skip + limit)
+            next_params.pop('$cursor', None)
+            if cursor is not None:
+                next_params['$cursor'] = cursor
             final['@odata.nextLink'] = str(request.url.with_query(
                 list(next_params.items())
             ))
     return final
+
+
+def suggestion_text(doc, params):
+    """The first source field value with words starting with the tokens."""
+    first = None
+    for field in params['fields']:
+        values = doc.get(field)
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            if not isinstance(value, str):
+                continue
+            if first is None:
+                first = value
+            words = [word.lower() for word in re.findall(r'\w+', value)]
+            if all(
+                any(word.startswith(token) for word in words)
+                for token in params['tokens']
+            ):
+                return value
+    return first
+
+
+def format_suggestion(doc, params):
+    item = {'@search.text': suggestion_text(doc, params)}
+    for field in params['select'] or [params['key']]:
+        if field in doc:
+            item[field] = doc[field]
+    return item
+
+
+def format_autocomplete(terms, params):
+    return [
+        {'text': term, 'queryPlusText': params['context'] + term}
+        for term, count in terms
+    ]
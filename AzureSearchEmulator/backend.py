@@ -0,0 +1,169 @@
+from . import solr
+from . import tools
+from .replicas import ReplicaSet
+
+
+class UnknownIndex(LookupError):
+    """The index does not exist in the backend, e.g. it was deleted."""
+
+
+class Backend(object):
+    """A search engine the emulator translates Azure Search requests to.
+
+    Searches receive the parameters returned by ``azquery.parse``
+    and return results shaped as the SOLR JSON Request API responses
+    (``response``, ``facets``...), which ``azresponse.format`` turns
+    into Azure Search responses.
+    """
+
+    # Whether pre-forked workers can each use their own instance
+    supports_workers = True
+
+    async def start(self, app):
+        pass
+
+    async def stop(self, app):
+        pass
+
+    def stats(self):
+        """Returns numbers about the backend, for ``/stats``."""
+        return {}
+
+    async def create_indexes(self, indexes):
+        """Creates the indexes from their definitions, if missing."""
+        raise NotImplementedError()
+
+    async def update_index(self, index, definition):
+        """Creates an index, or updates the schema of an existing one."""
+        raise NotImplementedError()
+
+    async def delete_index(self, index):
+        raise NotImplementedError()
+
+    async def search(self, index, params, debug=False):
+        raise NotImplementedError()
+
+    async def get(self, index, key, select=None):
+        """Returns the current version of a document, or None."""
+        raise NotImplementedError()
+
+    async def count(self, index):
+        """Returns the number of documents in an index."""
+        raise NotImplementedError()
+
+    async def suggest(self, index, params):
+        """Returns the documents matching a suggest request.
+
+        Parameters are the ones returned by ``azquery.parse_suggest``,
+        plus the ``key`` field of the index.
+        """
+        raise NotImplementedError()
+
+    async def autocomplete(self, index, params):
+        """Returns ``(term, count)`` completing an autocomplete request."""
+        raise NotImplementedError()
+
+    async def index(self, index, inserts, deletes, index_primary,
+                    commit_within=None):
+        """Writes documents, returning a list of ``(key, error)``.
+
+        ``inserts`` are SOLR update documents (see
+        ``index.to_solr_document``), ``deletes`` the keys to delete.
+        A key appears only once, so they can be written in any order.
+        """
+        raise NotImplementedError()
+
+    async def commit(self, index):
+        raise NotImplementedError()
+
+
+class SolrBackend(Backend):
+    """Talks to SOLR through a single, pooled HTTP session.
+
+    Reads are spread on the SOLR replicas, while writes
+    and real-time gets go to the leader (see ``replicas``).
+    """
+
+    def __init__(self):
+        self.session = None
+        self.replicas = ReplicaSet()
+
+    async def start(self, app):
+        self.session = solr.create_session()
+        self.replicas.start(self.session)
+
+    async def stop(self, app):
+        await self.replicas.stop()
+        await self.session.close()
+
+    def stats(self):
+        return self.replicas.stats()
+
+    async def create_indexes(self, indexes):
+        await tools.main(self.session, indexes)
+
+    async def update_index(self, index, definition):
+        await tools.sync_index(self.session, index, definition)
+
+    async def delete_index(self, index):
+        if not await tools.delete_solr_index(self.session, index):
+            raise solr.SolrError(
+                'Failed to delete core {}'.format(index), None
+            )
+
+    async def search(self, index, params, debug=False):
+        return await self.replicas.read(
+            lambda solr_url: solr.search(
+                self.session, index, params, debug=debug, solr_url=solr_url
+            )
+        )
+
+    async def get(self, index, key, select=None):
+        # Only the leader has the documents which are not yet committed
+        return await self.replicas.write(
+            lambda solr_url: solr.get(
+                self.session, index, key, select, solr_url=solr_url
+            )
+        )
+
+    async def count(self, index):
+        return await self.replicas.read(
+            lambda solr_url: solr.count(
+                self.session, index, solr_url=solr_url
+            )
+        )
+
+    async def suggest(self, index, params):
+        return await self.replicas.read(
+            lambda solr_url: solr.suggest(
+                self.session, index, params, solr_url=solr_url
+            )
+        )
+
+    async def autocomplete(self, index, params):
+        return await self.replicas.read(
+            lambda solr_url: solr.autocomplete(
+                self.session, index, params, solr_url=solr_url
+            )
+        )
+
+    async def index(self, index, inserts, deletes, index_primary,
+                    commit_within=None):
+        return await self.replicas.write(
+            lambda solr_url: solr.index(
+                self.session,
+                index,
+                inserts,
+                deletes,
+                index_primary,
+                commit_within=commit_within,
+                solr_url=solr_url
+            )
+        )
+
+    async def commit(self, index):
+        return await self.replicas.write(
+            lambda solr_url: solr.commit(
+                self.session, index, solr_url=solr_url
+            )
+        )
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import multiprocessing
+from collections import OrderedDict
+
+
+SEARCH_CACHE_SIZE = int(os.environ.get('AZEMULATOR_SEARCH_CACHE_SIZE', '0'))
+SEARCH_CACHE_TTL = float(os.environ.get('AZEMULATOR_SEARCH_CACHE_TTL', '60'))
+SINGLE_FLIGHT = (
+    os.environ.get('AZEMULATOR_SEARCH_SINGLE_FLIGHT', 'true').lower()
+    in ('true', 'on', '1')
+)
+# Number of generations shared by the worker processes
+GENERATION_SLOTS = 1024
+
+
+class SearchCache(object):
+    """LRU cache of SOLR search results, with a time to live.
+
+    Entries are keyed on the index, its generation and the parsed
+    search parameters: bumping the generation of an index (when it is
+    written to) makes all its cached results unreachable,
+    and they are eventually evicted.
+    A cache with size 0 is disabled.
+    """
+
+    def __init__(self, size=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL,
+                 generations=None):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generations = (
+            Generations() if generations is None else generations
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def key(self, index, params):
+        """Returns the cache key for a search.
+
+        It must be computed before searching, so that a result read
+        before a write cannot be stored as current after it.
+        """
+        return (
+            index,
+            self.generations.get(index),
+            json.dumps(params, sort_keys=True)
+        )
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, result = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        if not self.enabled:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, index):
+        self.generations.increment(index)
+        self.invalidations += 1
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'size': len(self.entries),
+            'max_size': self.size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations
+        }
+
+
+class Generations(object):
+    """Index generations of a single process."""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, index):
+        return self.values.get(index, 0)
+
+    def increment(self, index):
+        self.values[index] = self.values.get(index, 0) + 1
+
+
+class SharedGenerations(object):
+    """Index generations shared among worker processes.
+
+    It must be created before forking the workers, so that a write
+    handled by any of them invalidates the caches of all the others.
+    Indexes are hashed to a fixed number of slots, so that indexes
+    created later are shared too: indexes in the same slot only
+    invalidate each other's results.
+
+    The definitions generation is incremented whenever an index is
+    created, updated or deleted, for the other workers to reload them.
+    """
+
+    def __init__(self, slots=GENERATION_SLOTS):
+        self.values = multiprocessing.Array('Q', slots)
+        self.definitions = multiprocessing.Value('Q', 0)
+        # Not shared: each process has its own copy after forking
+        self.seen_definitions = 0
+
+    def slot(self, index):
+        return zlib.crc32(index.encode('utf-8')) % len(self.values)
+
+    def get(self, index):
+        return self.values[self.slot(index)]
+
+    def increment(self, index):
+        with self.values.get_lock():
+            self.values[self.slot(index)] += 1
+
+    def change_definitions(self):
+        with self.definitions.get_lock():
+            self.definitions.value += 1
+
+    def definitions_changed(self):
+        """Whether the definitions changed since the last call."""
+        current = self.definitions.value
+        changed = current != self.seen_definitions
+        self.seen_definitions = current
+        return changed
+
+
+class SingleFlight(object):
+    """Shares a single call among concurrent callers with the same key.
+
+    The call is shielded, so that a caller going away (e.g. because
+    the client disconnected) does not cancel it for the others.
+    """
+
+    def __init__(self, enabled=SINGLE_FLIGHT):
+        self.enabled = enabled
+        self.calls = {}
+        self.started = 0
+        self.shared = 0
+
+    async def do(self, key, function):
+        if not self.enabled:
+            return await function()
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(function())
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+            self.started += 1
+        else:
+            self.shared += 1
+        return await asyncio.shield(future)
+
+    def _done(self, key, future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'in_flight': len(self.calls),
+            'started': self.started,
+            'shared': self.shared
+        }
@@ -0,0 +1,674 @@
+"""Embedded, persistent search backend using memory-mapped segments.
+
+Every index is a directory of immutable segment files plus a manifest
+(``segments.json``) listing the live segments and their deleted documents.
+New documents are kept in an in-memory buffer (a ``MemoryIndex``), which is
+searchable right away and is written as a new segment on commit, or when it
+grows over ``AZEMULATOR_DISK_BUFFER_SIZE`` documents.
+When there are more than ``AZEMULATOR_DISK_MERGE_FACTOR`` segments the
+smallest ones are merged in the background.
+
+Segments are memory-mapped, so opening an index is cheap and only the pages
+actually needed by searches are read: a segment has the stored documents,
+the terms and postings (with positions) of the searchable fields,
+the sorted values of every field for filters and the values of each
+document for sorting and faceting, all as tables of offsets followed by
+their data, in the native byte order.
+"""
+import os
+import mmap
+import shutil
+import asyncio
+from array import array
+from itertools import chain
+from bisect import bisect_left, bisect_right
+from logging import getLogger
+from . import jsonbackend
+from .backend import Backend, UnknownIndex
+from .memory import (
+    MemoryIndex, Searcher, analyze, as_list, schema_fields, primary_field,
+    range_slice
+)
+
+
+DATA_DIR = os.environ.get('AZEMULATOR_DATA_DIR', '/srv/azuresearch/data')
+BUFFER_SIZE = int(os.environ.get('AZEMULATOR_DISK_BUFFER_SIZE', '10000'))
+MERGE_FACTOR = int(os.environ.get('AZEMULATOR_DISK_MERGE_FACTOR', '10'))
+MANIFEST = 'segments.json'
+# One key in this many is kept in memory, to find the others in the mmap
+KEY_INDEX_INTERVAL = 64
+SEGMENT_EXTENSION = '.seg'
+logger = getLogger(__name__)
+
+
+def encode_table(items):
+    """Encodes a list of bytes as a table: count, offsets, then data."""
+    offsets = array('Q', [len(items), 0])
+    total = 0
+    for item in items:
+        total += len(item)
+        offsets.append(total)
+    return offsets.tobytes() + b''.join(items)
+
+
+def decode_text(data):
+    return str(data, 'utf-8')
+
+
+def decode_json(data):
+    return jsonbackend.loads(bytes(data))
+
+
+def as_view(data):
+    return data
+
+
+def write_atomically(path, data):
+    with open(path + '.tmp', 'wb') as stream:
+        stream.write(data)
+        stream.flush()
+        os.fsync(stream.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def as_list_pairs(documents, field):
+    return [
+        (value, ordinal)
+        for ordinal, (_, document) in enumerate(documents)
+        for value in as_list(document.get(field))
+    ]
+
+
+def write_segment(path, schema, documents):
+    """Writes ``(key, document)`` pairs as a segment file."""
+    documents = sorted(documents, key=lambda item: item[0])
+    searchable = schema_fields(schema, 'searchable')
+    with_values = set(
+        schema_fields(schema, 'sortable') + schema_fields(schema, 'facetable')
+    )
+    sections = [
+        ('keys', encode_table([k.encode('utf-8') for k, _ in documents])),
+        ('docs', encode_table([
+            jsonbackend.dumps_bytes(d) for _, d in documents
+        ]))
+    ]
+    total_lengths = {}
+    for field in schema:
+        values = as_list_pairs(documents, field)
+        values.sort(key=lambda item: item[0])
+        sections.append(('values:' + field, encode_table([
+            jsonbackend.dumps_bytes(value) for value, _ in values
+        ])))
+        sections.append((
+            'value_ords:' + field,
+            array('I', [ordinal for _, ordinal in values]).tobytes()
+        ))
+        if field in with_values:
+            sections.append(('docvalues:' + field, encode_table([
+                jsonbackend.dumps_bytes(d.get(field)) for _, d in documents
+            ])))
+        if field in searchable:
+            postings = {}
+            lengths = array('I')
+            for ordinal, (_, document) in enumerate(documents):
+                tokens = [
+                    token for item in as_list(document.get(field))
+                    for token in analyze(item)
+                ]
+                for position, token in enumerate(tokens):
+                    postings.setdefault(token, {}).setdefault(
+                        ordinal, []
+                    ).append(position)
+                lengths.append(len(tokens))
+            terms = sorted(postings)
+            encoded = []
+            for term in terms:
+                entry = array('I')
+                for ordinal, positions in sorted(postings[term].items()):
+                    entry.append(ordinal)
+                    entry.append(len(positions))
+                    entry.extend(positions)
+                encoded.append(entry.tobytes())
+            sections.append(('terms:' + field, encode_table(
+                [term.encode('utf-8') for term in terms]
+            )))
+            sections.append(('postings:' + field, encode_table(encoded)))
+            sections.append(('lengths:' + field, lengths.tobytes()))
+            total_lengths[field] = sum(lengths)
+    directory = {}
+    position = 0
+    with open(path + '.tmp', 'wb') as stream:
+        for name, data in sections:
+            directory[name] = [position, len(data)]
+            padding = -len(data) % 8
+            stream.write(data + b'\0' * padding)
+            position += len(data) + padding
+        footer = jsonbackend.dumps_bytes({
+            'count': len(documents),
+            'total_lengths': total_lengths,
+            'sections': directory
+        })
+        stream.write(footer)
+        stream.write(array('Q', [len(footer)]).tobytes())
+        stream.flush()
+        os.fsync(stream.fileno())
+    os.replace(path + '.tmp', path)
+
+
+class Table(object):
+    """A read-only sequence of the items of an encoded table."""
+
+    def __init__(self, view, decode):
+        count = view[:8].cast('Q')[0]
+        self.offsets = view[8:8 * (count + 2)].cast('Q')
+        self.data = view[8 * (count + 2):]
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        return self.decode(
+            self.data[self.offsets[position]:self.offsets[position + 1]]
+        )
+
+
+class Segment(object):
+    """A memory-mapped segment file, with its deleted documents.
+
+    Implements the reader interface of ``MemoryIndex``.
+    """
+
+    def __init__(self, path, deleted=()):
+        self.path = path
+        self.name = os.path.basename(path)[:-len(SEGMENT_EXTENSION)]
+        with open(path, 'rb') as stream:
+            self.mmap = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        footer_length = self.view[-8:].cast('Q')[0]
+        footer = jsonbackend.loads(
+            bytes(self.view[-8 - footer_length:-8])
+        )
+        self.size = footer['count']
+        self.total_lengths = footer['total_lengths']
+        self.sections = footer['sections']
+        # Ordinals of the deleted documents
+        self.deleted = set(deleted)
+        self.cache = {}
+        self.key_index = None
+
+    def close(self):
+        self.cache.clear()
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            # Still referenced, it is unmapped when garbage collected
+            pass
+
+    def _section(self, name):
+        position, length = self.sections[name]
+        return self.view[position:position + length]
+
+    def table(self, name, decode):
+        cache_key = (name, decode)
+        if cache_key not in self.cache:
+            if name not in self.sections:
+                self.cache[cache_key] = ()
+            else:
+                self.cache[cache_key] = Table(self._section(name), decode)
+        return self.cache[cache_key]
+
+    def ordinals(self, name):
+        if name not in self.cache:
+            if name not in self.sections:
+                self.cache[name] = ()
+            else:
+                self.cache[name] = self._section(name).cast('I')
+        return self.cache[name]
+
+    def ordinal(self, key):
+        # Keys are sorted, and UTF-8 preserves their order: the table
+        # is searched in place, from a sample of its keys
+        keys = self.table('keys', bytes)
+        if self.key_index is None:
+            self.key_index = [
+                keys[o] for o in range(0, self.size, KEY_INDEX_INTERVAL)
+            ]
+        encoded = key.encode('utf-8')
+        start = (bisect_right(self.key_index, encoded) - 1) * (
+            KEY_INDEX_INTERVAL
+        )
+        if start < 0:
+            return None
+        end = min(start + KEY_INDEX_INTERVAL, self.size)
+        position = bisect_left(keys, encoded, start, end)
+        if position < end and keys[position] == encoded:
+            if position not in self.deleted:
+                return position
+        return None
+
+    def delete(self, key):
+        ordinal = self.ordinal(key)
+        if ordinal is None:
+            return False
+        self.deleted.add(ordinal)
+        return True
+
+    def live_documents(self, deleted):
+        keys = self.table('keys', decode_text)
+        docs = self.table('docs', decode_json)
+        for ordinal in range(self.size):
+            if ordinal not in deleted:
+                yield keys[ordinal], docs[ordinal]
+
+    def _keys(self, ordinals):
+        keys = self.table('keys', decode_text)
+        deleted = self.deleted
+        if not deleted:
+            return [keys[o] for o in ordinals]
+        return [keys[o] for o in ordinals if o not in deleted]
+
+    # Reader interface
+
+    def keys(self):
+        return self._keys(range(self.size))
+
+    def count(self):
+        return self.size - len(self.deleted)
+
+    def get_postings(self, field, term):
+        terms = self.table('terms:' + field, decode_text)
+        position = bisect_left(terms, term)
+        if position == len(terms) or terms[position] != term:
+            return {}
+        entry = self.table('postings:' + field, as_view)[position]
+        entry = entry.cast('I')
+        keys = self.table('keys', decode_text)
+        postings = {}
+        offset = 0
+        while offset < len(entry):
+            ordinal, frequency = entry[offset], entry[offset + 1]
+            if ordinal not in self.deleted:
+                postings[keys[ordinal]] = entry[
+                    offset + 2:offset + 2 + frequency
+                ].tolist()
+            offset += 2 + frequency
+        return postings
+
+    def prefix_terms(self, field, prefix):
+        terms = self.table('terms:' + field, decode_text)
+        position = bisect_left(terms, prefix)
+        found = []
+        while position < len(terms) and terms[position].startswith(prefix):
+            found.append(terms[position])
+            position += 1
+        return found
+
+    def field_length(self, field, key):
+        ordinal = self.ordinal(key)
+        lengths = self.ordinals('lengths:' + field)
+        if ordinal is None or not lengths:
+            return None
+        return lengths[ordinal]
+
+    def total_length(self, field):
+        lengths = self.ordinals('lengths:' + field)
+        if not lengths:
+            return 0
+        return self.total_lengths[field] - sum(
+            lengths[ordinal] for ordinal in self.deleted
+        )
+
+    def range_keys(self, field, operator, value):
+        values = self.table('values:' + field, decode_json)
+        ordinals = self.ordinals('value_ords:' + field)
+        return self._keys(ordinals[range_slice(values, operator, value)])
+
+    def value_keys(self, field, value):
+        return self.range_keys(field, 'eq', value)
+
+    def valued_keys(self, field):
+        return self._keys(self.ordinals('value_ords:' + field))
+
+    def value(self, field, key):
+        ordinal = self.ordinal(key)
+        if ordinal is None:
+            return None
+        if 'docvalues:' + field in self.sections:
+            return self.table('docvalues:' + field, decode_json)[ordinal]
+        return self.table('docs', decode_json)[ordinal].get(field)
+
+    def document(self, key):
+        ordinal = self.ordinal(key)
+        if ordinal is None:
+            return None
+        return self.table('docs', decode_json)[ordinal]
+
+
+class MultiReader(object):
+    """Reads from several readers as if they were one.
+
+    A key is live in at most one of them.
+    """
+
+    def __init__(self, readers):
+        self.readers = readers
+
+    def keys(self):
+        return [key for reader in self.readers for key in reader.keys()]
+
+    def count(self):
+        return sum(reader.count() for reader in self.readers)
+
+    def get_postings(self, field, term):
+        postings = {}
+        for reader in self.readers:
+            postings.update(reader.get_postings(field, term))
+        return postings
+
+    def prefix_terms(self, field, prefix):
+        return sorted(set(
+            term for reader in self.readers
+            for term in reader.prefix_terms(field, prefix)
+        ))
+
+    def _first(self, method, *args):
+        for reader in reversed(self.readers):
+            result = getattr(reader, method)(*args)
+            if result is not None:
+                return result
+        return None
+
+    def field_length(self, field, key):
+        return self._first('field_length', field, key)
+
+    def total_length(self, field):
+        return sum(reader.total_length(field) for reader in self.readers)
+
+    def value_keys(self, field, value):
+        return [
+            key for reader in self.readers
+            for key in reader.value_keys(field, value)
+        ]
+
+    def range_keys(self, field, operator, value):
+        return [
+            key for reader in self.readers
+            for key in reader.range_keys(field, operator, value)
+        ]
+
+    def valued_keys(self, field):
+        return [
+            key for reader in self.readers
+            for key in reader.valued_keys(field)
+        ]
+
+    def value(self, field, key):
+        return self._first('value', field, key)
+
+    def document(self, key):
+        return self._first('document', key)
+
+
+class DiskIndex(object):
+
+    def __init__(self, name, schema, path):
+        self.name = name
+        self.schema = schema
+        self.primary = primary_field(schema)
+        self.path = path
+        self.buffer = MemoryIndex(name, schema)
+        # Buffers being written as segments, still searchable meanwhile
+        self.flushing = []
+        self.segments = []
+        self.next_segment = 0
+        # Keys deleted while flushing or merging, to delete again
+        # from the segment being written
+        self.trackers = []
+        self.lock = asyncio.Lock()
+        self.flush_scheduled = False
+        self.merging = False
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        manifest = {'next': 0, 'segments': {}}
+        manifest_path = os.path.join(self.path, MANIFEST)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, 'rb') as stream:
+                manifest = jsonbackend.loads(stream.read())
+        self.next_segment = manifest['next']
+        for name, deleted in sorted(manifest['segments'].items()):
+            self.segments.append(Segment(
+                os.path.join(self.path, name + SEGMENT_EXTENSION), deleted
+            ))
+        for filename in os.listdir(self.path):
+            name, extension = os.path.splitext(filename)
+            if filename != MANIFEST and name not in manifest['segments']:
+                # Left over by an interrupted flush or merge
+                os.unlink(os.path.join(self.path, filename))
+        logger.info('Opened index {} with {} documents in {} segments'.format(
+            self.name, sum(s.count() for s in self.segments),
+            len(self.segments)
+        ))
+
+    def set_schema(self, schema):
+        """Changes the schema, for the documents written from now on.
+
+        Segments are immutable: the documents they already contain
+        keep being searched as they were indexed.
+        """
+        self.schema = schema
+        self.buffer = self.buffer.with_schema(schema)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+    def write_manifest(self):
+        write_atomically(
+            os.path.join(self.path, MANIFEST),
+            jsonbackend.dumps_bytes({
+                'next': self.next_segment,
+                'segments': {
+                    segment.name: sorted(segment.deleted)
+                    for segment in self.segments
+                }
+            })
+        )
+
+    def new_segment_path(self):
+        name = 'segment_{:08d}'.format(self.next_segment)
+        self.next_segment += 1
+        return os.path.join(self.path, name + SEGMENT_EXTENSION)
+
+    def reader(self):
+        return MultiReader(self.segments + self.flushing + [self.buffer])
+
+    def _delete_older(self, key):
+        """Deletes a key from everything but the buffer."""
+        deleted = False
+        for reader in self.flushing + self.segments:
+            deleted = reader.delete(key) or deleted
+        if deleted:
+            for tracker in self.trackers:
+                tracker.add(key)
+
+    def update(self, update):
+        key = update.get(self.primary)
+        existing = None
+        if key is not None and str(key) not in self.buffer.documents:
+            existing = self.reader().document(str(key))
+        error = self.buffer.update(update, existing=existing)
+        if error is None:
+            self._delete_older(str(key))
+        return error
+
+    def delete(self, key):
+        self.buffer.delete(key)
+        self._delete_older(str(key))
+
+    def written(self):
+        if self.buffer.count() >= BUFFER_SIZE and not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.ensure_future(self.commit())
+
+    async def _write(self, documents, tracker):
+        """Writes documents as a new segment, in a thread."""
+        path = self.new_segment_path()
+        await asyncio.get_event_loop().run_in_executor(
+            None, write_segment, path, self.schema, documents
+        )
+        segment = Segment(path)
+        for key in tracker:
+            segment.delete(key)
+        return segment
+
+    async def commit(self):
+        """Writes the buffer as a segment, then the manifest."""
+        async with self.lock:
+            self.flush_scheduled = False
+            if self.buffer.count():
+                frozen = self.buffer
+                self.buffer = MemoryIndex(self.name, self.schema)
+                self.flushing.append(frozen)
+                tracker = set()
+                self.trackers.append(tracker)
+                try:
+                    segment = await self._write(
+                        list(frozen.documents.items()), tracker
+                    )
+                except Exception:
+                    # Keep the documents in the buffer, to retry later
+                    for key, document in frozen.documents.items():
+                        if key not in self.buffer.documents:
+                            self.buffer.put(key, document)
+                    raise
+                finally:
+                    self.flushing.remove(frozen)
+                    self.trackers.remove(tracker)
+                self.segments.append(segment)
+            self.write_manifest()
+        self.maybe_merge()
+
+    def maybe_merge(self):
+        if not self.merging and len(self.segments) > MERGE_FACTOR:
+            self.merging = True
+            asyncio.ensure_future(self.merge())
+
+    async def merge(self):
+        """Merges the smallest segments in a new one."""
+        tracker = set()
+        self.trackers.append(tracker)
+        try:
+            sources = sorted(self.segments, key=lambda s: s.count())
+            sources = sources[:MERGE_FACTOR]
+            # Read in the writing thread, from a snapshot of the deletions
+            documents = chain.from_iterable([
+                segment.live_documents(set(segment.deleted))
+                for segment in sources
+            ])
+            logger.info('Merging {} segments of {} in one'.format(
+                len(sources), self.name
+            ))
+            merged = await self._write(documents, tracker)
+            async with self.lock:
+                # Keys deleted or replaced while waiting for the lock
+                for key in tracker:
+                    merged.delete(key)
+                self.segments = [
+                    s for s in self.segments if s not in sources
+                ] + [merged]
+                self.write_manifest()
+            for segment in sources:
+                segment.close()
+                os.unlink(segment.path)
+        except Exception:
+            logger.exception('Merging segments of {} failed'.format(self.name))
+        finally:
+            self.trackers.remove(tracker)
+            self.merging = False
+
+
+class DiskBackend(Backend):
+    """Persists the indexes in ``AZEMULATOR_DATA_DIR``."""
+
+    supports_workers = False
+
+    def __init__(self, path=DATA_DIR):
+        self.path = path
+        self.indexes = {}
+
+    def get_index(self, index):
+        if index not in self.indexes:
+            raise UnknownIndex('Index {} does not exist'.format(index))
+        return self.indexes[index]
+
+    async def stop(self, app):
+        for disk_index in self.indexes.values():
+            await disk_index.commit()
+            disk_index.close()
+
+    async def create_indexes(self, indexes):
+        for name, definition in indexes.items():
+            if name not in self.indexes:
+                disk_index = DiskIndex(
+                    name, definition['schema'], os.path.join(self.path, name)
+                )
+                disk_index.open()
+                self.indexes[name] = disk_index
+
+    async def update_index(self, index, definition):
+        if index in self.indexes:
+            self.indexes[index].set_schema(definition['schema'])
+        else:
+            await self.create_indexes({index: definition})
+
+    async def delete_index(self, index):
+        disk_index = self.indexes.pop(index, None)
+        if disk_index is not None:
+            disk_index.close()
+            shutil.rmtree(disk_index.path)
+
+    async def search(self, index, params, debug=False):
+        disk_index = self.get_index(index)
+        return Searcher(disk_index.schema, disk_index.reader()).search(params)
+
+    async def get(self, index, key, select=None):
+        disk_index = self.get_index(index)
+        return Searcher(disk_index.schema, disk_index.reader()).get(
+            key, select
+        )
+
+    async def count(self, index):
+        return self.get_index(index).reader().count()
+
+    async def suggest(self, index, params):
+        disk_index = self.get_index(index)
+        return Searcher(disk_index.schema, disk_index.reader()).suggest(params)
+
+    async def autocomplete(self, index, params):
+        disk_index = self.get_index(index)
+        return Searcher(
+            disk_index.schema, disk_index.reader()
+        ).autocomplete(params)
+
+    async def index(self, index, inserts, deletes, index_primary,
+                    commit_within=None):
+        disk_index = self.get_index(index)
+        statuses = []
+        for update in inserts:
+            statuses.append((
+                update.get(index_primary),
+                disk_index.update(update)
+            ))
+        for key in deletes:
+            disk_index.delete(key)
+            statuses.append((key, None))
+        disk_index.written()
+        return statuses
+
+    async def commit(self, index):
+        await self.get_index(index).commit()
+        return True
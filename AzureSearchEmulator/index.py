@@ -1,5 +1,18 @@
+import asyncio
+from logging import getLogger
 from aiohttp import web
 from . import solr
+from . import metrics
+from .jsonstream import ValueReader
+from .jsonbackend import json_response
+
+
+COMMIT_TIMER_RESOLUTION = 1
+# Documents are parsed and sent to SOLR in batches of this size,
+# while the next batch is being received
+STREAM_BATCH_SIZE = solr.INDEX_CHUNK_SIZE * solr.INDEX_CONCURRENCY
+
+logger = getLogger(__name__)
 
 
 def strip_action(item):
@@ -9,46 +22,206 @@ def strip_action(item):
     }
 
 
+def to_solr_document(item, index_primary):
+    """Turns an Azure indexing action in a SOLR update document.
+
+    ``merge`` and ``mergeOrUpload`` become atomic updates that only set the
+    fields that were sent; ``merge`` additionally requires the document
+    to already exist (``_version_`` set to 1).
+
+    The key is always sent as ``id``, the SOLR unique key: a copy field
+    would add it a second time when an atomic update rebuilds the document.
+    """
+    action = item['@search.action']
+    document = strip_action(item)
+    key = document[index_primary]
+    if action == 'upload':
+        document['id'] = key
+        return document
+    update = {
+        k: {'set': v} for k, v in document.items()
+        if k != index_primary
+    }
+    update[index_primary] = key
+    update['id'] = key
+    if action == 'merge':
+        update['_version_'] = 1
+    return update
+
+
+def ordered_segments(items, index_primary):
+    """Cuts indexing actions in segments where every key appears once.
+
+    The actions of a segment can be sent concurrently, in any order,
+    while segments are sent one after the other: the actions on a key
+    are then applied in the order of the request, as Azure does.
+    """
+    segments = [[]]
+    keys = set()
+    for item in items:
+        key = item.get(index_primary)
+        if key in keys:
+            segments.append([])
+            keys = set()
+        keys.add(key)
+        segments[-1].append(item)
+    return segments
+
+
 class Indexer(object):
 
-    def __init__(self, indexes_primary):
+    def __init__(self, indexes_primary, indexes_options=None):
         self.indexes_primary = indexes_primary
+        self.indexes_options = indexes_options or {}
+        self.committers = {}
+        self._timer = None
 
-    async def index(self, request):
+    def register(self, index, definition):
+        self.indexes_primary[index] = [
+            k for k, v in definition['schema'].items()
+            if v.get('is_primary', False)
+        ][0]
+        self.indexes_options[index] = definition.get('indexing', {})
+
+    def unregister(self, index):
+        self.indexes_primary.pop(index, None)
+        self.indexes_options.pop(index, None)
+        self.committers.pop(index, None)
+
+    def committer(self, index):
+        if index not in self.committers:
+            options = self.indexes_options.get(index, {})
+            self.committers[index] = solr.Committer(
+                index,
+                commit_within=options.get('commit_within'),
+                hard_commit_interval=options.get('hard_commit_interval', 60)
+            )
+        return self.committers[index]
+
+    async def start(self, app):
+        self._timer = asyncio.ensure_future(
+            self.commit_periodically(app['backend'])
+        )
+
+    async def stop(self, app):
+        # Not set if an earlier startup hook failed
+        if self._timer is not None:
+            self._timer.cancel()
+        for committer in self.committers.values():
+            if committer.dirty:
+                await committer.commit(app['backend'])
+
+    async def commit_periodically(self, backend):
+        while True:
+            await asyncio.sleep(COMMIT_TIMER_RESOLUTION)
+            for committer in list(self.committers.values()):
+                if committer.is_due():
+                    logger.debug(
+                        'Hard commit due for {}'.format(committer.index)
+                    )
+                    await committer.commit(backend)
+
+    async def flush(self, request):
         index = request.match_info['index']
-        index_primary = self.indexes_primary[index]
-        payload = await request.json()
-        inserts = [
-            strip_action(i) for i in payload['value']
-            if i['@search.action'] in ('upload', 'merge', 'mergeOrUpload')
-        ]
-        deletes = [
-            i[index_primary] for i in payload['value']
-            if i['@search.action'] in 'delete'
-        ]
-        succeeded, failed = await solr.index(
-            index,
-            inserts,
-            deletes,
-            index_primary
+        if index not in self.indexes_primary:
+            raise web.HTTPNotFound()
+        committed = await self.committer(index).commit(
+            request.app['backend']
         )
-        return web.json_response(
-            {
-                'value': [
-                    {
-                        'key': i,
-                        'status': True,
-                        'errorMessage': None
-                    }
-                    for i in succeeded
-                ] + [
-                    {
-                        'key': i,
-                        'status': False,
-                        'errorMessage': "An error occurred during indexing"
-                    }
-                    for i in failed
+        return web.Response(status=(204 if committed else 500))
+
+    async def submit(self, backend, index, items):
+        index_primary = self.indexes_primary[index]
+        statuses = []
+        with metrics.timer('solr_update', index):
+            for segment in ordered_segments(items, index_primary):
+                inserts = [
+                    to_solr_document(i, index_primary) for i in segment
+                    if i['@search.action'] in (
+                        'upload', 'merge', 'mergeOrUpload'
+                    )
+                ]
+                deletes = [
+                    i[index_primary] for i in segment
+                    if i['@search.action'] == 'delete'
                 ]
-            },
-            status=(200 if len(failed) == 0 else 207)
+                errors = dict(await backend.index(
+                    index,
+                    inserts,
+                    deletes,
+                    index_primary,
+                    commit_within=self.committer(index).commit_within
+                ))
+                # In the order of the request
+                statuses.extend(
+                    (key, errors[key]) for key in (
+                        i.get(index_primary) for i in segment
+                    )
+                    if key in errors
+                )
+        metrics.count_documents(index, statuses)
+        return statuses
+
+    async def index(self, request):
+        index = request.match_info['index']
+        if index not in self.indexes_primary:
+            raise web.HTTPNotFound()
+        metrics.count_request('index', index)
+        with metrics.timer('indexing', index):
+            return await self._index(request, index)
+
+    async def _index(self, request, index):
+        backend = request.app['backend']
+        reader = ValueReader(request.content)
+        statuses = []
+        pending = None
+        parse_error = None
+        try:
+            items = await reader.read(STREAM_BATCH_SIZE)
+            while items:
+                if pending is not None:
+                    statuses.extend(await pending)
+                pending = asyncio.ensure_future(
+                    self.submit(backend, index, items)
+                )
+                items = await reader.read(STREAM_BATCH_SIZE)
+        except ValueError as e:
+            parse_error = e
+        if pending is not None:
+            statuses.extend(await pending)
+        if any(error is None for _, error in statuses):
+            committer = self.committer(index)
+            with metrics.timer('commit', index):
+                await committer.written(backend)
+            cache = request.app['search_cache']
+            cache.invalidate(index)
+            if committer.commit_within is not None:
+                # Documents only become visible after the soft commit
+                asyncio.get_event_loop().call_later(
+                    committer.commit_within / 1000, cache.invalidate, index
+                )
+        payload = {
+            'value': [
+                {
+                    'key': key,
+                    'status': error is None,
+                    'errorMessage': error
+                }
+                for key, error in statuses
+            ]
+        }
+        if parse_error is not None:
+            metrics.count_error('index', index, 'parse_fail')
+            payload.update({
+                'error': 'parse_fail',
+                'message': 'Error while parsing indexing request',
+                'detail': str(parse_error)
+            })
+            # The batches before the error were already written
+            return json_response(payload, status=(207 if statuses else 400))
+        return json_response(
+            payload,
+            status=(
+                200 if all(error is None for _, error in statuses) else 207
+            )
         )
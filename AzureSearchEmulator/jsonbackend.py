@@ -0,0 +1,81 @@
+"""JSON encoding and decoding, using the fastest available library.
+
+The backend is chosen with the ``AZEMULATOR_JSON`` environment variable
+(``orjson``, ``ujson`` or ``json``); by default the first one installed
+is used, the standard library being the fallback.
+"""
+import os
+import json
+from aiohttp import web
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _choose_backend():
+    requested = os.environ.get('AZEMULATOR_JSON', 'auto').lower()
+    available = {
+        'orjson': orjson,
+        'ujson': ujson,
+        'json': json
+    }
+    if requested != 'auto':
+        if available.get(requested) is None:
+            raise ImportError(
+                'JSON backend {} is not available'.format(requested)
+            )
+        return requested
+    for name in ('orjson', 'ujson'):
+        if available[name] is not None:
+            return name
+    return 'json'
+
+
+BACKEND = _choose_backend()
+
+
+def _stdlib_dumps_bytes(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+if BACKEND == 'orjson':
+    def dumps_bytes(obj):
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # e.g. integers over 64 bits, which the stdlib supports
+            return _stdlib_dumps_bytes(obj)
+
+    def loads(data):
+        return orjson.loads(data)
+elif BACKEND == 'ujson':
+    def dumps_bytes(obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    def loads(data):
+        return ujson.loads(data)
+else:
+    dumps_bytes = _stdlib_dumps_bytes
+
+    def loads(data):
+        return json.loads(data)
+
+
+def dumps(obj):
+    return dumps_bytes(obj).decode('utf-8')
+
+
+def json_response(data, status=200):
+    """Same as ``aiohttp.web.json_response``, with the chosen backend."""
+    return web.Response(
+        body=dumps_bytes(data),
+        status=status,
+        content_type='application/json'
+    )
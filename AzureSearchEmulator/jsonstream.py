@@ -0,0 +1,126 @@
+import json
+import codecs
+
+
+READ_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+
+
+class ValueReader(object):
+    """Incrementally reads the items of the ``value`` array of a JSON object.
+
+    Only the items being returned (and the bytes not yet parsed)
+    are kept in memory, so huge indexing payloads can be processed
+    a few documents at a time as they are received.
+
+    Example::
+
+        reader = ValueReader(request.content)
+        items = await reader.read(100)
+        while items:
+            ...
+            items = await reader.read(100)
+    """
+
+    def __init__(self, stream, read_size=READ_SIZE):
+        self.stream = stream
+        self.read_size = read_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.state = 'start'
+        self.first_item = True
+        self.found = False
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+
+    async def _fill(self):
+        chunk = await self.stream.read(self.read_size)
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        if chunk:
+            self.buffer += self.text_decoder.decode(chunk)
+        else:
+            self.buffer += self.text_decoder.decode(b'', final=True)
+            self.eof = True
+
+    async def _peek(self):
+        """Skips whitespace and returns the next character ('' at the end)."""
+        while True:
+            while (
+                self.pos < len(self.buffer) and
+                self.buffer[self.pos] in WHITESPACE
+            ):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ''
+            await self._fill()
+
+    async def _expect(self, chars):
+        char = await self._peek()
+        if not char or char not in chars:
+            raise ValueError(
+                'Expecting one of {!r} at character {}, found {!r}'.format(
+                    chars, self.pos, char
+                )
+            )
+        self.pos += 1
+        return char
+
+    async def _decode(self):
+        await self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+            else:
+                # A number at the end of the buffer might be truncated
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            await self._fill()
+
+    async def _find_value(self):
+        if self.state == 'start':
+            await self._expect('{')
+            self.state = 'keys'
+        while True:
+            char = await self._peek()
+            if char == '}':
+                self.pos += 1
+                self.state = 'done'
+                return
+            if char == ',':
+                self.pos += 1
+            key = await self._decode()
+            await self._expect(':')
+            if key == 'value' and not self.found:
+                await self._expect('[')
+                self.found = True
+                self.state = 'items'
+                return
+            await self._decode()
+
+    async def read(self, count):
+        """Returns up to ``count`` items, or an empty list when done."""
+        if self.state in ('start', 'keys'):
+            await self._find_value()
+            if not self.found:
+                raise ValueError('The payload has no value array')
+        items = []
+        while self.state == 'items' and len(items) < count:
+            char = await self._peek()
+            if char == ']':
+                self.pos += 1
+                self.state = 'keys'
+                await self._find_value()
+                break
+            if not self.first_item:
+                await self._expect(',')
+            self.first_item = False
+            items.append(await self._decode())
+        return items
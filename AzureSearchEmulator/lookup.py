@@ -0,0 +1,64 @@
+"""Document lookup by key and document count endpoints.
+
+They skip query parsing, scoring and the search cache: lookups use
+the SOLR real-time get handler, so they also see uncommitted documents.
+"""
+import traceback
+from aiohttp import web
+from . import metrics
+from .jsonbackend import json_response
+from .backend import UnknownIndex
+
+
+def failure(endpoint, index, message, error):
+    metrics.count_error(endpoint, index, 'failure')
+    return web.json_response(
+        {
+            'error': 'failure',
+            'message': message,
+            'detail': str(error),
+            'traceback': traceback.format_exc()
+        },
+        status=500
+    )
+
+
+async def get_document(request):
+    index = request.match_info['index']
+    if index not in request.app['indexes']:
+        raise web.HTTPNotFound()
+    metrics.count_request('lookup', index)
+    select = request.query.get('$select')
+    if select is not None:
+        select = select.split(',')
+    with metrics.timer('request', index):
+        try:
+            with metrics.timer('solr', index):
+                document = await request.app['backend'].get(
+                    index,
+                    request.match_info['key'],
+                    select
+                )
+        except UnknownIndex:
+            raise web.HTTPNotFound()
+        except Exception as e:
+            return failure('lookup', index, 'Error while looking up', e)
+    if document is None:
+        raise web.HTTPNotFound()
+    return json_response(document)
+
+
+async def count(request):
+    index = request.match_info['index']
+    if index not in request.app['indexes']:
+        raise web.HTTPNotFound()
+    metrics.count_request('count', index)
+    with metrics.timer('request', index):
+        try:
+            with metrics.timer('solr', index):
+                result = await request.app['backend'].count(index)
+        except UnknownIndex:
+            raise web.HTTPNotFound()
+        except Exception as e:
+            return failure('count', index, 'Error while counting', e)
+    return web.Response(text=str(result), content_type='text/plain')
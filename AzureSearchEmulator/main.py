@@ -1,17 +1,62 @@
 import os
 import sys
+import time
+import signal
+import socket
+import asyncio
+import multiprocessing
 from logging import basicConfig, getLogger
 from aiohttp import web
 from .search import search
+from .suggest import suggest, autocomplete
+from .lookup import get_document, count
 from .index import Indexer
-from .tools import recreate_indexes
+from .cache import SearchCache, SingleFlight, SharedGenerations
+from .querypool import QueryPool
+from .metrics import make_handler as make_metrics_handler, track_indexes
+from . import management
+from .backend import SolrBackend
+from .memory import MemoryBackend
+from .disk import DiskBackend
+from .tools import (
+    load_indexes, primary_keys, indexing_options, recreate_indexes,
+    stop_bootstrap, bootstrap
+)
 
 
 LOGFMT = '[%(asctime)s %(levelname)s] %(name)s %(message)s'
 INDEXES_FILE = '/srv/azuresearch/indexes.json'
+HOST = os.environ.get('AZEMULATOR_HOST', '0.0.0.0')
+PORT = int(os.environ.get('AZEMULATOR_PORT', '8080'))
+WORKERS = int(os.environ.get('AZEMULATOR_WORKERS', '1'))
+BACKEND = os.environ.get('AZEMULATOR_BACKEND', 'solr')
+BACKENDS = {
+    'solr': SolrBackend,
+    'memory': MemoryBackend,
+    'disk': DiskBackend
+}
 logger = getLogger(__name__)
 
 
+def collect_stats(app):
+    return {
+        'search_cache': app['search_cache'].stats(),
+        'search_flights': app['search_flights'].stats(),
+        'query_pool': app['query_pool'].stats(),
+        'backend': app['backend'].stats()
+    }
+
+
+async def stats(request):
+    return web.json_response(collect_stats(request.app))
+
+
+async def ready(request):
+    if request.app['ready'].is_set():
+        return web.json_response({'ready': True})
+    return web.json_response({'ready': False}, status=503)
+
+
 async def hello(request):
     return web.json_response({
         'id': 'AzureSearchEmulator',
@@ -20,6 +65,59 @@ async def hello(request):
     })
 
 
+def make_app(indexes, debug_mode=False, create_indexes=True,
+             generations=None, indexes_file=None):
+    indexer = Indexer(primary_keys(indexes), indexing_options(indexes))
+    middlewares = []
+    if generations is not None:
+        middlewares.append(management.refresh_indexes)
+    app = web.Application(debug=debug_mode, middlewares=middlewares)
+    app['indexes'] = indexes
+    app['indexes_file'] = indexes_file
+    app['generations'] = generations
+    track_indexes(indexes)
+    app['indexer'] = indexer
+    app['backend'] = BACKENDS[BACKEND]()
+    app['search_cache'] = SearchCache(generations=generations)
+    app['search_flights'] = SingleFlight()
+    app['query_pool'] = QueryPool()
+    app['ready'] = asyncio.Event()
+    app['bootstrap'] = []
+    app.on_startup.append(app['backend'].start)
+    app.on_startup.append(app['query_pool'].start)
+    if create_indexes:
+        app.on_startup.append(recreate_indexes)
+    else:
+        app['ready'].set()
+    app.on_startup.append(indexer.start)
+    app.on_cleanup.append(stop_bootstrap)
+    app.on_cleanup.append(indexer.stop)
+    app.on_cleanup.append(app['query_pool'].stop)
+    app.on_cleanup.append(app['backend'].stop)
+    app.router.add_get('/', hello)
+    app.router.add_get('/ready', ready)
+    app.router.add_get('/stats', stats)
+    app.router.add_get('/metrics', make_metrics_handler(collect_stats))
+    app.router.add_get('/indexes', management.list_indexes)
+    app.router.add_get('/indexes/{index}', management.get_index)
+    app.router.add_put('/indexes/{index}', management.put_index)
+    app.router.add_delete('/indexes/{index}', management.delete_index)
+    app.router.add_get('/indexes/{index}/docs', search)
+    app.router.add_post('/indexes/{index}/docs', search)
+    app.router.add_get('/indexes/{index}/docs/search', search)
+    app.router.add_post('/indexes/{index}/docs/search', search)
+    app.router.add_get('/indexes/{index}/docs/suggest', suggest)
+    app.router.add_post('/indexes/{index}/docs/suggest', suggest)
+    app.router.add_get('/indexes/{index}/docs/autocomplete', autocomplete)
+    app.router.add_post('/indexes/{index}/docs/autocomplete', autocomplete)
+    app.router.add_post('/indexes/{index}/docs/index', indexer.index)
+    app.router.add_post('/indexes/{index}/docs/flush', indexer.flush)
+    # After the other document routes, which would match as keys
+    app.router.add_get('/indexes/{index}/docs/$count', count)
+    app.router.add_get('/indexes/{index}/docs/{key}', get_document)
+    return app
+
+
 def main():
     debug_mode = (
         os.environ.get('AZEMULATOR_DEBUG', '').lower() in ('true', 'on', '1')
@@ -28,16 +126,86 @@ def main():
         basicConfig(level='DEBUG', format=LOGFMT, stream=sys.stdout)
     else:
         basicConfig(level='INFO', format=LOGFMT, stream=sys.stdout)
+    indexes = {}
     if os.path.isfile(INDEXES_FILE):
-        logger.info('Checking indexes to re-create')
         with open(INDEXES_FILE, 'r', encoding='utf-8') as stream:
-            indexes_primary = recreate_indexes(stream)
-    indexer = Indexer(indexes_primary)
-    app = web.Application(debug=debug_mode)
-    app.router.add_get('/', hello)
-    app.router.add_get('/indexes/{index}/docs', search)
-    app.router.add_post('/indexes/{index}/docs', search)
-    app.router.add_get('/indexes/{index}/docs/search', search)
-    app.router.add_post('/indexes/{index}/docs/search', search)
-    app.router.add_post('/indexes/{index}/docs/index', indexer.index)
-    web.run_app(app)
+            indexes = load_indexes(stream)
+    if BACKEND not in BACKENDS:
+        logger.critical('Unknown backend {}, use one of {}'.format(
+            BACKEND, ', '.join(sorted(BACKENDS))
+        ))
+        sys.exit(1)
+    workers = WORKERS
+    if workers > 1 and not BACKENDS[BACKEND].supports_workers:
+        logger.warning(
+            'The {} backend cannot be shared by workers, using just one'
+            .format(BACKEND)
+        )
+        workers = 1
+    if workers > 1:
+        serve_workers(indexes, debug_mode, workers)
+    else:
+        web.run_app(
+            make_app(indexes, debug_mode, indexes_file=INDEXES_FILE),
+            host=HOST,
+            port=PORT
+        )
+
+
+def serve_worker(indexes, debug_mode, sock, generations):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    app = make_app(
+        indexes,
+        debug_mode,
+        create_indexes=False,
+        generations=generations,
+        indexes_file=INDEXES_FILE
+    )
+    web.run_app(app, sock=sock, print=None)
+
+
+def serve_workers(indexes, debug_mode, workers):
+    """Pre-forks worker processes all accepting on the same socket.
+
+    Indexes are created only once, before forking,
+    and dead workers are restarted.
+    """
+    bootstrap(indexes)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((HOST, PORT))
+    sock.listen(128)
+    generations = SharedGenerations()
+    context = multiprocessing.get_context('fork')
+
+    def start():
+        process = context.Process(
+            target=serve_worker,
+            args=(indexes, debug_mode, sock, generations)
+        )
+        process.start()
+        logger.info('Started worker {}'.format(process.pid))
+        return process
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info('Serving on http://{}:{}/ with {} workers'.format(
+        HOST, PORT, workers
+    ))
+    processes = [start() for _ in range(workers)]
+    try:
+        while True:
+            time.sleep(1)
+            for position, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.critical('Worker {} exited with {}'.format(
+                        process.pid, process.exitcode
+                    ))
+                    processes[position] = start()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info('Stopping workers')
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+    finally:
+        sock.close()
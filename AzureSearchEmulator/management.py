@@ -0,0 +1,247 @@
+"""Index management API: create, update, get and delete indexes.
+
+Index definitions are received and returned in the Azure Search format,
+and kept in the format of ``indexes.json``.
+"""
+import os
+import json
+import traceback
+from logging import getLogger
+from aiohttp import web
+from .tools import TYPES, primary_keys
+
+
+ATTRIBUTES = ('searchable', 'filterable', 'retrievable', 'sortable',
+              'facetable')
+TEXT_TYPES = ('Edm.String', 'Collection(Edm.String)')
+logger = getLogger(__name__)
+
+
+def from_azure(name, definition):
+    """Turns an Azure Search index definition in an emulator one."""
+    if not isinstance(definition, dict):
+        raise ValueError('The index definition must be an object')
+    if definition.get('name', name) != name:
+        raise ValueError('The index name does not match the URL')
+    fields = definition.get('fields')
+    if not isinstance(fields, list) or not fields:
+        raise ValueError('The index must have fields')
+    schema = {}
+    for field in fields:
+        if 'name' not in field or 'type' not in field:
+            raise ValueError('Fields must have a name and a type')
+        if field['type'] not in TYPES:
+            raise ValueError('Unsupported type {} for field {}'.format(
+                field['type'], field['name']
+            ))
+        schema[field['name']] = {
+            'type': field['type'],
+            # As in Azure Search, every attribute is enabled by default
+            'tags': [
+                attribute for attribute in ATTRIBUTES
+                if field.get(
+                    attribute,
+                    attribute != 'searchable' or field['type'] in TEXT_TYPES
+                )
+            ],
+            'is_primary': bool(field.get('key', False))
+        }
+    keys = [k for k, v in schema.items() if v['is_primary']]
+    if len(keys) != 1:
+        raise ValueError('The index must have exactly one key field')
+    if schema[keys[0]]['type'] != 'Edm.String':
+        raise ValueError('The key field must be an Edm.String')
+    result = {'schema': schema}
+    suggesters = definition.get('suggesters') or []
+    for suggester in suggesters:
+        if 'name' not in suggester or not suggester.get('sourceFields'):
+            raise ValueError('Suggesters must have a name and source fields')
+        for field in suggester['sourceFields']:
+            if field not in schema or (
+                schema[field]['type'] not in TEXT_TYPES or
+                'searchable' not in schema[field]['tags']
+            ):
+                raise ValueError(
+                    'Suggester source field {} must be a searchable '
+                    'string'.format(field)
+                )
+    if suggesters:
+        result['suggesters'] = [
+            {
+                'name': suggester['name'],
+                'searchMode': suggester.get(
+                    'searchMode', 'analyzingInfixMatching'
+                ),
+                'sourceFields': list(suggester['sourceFields'])
+            }
+            for suggester in suggesters
+        ]
+    return result
+
+
+def to_azure(name, definition):
+    return {
+        'name': name,
+        'fields': [
+            dict(
+                [
+                    ('name', field),
+                    ('type', options['type']),
+                    ('key', options.get('is_primary', False))
+                ] + [
+                    (attribute, attribute in options.get('tags', []))
+                    for attribute in ATTRIBUTES
+                ]
+            )
+            for field, options in definition['schema'].items()
+        ],
+        'suggesters': definition.get('suggesters', [])
+    }
+
+
+def save_index(app, name):
+    """Saves the definition of an index, to load it again on restart.
+
+    Only that index is changed in the file, which may have been
+    changed by other worker processes too.
+    """
+    path = app['indexes_file']
+    if path is None:
+        return
+    try:
+        indexes = {}
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as stream:
+                indexes = json.load(stream)
+        if name in app['indexes']:
+            indexes[name] = app['indexes'][name]
+        else:
+            indexes.pop(name, None)
+        with open(path + '.tmp', 'w', encoding='utf-8') as stream:
+            json.dump(indexes, stream, indent=2)
+        os.replace(path + '.tmp', path)
+    except (OSError, ValueError) as e:
+        logger.warning('Cannot save index definitions to {}: {}'.format(
+            path, e
+        ))
+        return
+    if app['generations'] is not None:
+        app['generations'].change_definitions()
+
+
+def reload_indexes(app):
+    """Loads the definitions saved by the other worker processes."""
+    path = app['indexes_file']
+    try:
+        with open(path, 'r', encoding='utf-8') as stream:
+            indexes = json.load(stream)
+    except (OSError, ValueError) as e:
+        logger.warning('Cannot reload index definitions from {}: {}'.format(
+            path, e
+        ))
+        return
+    for name in set(app['indexes']) - set(indexes):
+        del app['indexes'][name]
+        app['indexer'].unregister(name)
+    for name, definition in indexes.items():
+        if app['indexes'].get(name) != definition:
+            app['indexes'][name] = definition
+            app['indexer'].register(name, definition)
+
+
+@web.middleware
+async def refresh_indexes(request, handler):
+    """Reloads the indexes changed by other workers before a request."""
+    if request.app['generations'].definitions_changed():
+        reload_indexes(request.app)
+    return await handler(request)
+
+
+def error_response(error, message, detail, status):
+    return web.json_response(
+        {
+            'error': error,
+            'message': message,
+            'detail': detail
+        },
+        status=status
+    )
+
+
+async def list_indexes(request):
+    return web.json_response({
+        'value': [
+            to_azure(name, definition)
+            for name, definition in sorted(request.app['indexes'].items())
+        ]
+    })
+
+
+async def get_index(request):
+    name = request.match_info['index']
+    if name not in request.app['indexes']:
+        raise web.HTTPNotFound()
+    return web.json_response(to_azure(name, request.app['indexes'][name]))
+
+
+async def put_index(request):
+    app = request.app
+    name = request.match_info['index']
+    previous = app['indexes'].get(name)
+    try:
+        definition = from_azure(name, await request.json())
+    except ValueError as e:
+        return error_response(
+            'invalid_index', 'Invalid index definition', str(e), 400
+        )
+    if previous is not None:
+        if primary_keys({name: previous}) != primary_keys({name: definition}):
+            return error_response(
+                'invalid_index',
+                'Invalid index definition',
+                'The key field of an existing index cannot be changed',
+                400
+            )
+        for option in ('indexing', 'cloud'):
+            if option in previous:
+                definition[option] = previous[option]
+    try:
+        await app['backend'].update_index(name, definition)
+    except Exception as e:
+        logger.exception('Failed to create or update index {}'.format(name))
+        return web.json_response(
+            {
+                'error': 'failure',
+                'message': 'Error while creating or updating the index',
+                'detail': str(e),
+                'traceback': traceback.format_exc()
+            },
+            status=500
+        )
+    app['indexes'][name] = definition
+    app['indexer'].register(name, definition)
+    app['search_cache'].invalidate(name)
+    save_index(app, name)
+    return web.json_response(
+        to_azure(name, definition),
+        status=(201 if previous is None else 200)
+    )
+
+
+async def delete_index(request):
+    app = request.app
+    name = request.match_info['index']
+    if name not in app['indexes']:
+        raise web.HTTPNotFound()
+    try:
+        await app['backend'].delete_index(name)
+    except Exception as e:
+        logger.exception('Failed to delete index {}'.format(name))
+        return error_response(
+            'failure', 'Error while deleting the index', str(e), 500
+        )
+    del app['indexes'][name]
+    app['indexer'].unregister(name)
+    app['search_cache'].invalidate(name)
+    save_index(app, name)
+    return web.Response(status=204)
@@ -0,0 +1,954 @@
+"""Pure-Python, in-memory search backend.
+
+It is meant for tests and development, where starting SOLR is too slow:
+indexes are defined by the same schema as ``indexes.json``, documents are
+visible as soon as they are indexed and everything is lost on restart.
+
+Every index keeps an inverted index (with positions) of its searchable
+fields, scored with BM25, a map from values to documents for the others,
+and sorted arrays of values for range filters and sorting.
+"""
+import re
+import math
+import time
+import heapq
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from datetime import timedelta
+from logging import getLogger
+from .backend import Backend, UnknownIndex
+from . import azquery
+from . import odata
+
+
+ANALYZER_REGEXP = re.compile(r'\w+')
+BM25_K1 = 1.2
+BM25_B = 0.75
+DEFAULT_FACET_LIMIT = 10
+# The range queries of ``values`` facets, see ``azquery.facet_range_query``
+RANGE_REGEXP = re.compile(r'^(\w+):\[(\S+) TO (\S+)([\]}])$')
+# The bounds of ``interval`` facets, see ``azquery.az_facets_to_solr``
+AGGREGATION_REGEXP = re.compile(r'^(min|max)\((\w+)\)$')
+logger = getLogger(__name__)
+
+
+def analyze(text):
+    return [token.lower() for token in ANALYZER_REGEXP.findall(str(text))]
+
+
+def coerce(field_type, value):
+    """Converts a value to the Python type used for a field type."""
+    if value is None:
+        return None
+    if field_type.startswith('Collection('):
+        inner = field_type[len('Collection('):-1]
+        if not isinstance(value, list):
+            value = [value]
+        return [coerce(inner, v) for v in value]
+    if field_type in ('Edm.Int32', 'Edm.Int64'):
+        return int(value)
+    if field_type == 'Edm.Double':
+        return float(value)
+    if field_type == 'Edm.Boolean':
+        if isinstance(value, str):
+            if value.lower() not in ('true', 'false'):
+                raise ValueError('{!r} is not a boolean'.format(value))
+            return value.lower() == 'true'
+        return bool(value)
+    return str(value)
+
+
+class Descending(object):
+    """Wraps a sort value to sort it in descending order."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def schema_fields(schema, tag):
+    return [k for k, v in schema.items() if tag in v.get('tags', [])]
+
+
+def primary_field(schema):
+    return [k for k, v in schema.items() if v.get('is_primary', False)][0]
+
+
+def range_slice(sorted_values, operator, value):
+    """Returns the slice of a sorted sequence matching a comparison."""
+    if operator == 'gt':
+        return slice(bisect_right(sorted_values, value), None)
+    if operator == 'gte':
+        return slice(bisect_left(sorted_values, value), None)
+    if operator == 'lt':
+        return slice(None, bisect_left(sorted_values, value))
+    if operator == 'lte':
+        return slice(None, bisect_right(sorted_values, value))
+    return slice(
+        bisect_left(sorted_values, value),
+        bisect_right(sorted_values, value)
+    )
+
+
+def apply_update(existing, update, primary):
+    """Builds the document resulting from a SOLR update document.
+
+    ``existing`` is the current document, or None.
+    Raises LookupError when an update must not create the document.
+    """
+    atomic = '_version_' in update or any(
+        isinstance(v, dict) and 'set' in v for v in update.values()
+    )
+    if atomic:
+        if existing is None and update.get('_version_') == 1:
+            raise LookupError('Document not found')
+        document = dict(existing or {})
+        for field, value in update.items():
+            if field == '_version_':
+                continue
+            if isinstance(value, dict) and 'set' in value:
+                value = value['set']
+            if value is None:
+                document.pop(field, None)
+            else:
+                document[field] = value
+    else:
+        document = {k: v for k, v in update.items() if v is not None}
+    if primary != 'id':
+        document.pop('id', None)
+    return document
+
+
+def lucene_tokens(query):
+    """Splits a (subset of) Lucene query in ``(kind, text)`` tokens."""
+    tokens = []
+    pos = 0
+    while pos < len(query):
+        char = query[pos]
+        if char.isspace():
+            pos += 1
+        elif char in '()':
+            tokens.append((char, char))
+            pos += 1
+        elif char == '"':
+            end = pos + 1
+            while end < len(query) and query[end] != '"':
+                end += 2 if query[end] == '\\' else 1
+            tokens.append(('phrase', query[pos + 1:end]))
+            pos = end + 1
+        elif query.startswith('&&', pos) or query.startswith('||', pos):
+            tokens.append(('op', 'AND' if char == '&' else 'OR'))
+            pos += 2
+        elif char in '+-!':
+            tokens.append(('op', '+' if char == '+' else '-'))
+            pos += 1
+        else:
+            start = pos
+            while (
+                pos < len(query) and
+                not query[pos].isspace() and
+                query[pos] not in '()":'
+            ):
+                pos += 2 if query[pos] == '\\' else 1
+            text = re.sub(r'\\(.)', r'\1', query[start:pos])
+            if pos < len(query) and query[pos] == ':':
+                tokens.append(('field', text))
+                pos += 1
+            elif text in ('AND', 'OR'):
+                tokens.append(('op', text))
+            elif text == 'NOT':
+                tokens.append(('op', '-'))
+            else:
+                tokens.append(('term', text))
+    return tokens
+
+
+def parse_lucene(tokens, pos, default_must):
+    """Parses Lucene tokens in a list of ``[occur, node]`` clauses.
+
+    Occurrences are ``must``, ``should`` and ``must_not``: as in
+    the Lucene classic query parser ``AND`` makes both its sides required
+    and ``OR`` optional, otherwise the default operator applies.
+    """
+    clauses = []
+    occur = None
+    conjunction = None
+    while pos < len(tokens):
+        kind, text = tokens[pos]
+        if kind == ')':
+            break
+        pos += 1
+        if kind == 'op':
+            if text in ('AND', 'OR'):
+                conjunction = text
+            else:
+                occur = 'must' if text == '+' else 'must_not'
+            continue
+        field = None
+        if kind == 'field':
+            field = text
+            if pos >= len(tokens):
+                break
+            kind, text = tokens[pos]
+            pos += 1
+        if kind == '(':
+            sub_clauses, pos = parse_lucene(tokens, pos, default_must)
+            pos += 1
+            node = ('bool', sub_clauses, field)
+        elif kind in ('term', 'phrase'):
+            node = (kind, text, field)
+        else:
+            continue
+        if conjunction == 'AND':
+            if clauses and clauses[-1][0] == 'should':
+                clauses[-1][0] = 'must'
+            occur = occur or 'must'
+        elif conjunction == 'OR':
+            if clauses and clauses[-1][0] == 'must' and default_must:
+                clauses[-1][0] = 'should'
+            occur = occur or 'should'
+        clauses.append([occur or ('must' if default_must else 'should'), node])
+        occur = None
+        conjunction = None
+    return clauses, pos
+
+
+class MemoryIndex(object):
+    """The documents of an index, with their inverted index and values.
+
+    Besides writing, it implements the reader interface used by
+    ``Searcher``: documents are identified by their key and every method
+    only considers the live documents.
+    """
+
+    def __init__(self, name, schema):
+        self.name = name
+        self.schema = schema
+        self.primary = primary_field(schema)
+        self.searchable = schema_fields(schema, 'searchable')
+        self.documents = {}
+        # Searchable fields: field -> term -> key -> positions
+        self.postings = {field: {} for field in self.searchable}
+        self.lengths = {field: {} for field in self.searchable}
+        self.total_lengths = {field: 0 for field in self.searchable}
+        self.sorted_terms = {}
+        # All fields: field -> value -> keys
+        self.values = {field: {} for field in schema}
+        # All fields: field -> ([sorted values], [keys])
+        self.sorted = {field: ([], []) for field in schema}
+
+    def _add(self, key, document):
+        self.documents[key] = document
+        for field, value in document.items():
+            if field not in self.schema:
+                continue
+            values = as_list(value)
+            for item in values:
+                self.values[field].setdefault(item, set()).add(key)
+                sorted_values, sorted_keys = self.sorted[field]
+                position = bisect_right(sorted_values, item)
+                sorted_values.insert(position, item)
+                sorted_keys.insert(position, key)
+            if field in self.postings:
+                tokens = [t for item in values for t in analyze(item)]
+                postings = self.postings[field]
+                for position, token in enumerate(tokens):
+                    if token not in postings:
+                        self.sorted_terms.pop(field, None)
+                        postings[token] = {}
+                    postings[token].setdefault(key, []).append(position)
+                self.lengths[field][key] = len(tokens)
+                self.total_lengths[field] += len(tokens)
+
+    def _remove(self, key):
+        document = self.documents.pop(key, None)
+        if document is None:
+            return False
+        for field, value in document.items():
+            if field not in self.schema:
+                continue
+            values = as_list(value)
+            for item in values:
+                keys = self.values[field].get(item)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.values[field][item]
+                sorted_values, sorted_keys = self.sorted[field]
+                position = bisect_left(sorted_values, item)
+                while sorted_keys[position] != key:
+                    position += 1
+                del sorted_values[position]
+                del sorted_keys[position]
+            if field in self.postings:
+                postings = self.postings[field]
+                for token in set(t for item in values for t in analyze(item)):
+                    del postings[token][key]
+                    if not postings[token]:
+                        del postings[token]
+                        self.sorted_terms.pop(field, None)
+                self.total_lengths[field] -= self.lengths[field].pop(key)
+        return True
+
+    def coerce_document(self, document):
+        return {
+            field: (
+                coerce(self.schema[field]['type'], value)
+                if field in self.schema else value
+            )
+            for field, value in document.items()
+        }
+
+    def put(self, key, document):
+        """Adds or replaces an already coerced document."""
+        self._remove(key)
+        self._add(key, document)
+
+    def update(self, update, existing=None):
+        """Applies a SOLR update document, returning an error or None.
+
+        ``existing`` is the current document, when it is not stored here.
+        """
+        key = update.get(self.primary)
+        if key is None:
+            return 'Missing key field {}'.format(self.primary)
+        key = str(key)
+        try:
+            document = apply_update(
+                self.documents.get(key, existing), update, self.primary
+            )
+            document = self.coerce_document(document)
+        except LookupError as e:
+            return str(e)
+        except (TypeError, ValueError) as e:
+            return 'Invalid document: {}'.format(e)
+        self.put(key, document)
+        return None
+
+    def delete(self, key):
+        return self._remove(str(key))
+
+    def with_schema(self, schema):
+        """Returns a copy of the index with another schema.
+
+        Documents whose values do not fit the new schema are dropped.
+        """
+        index = MemoryIndex(self.name, schema)
+        for key, document in self.documents.items():
+            try:
+                index.put(key, index.coerce_document(document))
+            except (TypeError, ValueError) as e:
+                logger.warning('Dropping document {} of {}: {}'.format(
+                    key, self.name, e
+                ))
+        return index
+
+    # Reader interface
+
+    def keys(self):
+        return self.documents.keys()
+
+    def count(self):
+        return len(self.documents)
+
+    def get_postings(self, field, term):
+        return self.postings[field].get(term, {})
+
+    def prefix_terms(self, field, prefix):
+        if field not in self.sorted_terms:
+            self.sorted_terms[field] = sorted(self.postings[field])
+        terms = self.sorted_terms[field]
+        start = bisect_left(terms, prefix)
+        end = start
+        while end < len(terms) and terms[end].startswith(prefix):
+            end += 1
+        return terms[start:end]
+
+    def field_length(self, field, key):
+        return self.lengths[field].get(key)
+
+    def total_length(self, field):
+        return self.total_lengths[field]
+
+    def value_keys(self, field, value):
+        return self.values[field].get(value, ())
+
+    def range_keys(self, field, operator, value):
+        sorted_values, sorted_keys = self.sorted[field]
+        return sorted_keys[range_slice(sorted_values, operator, value)]
+
+    def valued_keys(self, field):
+        return self.sorted[field][1]
+
+    def value(self, field, key):
+        document = self.documents.get(key)
+        return None if document is None else document.get(field)
+
+    def document(self, key):
+        return self.documents.get(key)
+
+
+class Searcher(object):
+    """Runs searches on a reader, e.g. a ``MemoryIndex``."""
+
+    def __init__(self, schema, reader):
+        self.schema = schema
+        self.reader = reader
+        self.searchable = schema_fields(schema, 'searchable')
+        self.retrievable = schema_fields(schema, 'retrievable')
+
+    def field_type(self, field):
+        if field not in self.schema:
+            raise ValueError('Unknown field {}'.format(field))
+        return self.schema[field]['type']
+
+    # Full text search
+
+    def _bm25(self, field, matches):
+        """Scores ``{key: term frequency}`` for a term in a field."""
+        reader = self.reader
+        count = reader.count()
+        idf = math.log(1 + (count - len(matches) + 0.5) / (len(matches) + 0.5))
+        average = reader.total_length(field) / count if count else 1
+        scores = {}
+        for key, frequency in matches.items():
+            length = reader.field_length(field, key) or 0
+            scores[key] = idf * frequency * (BM25_K1 + 1) / (
+                frequency + BM25_K1 * (
+                    1 - BM25_B + BM25_B * length / (average or 1)
+                )
+            )
+        return scores
+
+    def _phrase(self, field, tokens):
+        postings = [self.reader.get_postings(field, t) for t in tokens]
+        if not all(postings):
+            return {}
+        keys = set(postings[0])
+        for token_postings in postings[1:]:
+            keys.intersection_update(token_postings)
+        matches = {}
+        for key in keys:
+            starts = set(postings[0][key])
+            for offset, token_postings in enumerate(postings[1:], 1):
+                starts.intersection_update(
+                    p - offset for p in token_postings[key]
+                )
+            if starts:
+                matches[key] = len(starts)
+        return matches
+
+    def _match_field(self, field, text, phrase):
+        """Returns ``{key: score}`` for a term or phrase in a field."""
+        if field not in self.searchable:
+            # Not analyzed: exact match on the value
+            try:
+                value = coerce(self.field_type(field), text)
+            except (TypeError, ValueError):
+                return {}
+            if isinstance(value, list):
+                value = value[0]
+            return {key: 1.0 for key in self.reader.value_keys(field, value)}
+        if not phrase and text.endswith('*'):
+            scores = {}
+            for term in self.reader.prefix_terms(field, text[:-1].lower()):
+                for key in self.reader.get_postings(field, term):
+                    scores[key] = 1.0
+            return scores
+        tokens = analyze(text)
+        if not tokens:
+            return {}
+        if len(tokens) == 1:
+            matches = {
+                key: len(positions) for key, positions
+                in self.reader.get_postings(field, tokens[0]).items()
+            }
+        else:
+            matches = self._phrase(field, tokens)
+        return self._bm25(field, matches)
+
+    def _evaluate(self, node, fields, default_must):
+        kind, value, field = node
+        if field is not None and field != '*':
+            fields = [field]
+        if kind == 'bool':
+            return self._evaluate_clauses(value, fields, default_must)
+        if value == '*' and kind == 'term':
+            return dict.fromkeys(self.reader.keys(), 1.0)
+        scores = {}
+        for search_field in fields:
+            for key, score in self._match_field(
+                search_field, value, kind == 'phrase'
+            ).items():
+                scores[key] = scores.get(key, 0.0) + score
+        return scores
+
+    def _evaluate_clauses(self, clauses, fields, default_must):
+        must = [
+            self._evaluate(node, fields, default_must)
+            for occur, node in clauses if occur == 'must'
+        ]
+        should = [
+            self._evaluate(node, fields, default_must)
+            for occur, node in clauses if occur == 'should'
+        ]
+        must_not = [
+            self._evaluate(node, fields, default_must)
+            for occur, node in clauses if occur == 'must_not'
+        ]
+        if must:
+            keys = set(must[0])
+            for scores in must[1:]:
+                keys.intersection_update(scores)
+        elif should:
+            keys = set()
+            for scores in should:
+                keys.update(scores)
+        else:
+            keys = set(self.reader.keys()) if must_not else set()
+        for scores in must_not:
+            keys.difference_update(scores)
+        result = dict.fromkeys(keys, 0.0)
+        for scores in must + should:
+            for key, score in scores.items():
+                if key in result:
+                    result[key] += score
+        return result
+
+    def search_text(self, query, fields, mode):
+        """Returns ``{key: score}`` for the documents matching the query."""
+        fields = fields or self.searchable
+        for field in fields:
+            self.field_type(field)
+        if query.strip() in ('*', '*:*'):
+            return dict.fromkeys(self.reader.keys(), 1.0)
+        clauses, _ = parse_lucene(lucene_tokens(query), 0, mode == 'all')
+        return self._evaluate_clauses(clauses, fields, mode == 'all')
+
+    # OData filters
+
+    def _operand(self, node):
+        if node[0] == 'quotes':
+            return ' '.join(node[1])
+        return node[1]
+
+    def _compare(self, operator, field, text):
+        field_type = self.field_type(field)
+        if text == 'null':
+            missing = set(self.reader.keys()).difference(
+                self.reader.valued_keys(field)
+            )
+            if operator == 'eq':
+                return missing
+            if operator == 'neq':
+                return set(self.reader.keys()) - missing
+            raise ValueError('null can only be compared for equality')
+        try:
+            value = coerce(field_type, text)
+        except (TypeError, ValueError):
+            raise ValueError(
+                '{!r} is not a valid value for {}'.format(text, field)
+            )
+        if isinstance(value, list):
+            value = value[0]
+        if operator in ('eq', 'neq'):
+            if field in self.searchable:
+                keys = set(self._match_field(field, text, True))
+            else:
+                keys = set(self.reader.value_keys(field, value))
+            if operator == 'neq':
+                return set(self.reader.keys()) - keys
+            return keys
+        return set(self.reader.range_keys(field, operator, value))
+
+    def filter(self, node):
+        """Returns the set of keys matching an OData filter AST."""
+        name = node[0]
+        if name == 'and':
+            keys = self.filter(node[1][0])
+            for item in node[1][1:]:
+                keys &= self.filter(item)
+            return keys
+        if name == 'or':
+            keys = self.filter(node[1][0])
+            for item in node[1][1:]:
+                keys |= self.filter(item)
+            return keys
+        if name == 'not':
+            nots = 0
+            while node[0] == 'not':
+                nots += 1
+                node = node[1]
+            if nots % 2 == 0:
+                return self.filter(node)
+            return set(self.reader.keys()) - self.filter(node)
+        if name == 'parenthesis':
+            keys = self.filter(node[1][0])
+            for item in node[1][1:]:
+                keys &= self.filter(item)
+            return keys
+        if name in odata.COMPARISONS:
+            return self._compare(
+                name, self._operand(node[1]), self._operand(node[2])
+            )
+        raise ValueError('Unsupported filter {}'.format(name))
+
+    # Facets, sorting and results
+
+    def facet_query(self, keys, query):
+        """Returns the keys matching a ``*:*`` or range facet query."""
+        if query == '*:*':
+            return set(keys)
+        match = RANGE_REGEXP.match(query)
+        if match is None:
+            raise ValueError('Unsupported facet query {}'.format(query))
+        field, start, end, upper = match.groups()
+        matched = set(keys)
+        if start != '*':
+            matched &= self._compare('gte', field, start.strip('"'))
+        if end != '*':
+            matched &= self._compare(
+                'lte' if upper == ']' else 'lt', field, end.strip('"')
+            )
+        return matched
+
+    def aggregate(self, keys, function):
+        """Computes a ``min(field)`` or ``max(field)`` facet."""
+        match = AGGREGATION_REGEXP.match(function)
+        if match is None:
+            raise ValueError('Unsupported facet function {}'.format(function))
+        name, field = match.groups()
+        is_date = 'Edm.DateTimeOffset' in self.field_type(field)
+        values = [
+            value for key in keys
+            for value in as_list(self.reader.value(field, key))
+        ]
+        if not values:
+            return None
+        return (min if name == 'min' else max)(
+            values, key=(azquery.parse_date if is_date else None)
+        )
+
+    def range_facet(self, keys, definition, offset=0):
+        """Counts the documents in each bucket of a range facet.
+
+        Date gaps are added in the time zone of ``offset`` (in minutes),
+        as SOLR does with ``TZ``.
+        """
+        field = definition['field']
+        gap = definition['gap']
+        start = definition['start']
+        end = definition['end']
+        is_date = isinstance(gap, str)
+        shift = timedelta(minutes=offset)
+        if is_date:
+            start = azquery.parse_date(start) + shift
+            end = azquery.parse_date(end) + shift
+        bounds = []
+        bound = start
+        while bound < end:
+            bounds.append(bound)
+            if is_date:
+                bound = azquery.add_date_gap(bound, gap)
+            else:
+                bound += gap
+        counts = Counter()
+        for key in keys:
+            values = set(as_list(self.reader.value(field, key)))
+            if is_date:
+                values = [azquery.parse_date(v) + shift for v in values]
+            counts.update(set(
+                bisect_right(bounds, value) - 1
+                for value in values if start <= value < end
+            ))
+        return {
+            'buckets': [
+                {
+                    'val': (
+                        (bound - shift).strftime(azquery.DATE_FORMAT)
+                        if is_date else bound
+                    ),
+                    'count': counts[position]
+                }
+                for position, bound in enumerate(bounds)
+                if counts[position] >= definition.get('mincount', 0)
+            ]
+        }
+
+    def facet(self, keys, definition, offset=0):
+        if isinstance(definition, str):
+            return self.aggregate(keys, definition)
+        if 'range' in definition:
+            return self.range_facet(keys, definition['range'], offset)
+        if 'query' in definition:
+            query = definition['query']
+            keys = self.facet_query(keys, query['q'])
+            result = {'count': len(keys)}
+            for name, sub_facet in query.get('facet', {}).items():
+                result[name] = self.facet(keys, sub_facet)
+            return result
+        terms = definition['terms']
+        field = terms['field']
+        self.field_type(field)
+        counts = Counter()
+        for key in keys:
+            counts.update(set(as_list(self.reader.value(field, key))))
+        sort = terms.get('sort', 'count desc').split()
+        if sort[0] == 'index':
+            buckets = sorted(counts.items(), reverse=(sort[-1] == 'desc'))
+        elif sort[-1] == 'asc':
+            buckets = sorted(
+                counts.items(), key=lambda item: (item[1], item[0])
+            )
+        else:
+            buckets = sorted(
+                counts.items(), key=lambda item: (-item[1], item[0])
+            )
+        limit = terms.get('limit', DEFAULT_FACET_LIMIT)
+        if limit >= 0:
+            buckets = buckets[:limit]
+        return {
+            'buckets': [
+                {'val': value, 'count': count} for value, count in buckets
+            ]
+        }
+
+    def _sort_value(self, field, descending, scores):
+        """Returns the function computing the sort value of a clause."""
+        if field == 'search.score()':
+            if descending:
+                return lambda key: -scores[key]
+            return lambda key: scores[key]
+        self.field_type(field)
+        value_of = self.reader.value
+
+        def sort_value(key):
+            value = value_of(field, key)
+            if isinstance(value, list):
+                value = value[0] if value else None
+            # Missing values always go last
+            if value is None:
+                return (1,)
+            return (0, Descending(value) if descending else value)
+        return sort_value
+
+    def sort(self, keys, scores, order_by, count=None):
+        """Sorts keys by score, or by the ``$orderby`` clauses.
+
+        Only the first ``count`` keys are returned, and sorted, if given.
+        Ties are broken by key, as SOLR does with its unique key.
+        """
+        specs = [spec.split() for spec in order_by or [] if spec.strip()]
+        if not specs:
+            specs = [['search.score()', 'desc']]
+        values = [
+            self._sort_value(
+                spec[0], len(spec) > 1 and spec[1].lower() == 'desc', scores
+            )
+            for spec in specs
+        ]
+        if len(values) == 1:
+            value = values[0]
+
+            def sort_key(key):
+                return (value(key), key)
+        else:
+            def sort_key(key):
+                return tuple(value(key) for value in values) + (key,)
+        if count is None:
+            return sorted(keys, key=sort_key)
+        return heapq.nsmallest(count, keys, key=sort_key)
+
+    def project(self, key, score, select):
+        document = self.reader.document(key)
+        fields = [f for f in (select or self.retrievable) if f != '*']
+        if select and '*' in select:
+            fields = self.retrievable
+        result = {
+            field: document[field] for field in fields
+            if field in document and field in self.retrievable
+        }
+        result['score'] = score
+        return result
+
+    def get(self, key, select=None):
+        if self.reader.document(key) is None:
+            return None
+        document = self.project(key, None, select)
+        del document['score']
+        return document
+
+    def _prefix_keys(self, field, prefix):
+        keys = set()
+        for term in self.reader.prefix_terms(field, prefix):
+            keys.update(self.reader.get_postings(field, term))
+        return keys
+
+    def suggest(self, params):
+        """Returns the documents with words starting with the searched ones.
+        """
+        matched = set()
+        for field in params['fields']:
+            if field not in self.searchable:
+                continue
+            keys = self._prefix_keys(field, params['tokens'][0])
+            for token in params['tokens'][1:]:
+                keys &= self._prefix_keys(field, token)
+            matched |= keys
+        if params.get('odata_filter'):
+            matched &= self.filter(azquery.odata_filter(params['odata_filter']))
+        # As SOLR, which only returns stored fields
+        select = (
+            [params['key']] + params['fields'] + (params['select'] or [])
+        )
+        documents = []
+        for key in heapq.nsmallest(params['limit'], matched):
+            document = self.project(key, None, select)
+            del document['score']
+            documents.append(document)
+        return documents
+
+    def autocomplete(self, params):
+        """Returns the most frequent terms starting with a prefix."""
+        keys = None
+        if params.get('odata_filter'):
+            keys = self.filter(azquery.odata_filter(params['odata_filter']))
+        counts = Counter()
+        for field in params['fields']:
+            if field not in self.searchable:
+                continue
+            for term in self.reader.prefix_terms(field, params['prefix']):
+                postings = self.reader.get_postings(field, term)
+                if keys is not None:
+                    postings = keys.intersection(postings)
+                if postings:
+                    counts[term] += len(postings)
+        return sorted(
+            counts.items(), key=lambda item: (-item[1], item[0])
+        )[:params['limit']]
+
+    def search(self, params):
+        """Runs a search, returning a SOLR-shaped result."""
+        start = time.perf_counter()
+        scores = self.search_text(
+            params['query'], params['fields'], params['mode']
+        )
+        keys = scores.keys()
+        if params.get('odata_filter'):
+            keys = keys & self.filter(azquery.odata_filter(params['odata_filter']))
+        result = {
+            'response': {
+                'numFound': len(keys),
+                'start': params['skip'],
+                'docs': []
+            }
+        }
+        if params['facets']:
+            result['facets'] = {'count': len(keys)}
+            for name, definition in params['facets'].items():
+                result['facets'][name] = self.facet(keys, definition)
+            if params.get('intervals'):
+                # Range facets need the bounds found by the first pass
+                groups = azquery.interval_facets(
+                    params['intervals'], result['facets']
+                )
+                for offset, facets in groups.items():
+                    for name, definition in facets.items():
+                        result['facets'][name] = self.facet(
+                            keys, definition, offset
+                        )
+        ordered = self.sort(
+            keys, scores, params['order_by'],
+            params['skip'] + params['limit']
+        )
+        page = ordered[params['skip']:]
+        result['response']['docs'] = [
+            self.project(key, scores[key], params['select'])
+            for key in page
+        ]
+        result['responseHeader'] = {
+            'status': 0,
+            'QTime': int((time.perf_counter() - start) * 1000)
+        }
+        return result
+
+
+class MemoryBackend(Backend):
+    """Keeps the indexes in memory, in the emulator process."""
+
+    supports_workers = False
+
+    def __init__(self):
+        self.indexes = {}
+
+    def get_index(self, index):
+        if index not in self.indexes:
+            raise UnknownIndex('Index {} does not exist'.format(index))
+        return self.indexes[index]
+
+    async def create_indexes(self, indexes):
+        for name, definition in indexes.items():
+            if name not in self.indexes:
+                self.indexes[name] = MemoryIndex(name, definition['schema'])
+
+    async def update_index(self, index, definition):
+        if index in self.indexes:
+            self.indexes[index] = self.indexes[index].with_schema(
+                definition['schema']
+            )
+        else:
+            self.indexes[index] = MemoryIndex(index, definition['schema'])
+
+    async def delete_index(self, index):
+        self.indexes.pop(index, None)
+
+    async def search(self, index, params, debug=False):
+        memory_index = self.get_index(index)
+        return Searcher(memory_index.schema, memory_index).search(params)
+
+    async def get(self, index, key, select=None):
+        memory_index = self.get_index(index)
+        return Searcher(memory_index.schema, memory_index).get(key, select)
+
+    async def count(self, index):
+        return self.get_index(index).count()
+
+    async def suggest(self, index, params):
+        memory_index = self.get_index(index)
+        return Searcher(memory_index.schema, memory_index).suggest(params)
+
+    async def autocomplete(self, index, params):
+        memory_index = self.get_index(index)
+        return Searcher(memory_index.schema, memory_index).autocomplete(
+            params
+        )
+
+    async def index(self, index, inserts, deletes, index_primary,
+                    commit_within=None):
+        memory_index = self.get_index(index)
+        statuses = []
+        for update in inserts:
+            statuses.append((
+                update.get(index_primary),
+                memory_index.update(update)
+            ))
+        for key in deletes:
+            memory_index.delete(key)
+            statuses.append((key, None))
+        return statuses
+
+    async def commit(self, index):
+        return True
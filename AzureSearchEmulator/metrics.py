@@ -0,0 +1,229 @@
+"""Prometheus metrics, exposed in the text format on ``/metrics``.
+
+Metrics are only collected if ``AZEMULATOR_METRICS`` is enabled:
+otherwise all the functions in here do nothing.
+"""
+import os
+import time
+from aiohttp import web
+
+
+METRICS_ENABLED = (
+    os.environ.get('AZEMULATOR_METRICS', '').lower() in ('true', 'on', '1')
+)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+UNKNOWN_INDEX = 'unknown'
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+# Only these indexes are used as labels, so that requests
+# for made-up index names cannot add series
+known_indexes = {}
+
+
+def track_indexes(indexes):
+    global known_indexes
+    known_indexes = indexes
+
+
+def index_label(index):
+    return index if index in known_indexes else UNKNOWN_INDEX
+
+
+def escape(value):
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('"', '\\"')
+        .replace('\n', '\\n')
+    )
+
+
+def format_labels(names, values, extra=''):
+    labels = [
+        '{}="{}"'.format(name, escape(value))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        labels.append(extra)
+    return '{{{}}}'.format(','.join(labels)) if labels else ''
+
+
+class Counter(object):
+
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} counter'.format(self.name)
+        ]
+        for labels, value in sorted(self.values.items()):
+            lines.append('{}{} {}'.format(
+                self.name, format_labels(self.labels, labels), value
+            ))
+        return lines
+
+
+class Histogram(object):
+
+    def __init__(self, name, documentation, labels, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value, *labels):
+        if labels not in self.values:
+            self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        counts, _, _ = series = self.values[labels]
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[position] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} histogram'.format(self.name)
+        ]
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    format_labels(
+                        self.labels, labels, 'le="{}"'.format(bound)
+                    ),
+                    cumulative
+                ))
+            lines.append('{}_bucket{} {}'.format(
+                self.name,
+                format_labels(self.labels, labels, 'le="+Inf"'),
+                count
+            ))
+            lines.append('{}_sum{} {}'.format(
+                self.name, format_labels(self.labels, labels), total
+            ))
+            lines.append('{}_count{} {}'.format(
+                self.name, format_labels(self.labels, labels), count
+            ))
+        return lines
+
+
+REQUESTS = Counter(
+    'azsearch_requests_total',
+    'Requests received, by endpoint and index.',
+    ('endpoint', 'index')
+)
+ERRORS = Counter(
+    'azsearch_errors_total',
+    'Requests that failed, by endpoint, index and error type.',
+    ('endpoint', 'index', 'error')
+)
+DOCUMENTS = Counter(
+    'azsearch_indexed_documents_total',
+    'Documents sent for indexing, by index and outcome.',
+    ('index', 'status')
+)
+STAGES = Histogram(
+    'azsearch_stage_duration_seconds',
+    'Time spent in each processing stage, by index.',
+    ('stage', 'index')
+)
+ALL_METRICS = (REQUESTS, ERRORS, DOCUMENTS, STAGES)
+
+
+class Timer(object):
+    """Context manager observing its duration in the stages histogram."""
+
+    def __init__(self, stage, index):
+        self.stage = stage
+        self.index = index
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        STAGES.observe(
+            time.perf_counter() - self.start, self.stage, self.index
+        )
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def timer(stage, index):
+    if not METRICS_ENABLED:
+        return NULL_TIMER
+    return Timer(stage, index_label(index))
+
+
+def count_request(endpoint, index):
+    if METRICS_ENABLED:
+        REQUESTS.inc(endpoint, index_label(index))
+
+
+def count_error(endpoint, index, error):
+    if METRICS_ENABLED:
+        ERRORS.inc(endpoint, index_label(index), error)
+
+
+def count_documents(index, statuses):
+    if METRICS_ENABLED:
+        index = index_label(index)
+        failed = sum(1 for _, error in statuses if error is not None)
+        DOCUMENTS.inc(index, 'failed', amount=failed)
+        DOCUMENTS.inc(index, 'succeeded', amount=len(statuses) - failed)
+
+
+def render_stats(stats):
+    """Renders the numbers of the ``/stats`` endpoint as gauges."""
+    lines = []
+    for section, values in sorted(stats.items()):
+        for key, value in sorted(values.items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = 'azsearch_{}_{}'.format(section, key)
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, value))
+    return lines
+
+
+def make_handler(get_stats):
+    async def handler(request):
+        if not METRICS_ENABLED:
+            raise web.HTTPNotFound()
+        lines = []
+        for metric in ALL_METRICS:
+            lines.extend(metric.render())
+        lines.extend(render_stats(get_stats(request.app)))
+        return web.Response(
+            body=('\n'.join(lines) + '\n').encode('utf-8'),
+            headers={'Content-Type': CONTENT_TYPE}
+        )
+    return handler
@@ -0,0 +1,270 @@
+"""Hand-written OData filter compiler.
+
+It accepts exactly the same language as the pyparsing grammar in
+``azquery.ODataQueryParser`` (which is kept as the reference implementation)
+and emits the same Lucene queries, but without any backtracking
+over the operands: the input is tokenized once and then parsed
+by a recursive-descent parser into a small AST made of tuples.
+Chains of ``and``, ``or`` and ``not`` are parsed in loops, and ``and`` and
+``or`` nodes hold the list of their operands, so that long filters
+do not exhaust the Python stack.
+"""
+import re
+
+
+TOKEN_REGEXP = re.compile(r'([ \t\r\n]+)|([A-Za-z0-9._]+)|(.)', re.DOTALL)
+
+WORD = 'word'
+PUNCT = 'punct'
+
+COMPARISONS = ('eq', 'neq', 'lt', 'lte', 'gt', 'gte')
+
+
+class FilterSyntaxError(Exception):
+    """The filter is not valid OData (or not supported by us).
+
+    Exposes the same location attributes as ``pyparsing.ParseException``.
+    """
+
+    def __init__(self, query, loc):
+        self.query = query
+        self.loc = loc
+
+    @property
+    def lineno(self):
+        return self.query.count('\n', 0, self.loc) + 1
+
+    @property
+    def col(self):
+        return self.loc - self.query.rfind('\n', 0, self.loc)
+
+    @property
+    def line(self):
+        start = self.query.rfind('\n', 0, self.loc) + 1
+        end = self.query.find('\n', self.loc)
+        return self.query[start:] if end < 0 else self.query[start:end]
+
+    def __str__(self):
+        return 'Syntax error at character {}'.format(self.loc)
+
+
+def tokenize(query):
+    """Splits a filter in tokens.
+
+    Every token is a tuple of ``(kind, text, start, ws_before)``,
+    where ``ws_before`` tells if the token was preceded by whitespace.
+    """
+    tokens = []
+    ws_before = False
+    for match in TOKEN_REGEXP.finditer(query):
+        blank, word, punct = match.groups()
+        if blank is not None:
+            ws_before = True
+            continue
+        if word is not None:
+            tokens.append((WORD, word, match.start(), ws_before))
+        else:
+            tokens.append((PUNCT, punct, match.start(), ws_before))
+        ws_before = False
+    return tokens
+
+
+class Parser(object):
+    """Recursive-descent parser producing the filter AST.
+
+    Every rule takes a token position and returns a ``(node, position)``
+    tuple, or ``None`` if the rule does not match there.
+    The rules mirror (and are named after) the ones in
+    ``ODataQueryParser.parser`` and have the same ordered-choice semantics,
+    so trailing unparseable input is ignored just as pyparsing does.
+    Where the grammar is right-recursive (``not``, ``and``, ``or``) the
+    rules loop instead, which gives the same result without the recursion.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.tokens = tokenize(query)
+        self.furthest = 0
+
+    def _fail(self, pos):
+        if pos > self.furthest:
+            self.furthest = pos
+        return None
+
+    def _keyword(self, pos, keyword):
+        if pos < len(self.tokens):
+            kind, text, _, _ = self.tokens[pos]
+            return kind == WORD and text.lower() == keyword
+        return False
+
+    def _punct(self, pos, char):
+        if pos < len(self.tokens):
+            kind, text, _, _ = self.tokens[pos]
+            return kind == PUNCT and text == char
+        return False
+
+    def parse(self):
+        try:
+            result = self.operator_or(0)
+        except RecursionError:
+            # Parenthesis nested too deeply
+            result = None
+        if result is None:
+            if self.furthest < len(self.tokens):
+                loc = self.tokens[self.furthest][2]
+            else:
+                loc = len(self.query)
+            raise FilterSyntaxError(self.query, loc)
+        return result[0]
+
+    def operator_word(self, pos):
+        if pos < len(self.tokens) and self.tokens[pos][0] == WORD:
+            return ('word', self.tokens[pos][1]), pos + 1
+        return self._fail(pos)
+
+    def operator_quotes(self, pos):
+        for quote in ('"', "'"):
+            if not self._punct(pos, quote):
+                continue
+            words = []
+            end = pos + 1
+            while end < len(self.tokens) and self.tokens[end][0] == WORD:
+                words.append(self.tokens[end][1])
+                end += 1
+            if words and self._punct(end, quote):
+                return ('quotes', tuple(words)), end + 1
+            self._fail(end)
+        return self.operator_word(pos)
+
+    def operator_condition(self, pos):
+        left = self.operator_quotes(pos)
+        if left is None:
+            return None
+        left, pos = left
+        if pos >= len(self.tokens) or not self.tokens[pos][3]:
+            return self._fail(pos)
+        kind, operator, _, _ = self.tokens[pos]
+        operator = operator.lower()
+        if kind != WORD or operator not in COMPARISONS:
+            return self._fail(pos)
+        pos += 1
+        if pos >= len(self.tokens) or not self.tokens[pos][3]:
+            return self._fail(pos)
+        right = self.operator_quotes(pos)
+        if right is None:
+            return None
+        return (operator, left, right[0]), right[1]
+
+    def operator_parenthesis(self, pos):
+        if self._punct(pos, '('):
+            items = []
+            end = pos + 1
+            result = self.operator_or(end)
+            while result is not None:
+                items.append(result[0])
+                end = result[1]
+                result = self.operator_or(end)
+            if items and self._punct(end, ')'):
+                return ('parenthesis', tuple(items)), end + 1
+            self._fail(end)
+        return self.operator_condition(pos)
+
+    def operator_not(self, pos):
+        # Every "not" falls back to parsing the rest from its own keyword
+        count = 0
+        while self._keyword(pos + count, 'not'):
+            count += 1
+        for nots in range(count, -1, -1):
+            result = self.operator_parenthesis(pos + nots)
+            if result is not None:
+                node, end = result
+                for _ in range(nots):
+                    node = ('not', node)
+                return node, end
+        return None
+
+    def _implicit_and_allowed(self, pos):
+        # Mirrors ~oneOf("and or"), which is a case-sensitive prefix check
+        if pos >= len(self.tokens):
+            return False
+        return not self.query.startswith(('and', 'or'), self.tokens[pos][2])
+
+    def operator_and(self, pos):
+        left = self.operator_not(pos)
+        if left is None:
+            return None
+        left, pos = left
+        items = [left]
+        while True:
+            right = None
+            if self._keyword(pos, 'and'):
+                right = self.operator_not(pos + 1)
+            if right is None and self._implicit_and_allowed(pos):
+                right = self.operator_not(pos)
+            if right is None:
+                break
+            items.append(right[0])
+            pos = right[1]
+        if len(items) == 1:
+            return left, pos
+        return ('and', tuple(items)), pos
+
+    def operator_or(self, pos):
+        left = self.operator_and(pos)
+        if left is None:
+            return None
+        left, pos = left
+        items = [left]
+        while self._keyword(pos, 'or'):
+            right = self.operator_and(pos + 1)
+            if right is None:
+                break
+            items.append(right[0])
+            pos = right[1]
+        if len(items) == 1:
+            return left, pos
+        return ('or', tuple(items)), pos
+
+
+def to_lucene(node):
+    """Emits the Lucene query for an AST node."""
+    name = node[0]
+    if name in ('and', 'or'):
+        return ' {} '.format(name.upper()).join(
+            to_lucene(i) for i in node[1]
+        )
+    if name == 'not':
+        nots = 0
+        while node[0] == 'not':
+            nots += 1
+            node = node[1]
+        return 'NOT ' * nots + to_lucene(node)
+    if name == 'parenthesis':
+        return '({})'.format(''.join(to_lucene(i) for i in node[1]))
+    if name == 'word':
+        return node[1]
+    if name == 'quotes':
+        return '"{}"'.format(''.join(node[1]))
+    field = to_lucene(node[1])
+    value = to_lucene(node[2])
+    if name == 'gt':
+        return '{}:{{{} TO *]'.format(field, value)
+    if name == 'gte':
+        return '{}:[{} TO *]'.format(field, value)
+    if name == 'lt':
+        return '{}:[* TO {}}}'.format(field, value)
+    if name == 'lte':
+        return '{}:[* TO {}]'.format(field, value)
+    if name == 'neq':
+        return 'NOT {}:{}'.format(field, value)
+    return '{}:{}'.format(field, value)
+
+
+def parse(query):
+    """Parses an OData filter into its AST."""
+    return Parser(query).parse()
+
+
+def translate(query):
+    """Translates an OData filter into a Lucene query."""
+    return to_lucene(parse(query))
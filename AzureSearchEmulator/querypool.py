@@ -0,0 +1,126 @@
+import os
+import time
+import asyncio
+import multiprocessing
+from logging import getLogger
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multidict import MultiDict
+from . import azquery
+
+
+QUERY_POOL_SIZE = int(os.environ.get('AZEMULATOR_QUERY_POOL_SIZE', '0'))
+QUERY_POOL_KIND = os.environ.get('AZEMULATOR_QUERY_POOL_KIND', 'process')
+QUERY_POOL_THRESHOLD = int(
+    os.environ.get('AZEMULATOR_QUERY_POOL_THRESHOLD', '1000')
+)
+QUERY_POOL_QUEUE = int(os.environ.get('AZEMULATOR_QUERY_POOL_QUEUE', '64'))
+
+logger = getLogger(__name__)
+
+
+class QueryPoolFull(Exception):
+    """Too many queries are already waiting to be parsed."""
+
+
+def start_method():
+    # Forking a process running the event loop and its threads
+    # could copy locks that are held
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return 'forkserver'
+    return 'spawn'
+
+
+def warm_up():
+    return os.getpid()
+
+
+def complexity(raw_parameters, is_post):
+    return len(raw_parameters.get('filter' if is_post else '$filter') or '')
+
+
+class QueryPool(object):
+    """Parses the most complex queries out of the event loop.
+
+    Queries whose ``$filter`` is longer than ``threshold`` characters
+    are parsed in a pool of ``size`` processes (or threads),
+    so that they cannot stall the other requests. At most ``queue``
+    of them can be pending, after which ``QueryPoolFull`` is raised.
+    A pool with size 0 is disabled and parses everything inline.
+    """
+
+    def __init__(self, size=QUERY_POOL_SIZE, kind=QUERY_POOL_KIND,
+                 threshold=QUERY_POOL_THRESHOLD, queue=QUERY_POOL_QUEUE):
+        self.size = size
+        self.kind = kind
+        self.threshold = threshold
+        self.queue = queue
+        self.executor = None
+        self.pending = 0
+        self.inline = 0
+        self.offloaded = 0
+        self.rejected = 0
+        self.offloaded_time = 0.0
+
+    async def start(self, app):
+        if self.size <= 0:
+            return
+        if self.kind == 'thread':
+            self.executor = ThreadPoolExecutor(self.size)
+        else:
+            self.executor = ProcessPoolExecutor(
+                self.size,
+                mp_context=multiprocessing.get_context(start_method())
+            )
+            # Processes are otherwise started by the first queries
+            loop = asyncio.get_event_loop()
+            await asyncio.gather(*[
+                loop.run_in_executor(self.executor, warm_up)
+                for _ in range(self.size)
+            ])
+        logger.info('Parsing complex queries in {} {}(s)'.format(
+            self.size, self.kind
+        ))
+
+    async def stop(self, app):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    async def parse(self, raw_parameters, is_post):
+        if (
+            self.executor is None or
+            complexity(raw_parameters, is_post) < self.threshold
+        ):
+            self.inline += 1
+            return azquery.parse(raw_parameters, is_post)
+        if self.pending >= self.queue:
+            self.rejected += 1
+            raise QueryPoolFull(
+                '{} queries are already being parsed'.format(self.pending)
+            )
+        if not is_post:
+            # Request query strings are proxies, which cannot be pickled
+            raw_parameters = MultiDict(raw_parameters)
+        self.pending += 1
+        start = time.monotonic()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                self.executor, azquery.parse, raw_parameters, is_post
+            )
+        finally:
+            self.pending -= 1
+            self.offloaded += 1
+            self.offloaded_time += time.monotonic() - start
+
+    def stats(self):
+        return {
+            'enabled': self.executor is not None,
+            'kind': self.kind,
+            'size': self.size,
+            'threshold': self.threshold,
+            'queue': self.queue,
+            'pending': self.pending,
+            'inline': self.inline,
+            'offloaded': self.offloaded,
+            'rejected': self.rejected,
+            'offloaded_time': self.offloaded_time
+        }
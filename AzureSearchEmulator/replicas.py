@@ -0,0 +1,277 @@
+"""Spreads reads on several SOLR replicas.
+
+Writes always go to the leader (``SOLR_URL``), which also serves reads:
+the other replicas are expected to replicate it, e.g. with the SOLR
+replication handler, since indexes are only created on the leader.
+
+Each read goes to the available replica with the least outstanding
+requests. Replicas are checked periodically, and taken out of rotation
+for a while after too many consecutive failures (circuit breaker).
+Reads slower than a percentile of the recent latencies can be hedged,
+sending the same query to a second replica and keeping the first answer.
+"""
+import os
+import time
+import random
+import asyncio
+from collections import deque
+from logging import getLogger
+from urllib.parse import urljoin
+from aiohttp import ClientError, ClientTimeout
+from .solr import SOLR_URL, SolrError
+
+
+REPLICAS = [
+    url.strip() for url in
+    os.environ.get('AZEMULATOR_SOLR_REPLICAS', '').split(',')
+    if url.strip()
+]
+HEALTH_INTERVAL = float(
+    os.environ.get('AZEMULATOR_SOLR_HEALTH_INTERVAL', '5')
+)
+HEALTH_TIMEOUT = float(os.environ.get('AZEMULATOR_SOLR_HEALTH_TIMEOUT', '2'))
+BREAKER_FAILURES = int(
+    os.environ.get('AZEMULATOR_SOLR_BREAKER_FAILURES', '5')
+)
+BREAKER_COOLDOWN = float(
+    os.environ.get('AZEMULATOR_SOLR_BREAKER_COOLDOWN', '30')
+)
+# 0 disables hedged reads
+HEDGE_PERCENTILE = float(
+    os.environ.get('AZEMULATOR_SOLR_HEDGE_PERCENTILE', '0')
+)
+HEDGE_MIN_SAMPLES = 20
+LATENCY_SAMPLES = 1000
+logger = getLogger(__name__)
+
+
+def with_slash(url):
+    return url if url.endswith('/') else url + '/'
+
+
+def is_node_failure(error):
+    """Whether an error means the replica, not the request, is broken."""
+    if isinstance(error, SolrError):
+        return error.status is None or error.status >= 500
+    return isinstance(error, (ClientError, asyncio.TimeoutError))
+
+
+class Replica(object):
+
+    def __init__(self, url):
+        self.url = with_slash(url)
+        self.healthy = True
+        self.outstanding = 0
+        self.failures = 0
+        self.open_until = 0
+        self.requests = 0
+        self.errors = 0
+
+    def is_open(self, now):
+        """Whether the circuit breaker keeps the replica out of rotation."""
+        return self.failures >= BREAKER_FAILURES and now < self.open_until
+
+    def available(self, now):
+        return self.healthy and not self.is_open(now)
+
+    def acquired(self, now):
+        self.outstanding += 1
+        self.requests += 1
+        if self.failures >= BREAKER_FAILURES:
+            # Half open: only this request tries it, until it answers
+            self.open_until = now + BREAKER_COOLDOWN
+
+    def succeeded(self):
+        if self.failures >= BREAKER_FAILURES:
+            logger.info('Replica {} is back in rotation'.format(self.url))
+        self.failures = 0
+
+    def failed(self):
+        self.errors += 1
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURES:
+            if self.failures == BREAKER_FAILURES:
+                logger.warning(
+                    'Replica {} failed {} times, out of rotation'.format(
+                        self.url, self.failures
+                    )
+                )
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+
+    def stats(self, now):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'open': self.is_open(now),
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'errors': self.errors
+        }
+
+
+class ReplicaSet(object):
+
+    def __init__(self, leader=SOLR_URL, replicas=REPLICAS,
+                 hedge_percentile=HEDGE_PERCENTILE):
+        self.leader = Replica(leader)
+        self.replicas = [self.leader] + [
+            Replica(url) for url in replicas
+            if with_slash(url) != self.leader.url
+        ]
+        self.hedge_percentile = hedge_percentile
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.samples = 0
+        self.hedge_delay = None
+        self.hedged = 0
+        self.failovers = 0
+        self.checker = None
+
+    def start(self, session):
+        if len(self.replicas) > 1:
+            self.checker = asyncio.ensure_future(self.check(session))
+
+    async def stop(self):
+        if self.checker is not None:
+            self.checker.cancel()
+            await asyncio.wait([self.checker])
+
+    async def check(self, session):
+        """Checks every replica periodically."""
+        while True:
+            await asyncio.gather(*(
+                self.check_replica(session, replica)
+                for replica in self.replicas
+            ))
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def check_replica(self, session, replica):
+        url = urljoin(replica.url, 'admin/info/system')
+        try:
+            async with session.get(
+                url,
+                params={'wt': 'json'},
+                timeout=ClientTimeout(total=HEALTH_TIMEOUT)
+            ) as resp:
+                healthy = resp.status == 200
+        except (ClientError, asyncio.TimeoutError):
+            healthy = False
+        if healthy != replica.healthy:
+            logger.warning('Replica {} is now {}'.format(
+                replica.url, 'healthy' if healthy else 'unhealthy'
+            ))
+        replica.healthy = healthy
+
+    def pick(self, exclude=()):
+        """Returns the replica with the least outstanding requests.
+
+        When none is available, replicas are tried anyway: failing
+        is no better than trying one which may have recovered.
+        """
+        now = time.monotonic()
+        candidates = [r for r in self.replicas if r not in exclude]
+        available = [r for r in candidates if r.available(now)]
+        candidates = available or candidates
+        if not candidates:
+            return None
+        least = min(r.outstanding for r in candidates)
+        replica = random.choice(
+            [r for r in candidates if r.outstanding == least]
+        )
+        replica.acquired(now)
+        return replica
+
+    def record_latency(self, latency):
+        self.latencies.append(latency)
+        self.samples += 1
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return
+        # Sorting on every read would cost more than the reads
+        if self.hedge_delay is None or self.samples % 50 == 0:
+            ordered = sorted(self.latencies)
+            position = int(len(ordered) * self.hedge_percentile / 100)
+            self.hedge_delay = ordered[min(position, len(ordered) - 1)]
+
+    async def call(self, replica, function):
+        start = time.monotonic()
+        try:
+            result = await function(replica.url)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if is_node_failure(e):
+                replica.failed()
+            else:
+                replica.succeeded()
+            raise
+        finally:
+            replica.outstanding -= 1
+        replica.succeeded()
+        self.record_latency(time.monotonic() - start)
+        return result
+
+    async def read(self, function):
+        """Calls ``function(solr_url)`` on the best replica.
+
+        It is called again on other replicas when a replica fails,
+        or when it is too slow and hedging is enabled.
+        """
+        tried = []
+        pending = set()
+        hedged = False
+        error = None
+        try:
+            while True:
+                if not pending:
+                    replica = self.pick(exclude=tried)
+                    if replica is None:
+                        raise error
+                    if tried:
+                        self.failovers += 1
+                    tried.append(replica)
+                    pending.add(asyncio.ensure_future(
+                        self.call(replica, function)
+                    ))
+                timeout = None
+                if self.hedge_percentile and not hedged:
+                    timeout = self.hedge_delay
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    hedged = True
+                    replica = self.pick(exclude=tried)
+                    if replica is not None:
+                        self.hedged += 1
+                        tried.append(replica)
+                        pending.add(asyncio.ensure_future(
+                            self.call(replica, function)
+                        ))
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                    if not is_node_failure(error):
+                        raise error
+        finally:
+            # Also when the caller is cancelled, e.g. on a disconnection
+            for task in pending:
+                task.cancel()
+
+    async def write(self, function):
+        """Calls ``function(solr_url)`` on the leader."""
+        self.leader.acquired(time.monotonic())
+        return await self.call(self.leader, function)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'replicas': len(self.replicas),
+            'available': sum(1 for r in self.replicas if r.available(now)),
+            'hedged': self.hedged,
+            'failovers': self.failovers,
+            'hedge_delay': self.hedge_delay,
+            'nodes': [r.stats(now) for r in self.replicas]
+        }
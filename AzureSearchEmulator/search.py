@@ -1,12 +1,77 @@
+import time
 import traceback
 from aiohttp import web
-from . import solr
 from . import azquery
 from . import azresponse
+from . import metrics
+from .jsonbackend import json_response
+from .querypool import QueryPoolFull
+from .backend import UnknownIndex
+
+
+DEBUG_HEADER = 'X-AzEmulator-Debug'
+
+
+def debug_options(request):
+    """Returns the debug options requested with the debug header.
+
+    ``timing`` adds a timing breakdown to the response,
+    ``solr`` also adds the Lucene query and the SOLR debug output.
+    """
+    header = request.headers.get(DEBUG_HEADER)
+    if not header:
+        return set()
+    return set(option.strip().lower() for option in header.split(','))
+
+
+def debug_section(debug, parameters, result, timings):
+    qtime = result.get('responseHeader', {}).get('QTime')
+    timing = {
+        'parse': timings['parse'],
+        'solr': timings['solr'],
+        'format': timings['format']
+    }
+    if qtime is not None:
+        timing['solr_qtime'] = qtime
+        timing['solr_network'] = round(timings['solr'] - qtime, 3)
+    section = {'timing': timing}
+    if 'solr' in debug:
+        section['query'] = parameters['query']
+        section['filter'] = parameters['filter_query']
+        section['solr'] = result.get('debug')
+    return section
+
+
+def elapsed(start):
+    """Milliseconds elapsed since ``start``."""
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+async def cached_search(request, index, parameters):
+    cache = request.app['search_cache']
+    cache_key = cache.key(index, parameters)
+    result = cache.get(cache_key)
+    if result is None:
+        async def fetch():
+            with metrics.timer('solr', index):
+                result = await request.app['backend'].search(
+                    index,
+                    parameters
+                )
+            cache.put(cache_key, result)
+            return result
+        result = await request.app['search_flights'].do(cache_key, fetch)
+    return result
 
 
 async def search(request):
     index = request.match_info['index']
+    metrics.count_request('search', index)
+    with metrics.timer('request', index):
+        return await _search(request, index)
+
+
+async def _search(request, index):
     try:
         if request.method == "POST":
             request_data = await request.json()
@@ -15,17 +80,45 @@ async def search(request):
         else:
             is_post = False
             raw_parameters = request.query
-        parameters = azquery.parse(raw_parameters, is_post)
-        result = await solr.search(index, parameters)
-        return web.json_response(
-            azresponse.format(
+        debug = debug_options(request)
+        timings = {}
+        start = time.perf_counter()
+        with metrics.timer('parse', index):
+            parameters = await request.app['query_pool'].parse(
+                raw_parameters,
+                is_post
+            )
+        timings['parse'] = elapsed(start)
+        start = time.perf_counter()
+        if debug:
+            # Never shared nor cached, so that timings are meaningful
+            with metrics.timer('solr', index):
+                result = await request.app['backend'].search(
+                    index,
+                    parameters,
+                    debug=('solr' in debug)
+                )
+        else:
+            result = await cached_search(request, index, parameters)
+        timings['solr'] = elapsed(start)
+        start = time.perf_counter()
+        with metrics.timer('format', index):
+            response = azresponse.format(
                 request,
                 result,
                 raw_parameters,
                 is_post
             )
-        )
+            timings['format'] = elapsed(start)
+            if debug:
+                response['@emulator.debug'] = debug_section(
+                    debug, parameters, result, timings
+                )
+            return json_response(response)
+    except UnknownIndex:
+        raise web.HTTPNotFound()
     except NotImplementedError as e:
+        metrics.count_error('search', index, 'unsupported_param')
         return web.json_response(
             {
                 'error': 'unsupported_param',
@@ -37,6 +130,7 @@ async def search(request):
             status=400
         )
     except azquery.ODataParseFailure as e:
+        metrics.count_error('search', index, 'odata_parse_fail')
         return web.json_response(
             {
                 'error': 'odata_parse_fail',
@@ -47,7 +141,20 @@ async def search(request):
             },
             status=400
         )
+    except QueryPoolFull as e:
+        metrics.count_error('search', index, 'overloaded')
+        return web.json_response(
+            {
+                'error': 'overloaded',
+                'message': (
+                    'Too many complex queries are being parsed'
+                ),
+                'detail': str(e)
+            },
+            status=503
+        )
     except ValueError as e:
+        metrics.count_error('search', index, 'parse_fail')
         return web.json_response(
             {
                 'error': 'parse_fail',
@@ -60,6 +167,7 @@ async def search(request):
             status=400
         )
     except Exception as e:
+        metrics.count_error('search', index, 'failure')
         return web.json_response(
             {
                 'error': 'failure',
@@ -1,15 +1,43 @@
 import os
-import json
+import time
+import asyncio
 from logging import getLogger
 from urllib.parse import urljoin
-from aiohttp import ClientSession
-from aiohttp.client_exceptions import ClientResponseError
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from aiohttp.client_exceptions import ClientError, ClientResponseError
+from . import azquery
+from . import jsonbackend
 
 
 logger = getLogger(__name__)
 
 
 SOLR_URL = os.environ.get('SOLR_URL', 'http://solr:8983/solr/')
+# In SolrCloud mode indexes are collections, created with the Collections API
+SOLR_CLOUD = (
+    os.environ.get('AZEMULATOR_SOLR_CLOUD', 'false').lower()
+    in ('true', 'on', '1')
+)
+POOL_SIZE = int(os.environ.get('AZEMULATOR_SOLR_POOL_SIZE', '100'))
+POOL_SIZE_PER_HOST = int(
+    os.environ.get('AZEMULATOR_SOLR_POOL_SIZE_PER_HOST', '0')
+)
+KEEPALIVE_TIMEOUT = float(
+    os.environ.get('AZEMULATOR_SOLR_KEEPALIVE_TIMEOUT', '30')
+)
+CONNECT_TIMEOUT = float(
+    os.environ.get('AZEMULATOR_SOLR_CONNECT_TIMEOUT', '10')
+)
+REQUEST_TIMEOUT = float(
+    os.environ.get('AZEMULATOR_SOLR_REQUEST_TIMEOUT', '300')
+)
+DNS_CACHE_TTL = int(os.environ.get('AZEMULATOR_SOLR_DNS_CACHE_TTL', '300'))
+INDEX_CHUNK_SIZE = int(os.environ.get('AZEMULATOR_INDEX_CHUNK_SIZE', '100'))
+INDEX_CONCURRENCY = int(os.environ.get('AZEMULATOR_INDEX_CONCURRENCY', '4'))
+CURSOR_PAGING = (
+    os.environ.get('AZEMULATOR_CURSOR_PAGING', 'true').lower()
+    in ('true', 'on', '1')
+)
 
 
 class SolrError(Exception):
@@ -18,17 +46,46 @@ class SolrError(Exception):
     He doesn't like what we asked him.
     """
 
-    def __init__(self, reason, response):
+    def __init__(self, reason, response, status=None):
         self.reason = reason
         self.response = response
+        self.status = status
 
     def __str__(self):
         return '{}: {}'.format(self.reason, self.response)
 
 
-async def search(index, params):
-    endpoint_url = urljoin(SOLR_URL, '{}/query'.format(index))
-    logger.debug('Contacting endpoint {}'.format(endpoint_url))
+def create_session():
+    """Creates the pooled HTTP session used to talk to SOLR.
+
+    Connections are kept alive and reused across requests,
+    so it should be created once and shared for the whole application.
+    """
+    connector = TCPConnector(
+        limit=POOL_SIZE,
+        limit_per_host=POOL_SIZE_PER_HOST,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        use_dns_cache=True,
+        ttl_dns_cache=DNS_CACHE_TTL
+    )
+    timeout = ClientTimeout(
+        total=REQUEST_TIMEOUT,
+        connect=CONNECT_TIMEOUT
+    )
+    return ClientSession(
+        connector=connector,
+        timeout=timeout,
+        json_serialize=jsonbackend.dumps
+    )
+
+
+def suggest_field(field):
+    """The edge n-gram field a suggester source field is copied to."""
+    return '{}_suggest'.format(field)
+
+
+async def search(session, index, params, debug=False,
+                 solr_url=SOLR_URL):
     solr_query = {
         'query': params['query'],
         'params': {
@@ -45,9 +102,18 @@ async def search(index, params):
         solr_query['fields'].append('score')
     else:
         solr_query['fields'] = ['*', 'score']
-    if params['order_by']:
+    if CURSOR_PAGING:
+        # Sorting on the unique key too makes the order stable,
+        # as cursors require
+        sort = list(params['order_by'] or ['score desc'])
+        if not any(s.split()[0] == 'id' for s in sort if s.strip()):
+            sort.append('id asc')
+        solr_query['sort'] = ', '.join(sort)
+    elif params['order_by']:
         solr_query['sort'] = params['order_by']
-    if params['skip']:
+    if CURSOR_PAGING and params.get('cursor') is not None:
+        solr_query['params']['cursorMark'] = params['cursor']
+    elif params['skip']:
         solr_query['offset'] = params['skip']
     if params['limit']:
         solr_query['limit'] = params['limit']
@@ -55,57 +121,327 @@ async def search(index, params):
         solr_query['filter'] = params['filter_query']
     if params['facets']:
         solr_query['facet'] = params['facets']
-    async with ClientSession() as session:
-        async with session.post(endpoint_url, json=solr_query) as resp:
-            try:
-                response_payload = await resp.text()
-                resp.raise_for_status()
-                return json.loads(response_payload)
-            except ClientResponseError:
-                logger.debug(await resp.text())
+    if debug:
+        solr_query['params']['debugQuery'] = 'true'
+    result = await query(session, index, solr_query, solr_url)
+    if params.get('intervals'):
+        await interval_facets(
+            session, index, solr_query, params['intervals'], result, solr_url
+        )
+    return result
+
+
+async def interval_facets(session, index, solr_query, intervals, result,
+                          solr_url=SOLR_URL):
+    """Adds the range facets of ``interval`` facets to a search result.
+
+    SOLR range facets need literal ``start`` and ``end`` bounds, and no
+    facet type groups values by interval: bounds that are not those of
+    the matching documents would make SOLR count every empty bucket in
+    between, and a terms facet returns every distinct value. So the
+    bounds come from the search itself, and a second query matching the
+    same documents only counts the range facets.
+    """
+    groups = azquery.interval_facets(intervals, result['facets'])
+    facet_query = {
+        k: v for k, v in solr_query.items()
+        if k in ('query', 'filter')
+    }
+    facet_query['limit'] = 0
+    params = {
+        k: v for k, v in solr_query['params'].items()
+        if k not in ('cursorMark', 'debugQuery')
+    }
+    queries = []
+    for offset, facets in sorted(groups.items()):
+        queries.append(query(session, index, dict(
+            facet_query,
+            params=(
+                dict(params, TZ=azquery.timezone(offset)) if offset
+                else params
+            ),
+            facet=facets
+        ), solr_url))
+    for response in await asyncio.gather(*queries):
+        result['facets'].update(
+            (k, v) for k, v in response['facets'].items() if k != 'count'
+        )
+
+
+async def query(session, index, solr_query, solr_url=SOLR_URL):
+    """Sends a query with the JSON Request API, returning the response."""
+    endpoint_url = urljoin(solr_url, '{}/query'.format(index))
+    logger.debug('Contacting endpoint {}'.format(endpoint_url))
+    async with session.post(endpoint_url, json=solr_query) as resp:
+        try:
+            response_payload = await resp.read()
+            resp.raise_for_status()
+            return jsonbackend.loads(response_payload)
+        except ClientResponseError:
+            logger.debug(response_payload)
+            raise SolrError(
+                "SOLR returned an error",
+                response_payload.decode('utf-8', 'replace'),
+                resp.status
+            )
+        except ValueError as e:
+            raise SolrError(
+                "Cannot decode JSON from SOLR",
+                response_payload.decode('utf-8', 'replace')
+            )
+
+
+async def get(session, index, key, select=None, solr_url=SOLR_URL):
+    """Fetches a document with the real-time get handler.
+
+    It also sees documents that have not been committed yet.
+    """
+    endpoint_url = urljoin(solr_url, '{}/get'.format(index))
+    query_params = {'id': key, 'wt': 'json'}
+    if select:
+        query_params['fl'] = ','.join(select)
+    async with session.get(endpoint_url, params=query_params) as resp:
+        response_payload = await resp.read()
+        if resp.status != 200:
+            raise SolrError(
+                "SOLR returned an error",
+                response_payload.decode('utf-8', 'replace'),
+                resp.status
+            )
+    document = jsonbackend.loads(response_payload).get('doc')
+    if document is not None:
+        document.pop('_version_', None)
+    return document
+
+
+async def count(session, index, solr_url=SOLR_URL):
+    result = await query(
+        session, index, {'query': '*:*', 'limit': 0}, solr_url
+    )
+    return result['response']['numFound']
+
+
+async def suggest(session, index, params, solr_url=SOLR_URL):
+    """Returns the documents with words starting with the searched ones."""
+    terms = ' '.join(params['tokens'])
+    solr_query = {
+        'query': ' OR '.join(
+            '{}:({})'.format(suggest_field(field), terms)
+            for field in params['fields']
+        ),
+        'params': {'q.op': 'AND'},
+        'fields': sorted(set(
+            [params['key']] + params['fields'] + (params['select'] or [])
+        )),
+        'limit': params['limit']
+    }
+    if params['filter_query']:
+        solr_query['filter'] = params['filter_query']
+    result = await query(session, index, solr_query, solr_url)
+    return result['response']['docs']
+
+
+def term_counts(terms):
+    """Reads terms and counts, either as a map or a flat list."""
+    if isinstance(terms, dict):
+        return list(terms.items())
+    return list(zip(terms[::2], terms[1::2]))
+
+
+async def autocomplete(session, index, params,
+                       solr_url=SOLR_URL):
+    """Returns the most frequent terms starting with a prefix.
+
+    Terms come from the terms component, which seeks the term dictionary,
+    or from terms facets with a prefix when documents must be filtered.
+    """
+    counts = {}
+    if params['filter_query']:
+        result = await query(session, index, {
+            'query': '*:*',
+            'filter': params['filter_query'],
+            'limit': 0,
+            'facet': {
+                field: {
+                    'type': 'terms',
+                    'field': field,
+                    'prefix': params['prefix'],
+                    'limit': params['limit']
+                }
+                for field in params['fields']
+            }
+        }, solr_url)
+        found = [
+            (bucket['val'], bucket['count'])
+            for field in params['fields']
+            for bucket in result.get('facets', {}).get(field, {}).get(
+                'buckets', []
+            )
+        ]
+    else:
+        endpoint_url = urljoin(solr_url, '{}/terms'.format(index))
+        query_params = [('terms.fl', field) for field in params['fields']]
+        query_params.extend([
+            ('terms.prefix', params['prefix']),
+            ('terms.limit', str(params['limit'])),
+            ('wt', 'json')
+        ])
+        if SOLR_CLOUD:
+            # The terms component only reads the local shard by default
+            query_params.append(('distrib', 'true'))
+        async with session.get(endpoint_url, params=query_params) as resp:
+            response_payload = await resp.read()
+            if resp.status != 200:
                 raise SolrError(
                     "SOLR returned an error",
-                    response_payload
-                )
-            except json.decoder.JSONDecodeError as e:
-                raise SolrError(
-                    "Cannot decode JSON from SOLR",
-                    response_payload
+                    response_payload.decode('utf-8', 'replace'),
+                    resp.status
                 )
+            terms = jsonbackend.loads(response_payload).get('terms', {})
+        found = [
+            pair for field in params['fields']
+            for pair in term_counts(terms.get(field, []))
+        ]
+    for term, count in found:
+        counts[term] = counts.get(term, 0) + count
+    return sorted(
+        counts.items(), key=lambda item: (-item[1], item[0])
+    )[:params['limit']]
 
 
-async def index(index, inserts, deletes, index_primary):
-    url = urljoin(SOLR_URL, '{}/update'.format(index))
-    succeeded = []
-    failed = []
-    async with ClientSession() as session:
-        if len(inserts) > 0:
-            logger.debug('Contacting endpoint {}'.format(url))
-            async with session.post(url, json=inserts) as resp:
-                response = await resp.text()
-                logger.debug(response)
-                if resp.status != 200:
-                    logger.critical("Indexing in {} failed".format(index))
-                    failed.extend(i[index_primary] for i in inserts)
-                else:
-                    succeeded.extend(i[index_primary] for i in inserts)
-        if len(deletes) > 0:
-            logger.debug('Contacting endpoint {}'.format(url))
-            delete_payload = {
-                'delete': [i[index_primary] for i in deletes]
-            }
-            async with session.post(url, json=delete_payload) as resp:
-                response = await resp.text()
-                logger.debug(response)
-                if resp.status != 200:
-                    logger.critical("Deletes in {} failed".format(index))
-                    failed.extend(delete_payload['delete'])
-                else:
-                    succeeded.extend(delete_payload['delete'])
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def error_message(response):
+    try:
+        return jsonbackend.loads(response)['error']['msg']
+    except (ValueError, KeyError, TypeError):
+        return "An error occurred during indexing"
+
+
+async def submit(session, url, params, items, keys, make_payload, semaphore):
+    """Posts an update to SOLR, returning a list of ``(key, error)``.
+
+    If SOLR rejects the update (because a document is invalid, or because
+    a merged document does not exist) the items are split in half and retried,
+    until the documents that are actually invalid are found.
+    """
+    async with semaphore:
         logger.debug('Contacting endpoint {}'.format(url))
-        async with session.post(url, json={'commit': {}}) as resp:
-            response = await resp.text()
-            logger.debug(response)
-            if resp.status != 200:
-                logger.critical("Commit in {} failed".format(index))
-    return (succeeded, failed)
+        try:
+            async with session.post(url, json=make_payload(items),
+                                    params=params) as resp:
+                response = await resp.text()
+                status = resp.status
+        except (ClientError, asyncio.TimeoutError) as e:
+            logger.critical("Update to {} failed: {}".format(url, e))
+            return [(key, str(e)) for key in keys]
+    logger.debug(response)
+    if status == 200:
+        return [(key, None) for key in keys]
+    if status in (400, 409) and len(items) > 1:
+        half = len(items) // 2
+        first, second = await asyncio.gather(
+            submit(session, url, params, items[:half], keys[:half],
+                   make_payload, semaphore),
+            submit(session, url, params, items[half:], keys[half:],
+                   make_payload, semaphore)
+        )
+        return first + second
+    logger.critical("Update to {} failed for {}".format(url, keys))
+    return [(key, error_message(response)) for key in keys]
+
+
+def delete_payload(keys):
+    return {'delete': keys}
+
+
+async def index(session, index, inserts, deletes, index_primary,
+                commit_within=None, solr_url=SOLR_URL):
+    """Sends inserts and deletes to SOLR, returning a list of ``(key, error)``.
+
+    Both are split in chunks that are submitted concurrently, so keys
+    must appear only once: see ``index.ordered_segments``.
+    """
+    url = urljoin(solr_url, '{}/update'.format(index))
+    params = {}
+    if commit_within is not None:
+        params['commitWithin'] = str(commit_within)
+    semaphore = asyncio.Semaphore(INDEX_CONCURRENCY)
+    jobs = [
+        submit(session, url, params, chunk,
+               [i[index_primary] for i in chunk], list, semaphore)
+        for chunk in chunked(inserts, INDEX_CHUNK_SIZE)
+    ] + [
+        submit(session, url, params, chunk, chunk,
+               delete_payload, semaphore)
+        for chunk in chunked(deletes, INDEX_CHUNK_SIZE)
+    ]
+    results = await asyncio.gather(*jobs)
+    return [status for result in results for status in result]
+
+
+async def commit(session, index, solr_url=SOLR_URL):
+    url = urljoin(solr_url, '{}/update'.format(index))
+    logger.debug('Contacting endpoint {}'.format(url))
+    async with session.post(url, json={'commit': {}}) as resp:
+        response = await resp.text()
+        logger.debug(response)
+        if resp.status != 200:
+            logger.critical("Commit in {} failed".format(index))
+        return resp.status == 200
+
+
+class Committer(object):
+    """Decides when the writes to an index are committed.
+
+    By default a hard commit is sent after every indexing batch,
+    but concurrent batches share the same commit.
+    If ``commit_within`` (in milliseconds) is set SOLR makes documents
+    visible within that time with soft commits, and a hard commit is only
+    sent every ``hard_commit_interval`` seconds or when explicitly flushed.
+    """
+
+    def __init__(self, index, commit_within=None, hard_commit_interval=60):
+        self.index = index
+        self.commit_within = commit_within
+        self.hard_commit_interval = hard_commit_interval
+        self.dirty = False
+        self.last_commit = time.monotonic()
+        self._pending = None
+        self._running = None
+
+    async def written(self, backend):
+        self.dirty = True
+        if self.commit_within is None:
+            await self.commit(backend)
+
+    def is_due(self):
+        return (
+            self.dirty and
+            self.commit_within is not None and
+            time.monotonic() - self.last_commit >= self.hard_commit_interval
+        )
+
+    def commit(self, backend):
+        """Commits the index, joining a commit that is not yet sent."""
+        if self._pending is None:
+            self._pending = asyncio.ensure_future(self._commit(backend))
+        return asyncio.shield(self._pending)
+
+    async def _commit(self, backend):
+        if self._running is not None:
+            # Writes made while it runs are not covered by it
+            await asyncio.wait([self._running])
+        self._running, self._pending = self._pending, None
+        self.dirty = False
+        self.last_commit = time.monotonic()
+        try:
+            committed = await backend.commit(self.index)
+        except Exception:
+            logger.exception("Commit in {} failed".format(self.index))
+            committed = False
+        if not committed:
+            self.dirty = True
+        return committed
@@ -0,0 +1,95 @@
+"""Suggest and autocomplete endpoints, using the suggesters of the index."""
+import traceback
+from aiohttp import web
+from . import azquery
+from . import azresponse
+from . import metrics
+from .jsonbackend import json_response
+from .tools import primary_keys
+from .backend import UnknownIndex
+
+
+def error_response(kind, index, error, message, detail, status, trace=False):
+    metrics.count_error(kind, index, error)
+    payload = {
+        'error': error,
+        'message': message,
+        'detail': detail
+    }
+    if trace:
+        payload['traceback'] = traceback.format_exc()
+    return web.json_response(payload, status=status)
+
+
+async def parse(request, index):
+    definition = request.app['indexes'].get(index)
+    if definition is None:
+        raise web.HTTPNotFound()
+    if request.method == "POST":
+        raw_parameters = await request.json()
+        is_post = True
+    else:
+        raw_parameters = request.query
+        is_post = False
+    parameters = azquery.parse_suggest(
+        raw_parameters,
+        definition.get('suggesters', []),
+        is_post
+    )
+    parameters['key'] = primary_keys({index: definition})[index]
+    return parameters
+
+
+def make_handler(kind, run, message):
+    async def handler(request):
+        index = request.match_info['index']
+        metrics.count_request(kind, index)
+        with metrics.timer('request', index):
+            try:
+                parameters = await parse(request, index)
+                with metrics.timer('solr', index):
+                    value = await run(
+                        request.app['backend'], index, parameters
+                    )
+                return json_response({'value': value})
+            except UnknownIndex:
+                raise web.HTTPNotFound()
+            except NotImplementedError as e:
+                return error_response(
+                    kind, index, 'unsupported_param',
+                    'The emulator does not currently support this parameter',
+                    str(e), 400
+                )
+            except azquery.ODataParseFailure as e:
+                return error_response(
+                    kind, index, 'odata_parse_fail',
+                    'Error while parsing filter query', str(e), 400
+                )
+            except ValueError as e:
+                return error_response(
+                    kind, index, 'parse_fail',
+                    'Error while parsing query', str(e), 400, trace=True
+                )
+            except web.HTTPException:
+                raise
+            except Exception as e:
+                return error_response(
+                    kind, index, 'failure', message, str(e), 500, trace=True
+                )
+    return handler
+
+
+async def run_suggest(backend, index, parameters):
+    docs = await backend.suggest(index, parameters)
+    return [azresponse.format_suggestion(doc, parameters) for doc in docs]
+
+
+async def run_autocomplete(backend, index, parameters):
+    terms = await backend.autocomplete(index, parameters)
+    return azresponse.format_autocomplete(terms, parameters)
+
+
+suggest = make_handler('suggest', run_suggest, 'Error while suggesting')
+autocomplete = make_handler(
+    'autocomplete', run_autocomplete, 'Error while autocompleting'
+)
@@ -1,11 +1,13 @@
-import asyncio
+import os
 import json
-import aiohttp
-import time
+import asyncio
+from collections import OrderedDict
 from logging import getLogger
 from defusedxml.ElementTree import fromstring
-from aiohttp.client_exceptions import ClientConnectorError
-from .solr import SOLR_URL
+from aiohttp import ClientError
+from .solr import (
+    SOLR_URL, SOLR_CLOUD, SolrError, create_session, suggest_field
+)
 
 
 URL_TEMPLATES = {
@@ -14,9 +16,18 @@ URL_TEMPLATES = {
         '{solr_url}/admin/cores?'
         'action=CREATE&name={index}&'
         'instanceDir=%2Fopt%2Fsolr%2Fserver%2Fsolr%2Fmycores%2F{index}&'
-        'configSet=data_driven_schema_configs'
+        'configSet={configset}'
+    ),
+    'unload': (
+        '{solr_url}/admin/cores?'
+        'action=UNLOAD&core={index}&'
+        'deleteIndex=true&deleteDataDir=true&deleteInstanceDir=true'
     ),
-    'putschema': '{solr_url}/{index}/schema'
+    'collections': '{solr_url}/admin/collections',
+    'putschema': '{solr_url}/{index}/schema',
+    'fields': '{solr_url}/{index}/schema/fields',
+    'copyfields': '{solr_url}/{index}/schema/copyfields',
+    'fieldtypes': '{solr_url}/{index}/schema/fieldtypes'
 }
 
 TYPES = {
@@ -50,7 +61,47 @@ TYPES = {
     }
 }
 
-MAX_RETRIES = 10
+# Suggester source fields are copied in fields of this type, which index
+# every prefix (edge n-gram) of every word, so suggestions are term lookups
+SUGGEST_FIELD_TYPE = {
+    'name': 'text_suggest',
+    'class': 'solr.TextField',
+    'positionIncrementGap': '100',
+    'indexAnalyzer': {
+        'tokenizer': {'class': 'solr.StandardTokenizerFactory'},
+        'filters': [
+            {'class': 'solr.LowerCaseFilterFactory'},
+            {
+                'class': 'solr.EdgeNGramFilterFactory',
+                'minGramSize': '1',
+                'maxGramSize': '25'
+            }
+        ]
+    },
+    'queryAnalyzer': {
+        'tokenizer': {'class': 'solr.StandardTokenizerFactory'},
+        'filters': [{'class': 'solr.LowerCaseFilterFactory'}]
+    }
+}
+
+BOOTSTRAP_TIMEOUT = float(
+    os.environ.get('AZEMULATOR_BOOTSTRAP_TIMEOUT', '120')
+)
+BOOTSTRAP_CONCURRENCY = int(
+    os.environ.get('AZEMULATOR_BOOTSTRAP_CONCURRENCY', '8')
+)
+BACKOFF_INITIAL = 0.1
+BACKOFF_MAX = 5.0
+
+CONFIGSET = os.environ.get(
+    'AZEMULATOR_SOLR_CONFIGSET',
+    '_default' if SOLR_CLOUD else 'data_driven_schema_configs'
+)
+# Defaults for the indexes whose definition has no "cloud" section
+CLOUD_SHARDS = int(os.environ.get('AZEMULATOR_SOLR_SHARDS', '1'))
+CLOUD_REPLICATION_FACTOR = int(
+    os.environ.get('AZEMULATOR_SOLR_REPLICATION_FACTOR', '1')
+)
 
 logger = getLogger(__name__)
 
@@ -73,7 +124,8 @@ async def get_cores_status(client):
 async def create_core(client, name):
     url = URL_TEMPLATES['create'].format(
         solr_url=SOLR_URL.rstrip('/'),
-        index=name
+        index=name,
+        configset=CONFIGSET
     )
     logger.debug('Calling GET {}'.format(url))
     async with client.get(url) as resp:
@@ -81,19 +133,95 @@ async def create_core(client, name):
         return resp.status == 200
 
 
-def schema_to_solrops(schema):
-    ops = {
-        'add-field': []
+async def collections_api(client, params):
+    """Calls the Collections API, returning whether it succeeded."""
+    url = URL_TEMPLATES['collections'].format(solr_url=SOLR_URL.rstrip('/'))
+    params = dict(params, wt='json')
+    logger.debug('Calling GET {} with {}'.format(url, params))
+    async with client.get(url, params=params) as resp:
+        text_resp = await resp.text()
+        logger.debug(text_resp)
+        if resp.status != 200:
+            return None
+        result = json.loads(text_resp)
+        # Some errors are reported with a 200 status
+        if 'failure' in result or 'exception' in result:
+            return None
+        return result
+
+
+async def get_collections(client):
+    result = await collections_api(client, {'action': 'LIST'})
+    if result is None:
+        raise SolrError('Cannot list the collections', None)
+    return set(result.get('collections', []))
+
+
+def collection_options(definition):
+    """Returns the Collections API parameters to create an index.
+
+    They are read from the optional ``cloud`` section of the definition:
+    ``shards``, ``replication_factor`` and ``max_shards_per_node``.
+    Documents are always routed by their key: lookups, merges and deletes
+    only know the key, so they would miss documents routed by another field.
+    """
+    cloud = definition.get('cloud', {})
+    params = {
+        'numShards': str(cloud.get('shards', CLOUD_SHARDS)),
+        'replicationFactor': str(
+            cloud.get('replication_factor', CLOUD_REPLICATION_FACTOR)
+        ),
+        'collection.configName': CONFIGSET
     }
+    if 'router_field' in cloud:
+        raise ValueError(
+            'Cannot route documents by {}, '
+            'they are routed by their key'.format(cloud['router_field'])
+        )
+    if 'max_shards_per_node' in cloud:
+        params['maxShardsPerNode'] = str(cloud['max_shards_per_node'])
+    return params
+
+
+async def create_collection(client, name, definition):
+    params = {'action': 'CREATE', 'name': name}
+    params.update(collection_options(definition))
+    return await collections_api(client, params) is not None
+
+
+async def delete_collection(client, name):
+    params = {'action': 'DELETE', 'name': name}
+    return await collections_api(client, params) is not None
+
+
+async def get_existing_indexes(client):
+    """Returns the names of the cores, or collections, in SOLR."""
+    if SOLR_CLOUD:
+        return await get_collections(client)
+    return await get_cores_status(client)
+
+
+async def create_solr_index(client, name, definition):
+    """Creates the core, or collection, of an index."""
+    if SOLR_CLOUD:
+        return await create_collection(client, name, definition)
+    return await create_core(client, name)
+
+
+async def delete_solr_index(client, name):
+    if SOLR_CLOUD:
+        return await delete_collection(client, name)
+    return await delete_core(client, name)
+
+
+def schema_to_solrops(schema, suggesters=()):
+    ops = OrderedDict()
+    fields = []
+    copy_fields = []
     for field_id, field_def in schema.items():
-        if field_def.get('is_primary', False):
-            if field_id != 'id':
-                ops['add-copy-field'] = {
-                    'source': field_id,
-                    'dest': 'id'
-                }
-            else:
-                continue
+        # The key is sent as id along with the documents
+        if field_id == 'id':
+            continue
         rule = {
             'name': field_id,
             'indexed': True
@@ -103,9 +231,31 @@ def schema_to_solrops(schema):
                 field_def.get('tags', [])
             )
         )
-        if 'retrievable' in field_def['tags']:
-            rule['stored'] = True
-        ops['add-field'].append(rule)
+        # Always sent, so that turning retrievable off is a schema change
+        rule['stored'] = 'retrievable' in field_def['tags']
+        fields.append(rule)
+    sources = sorted(set(
+        field for suggester in suggesters
+        for field in suggester['sourceFields']
+    ))
+    if sources:
+        # The type must be created before the fields using it
+        ops['add-field-type'] = [SUGGEST_FIELD_TYPE]
+        for field_id in sources:
+            fields.append({
+                'name': suggest_field(field_id),
+                'type': SUGGEST_FIELD_TYPE['name'],
+                'indexed': True,
+                'stored': False,
+                'multiValued': True
+            })
+            copy_fields.append({
+                'source': field_id,
+                'dest': suggest_field(field_id)
+            })
+    ops['add-field'] = fields
+    if copy_fields:
+        ops['add-copy-field'] = copy_fields
     return ops
 
 
@@ -120,44 +270,188 @@ async def create_schema(client, index, operations):
         return resp.status == 200
 
 
-async def main(loop, indexes):
-    async with aiohttp.ClientSession(loop=loop) as client:
-        tries = 0
-        while tries < MAX_RETRIES:
-            try:
-                async with client.get(SOLR_URL) as resp:
+async def delete_core(client, name):
+    url = URL_TEMPLATES['unload'].format(
+        solr_url=SOLR_URL.rstrip('/'),
+        index=name
+    )
+    logger.debug('Calling GET {}'.format(url))
+    async with client.get(url) as resp:
+        logger.debug(await resp.text())
+        return resp.status == 200
+
+
+async def get_schema(client, index):
+    """Returns the fields and copy fields of a live SOLR schema."""
+    schema = {}
+    for name, key in (
+        ('fields', 'fields'),
+        ('copyfields', 'copyFields'),
+        ('fieldtypes', 'fieldTypes')
+    ):
+        url = URL_TEMPLATES[name].format(
+            solr_url=SOLR_URL.rstrip('/'),
+            index=index
+        )
+        logger.debug('Calling GET {}'.format(url))
+        async with client.get(url) as resp:
+            if resp.status != 200:
+                raise SolrError(
+                    'Cannot read the schema of {}'.format(index),
                     await resp.text()
-            except ClientConnectorError:
-                logger.info("Cannot contact {}, waiting".format(SOLR_URL))
-                time.sleep(1)
-                tries += 1
-            else:
-                time.sleep(10)
-                tries = MAX_RETRIES
-        existing_cores = await get_cores_status(client)
-        logger.debug("Existing cores: {}".format(existing_cores))
-        for index, definition in indexes.items():
-            if index not in existing_cores:
-                logger.info("Creating core {}".format(index))
-                created = await create_core(client, index)
-                if not created:
-                    logger.critical("Failed to create core {}".format(index))
-                else:
-                    logger.critical("Created core {}".format(index))
-                    operations = schema_to_solrops(definition['schema'])
-                    created = await create_schema(client, index, operations)
-                    if created:
-                        logger.info("Updated schema for {}".format(index))
-                    else:
-                        logger.critical(
-                            "Failed to update schema for {}".format(index)
-                        )
-
-
-def recreate_indexes(stream):
-    indexes = json.load(stream)
+                )
+            schema[name] = (await resp.json())[key]
+    return {
+        'fields': {field['name']: field for field in schema['fields']},
+        'copyfields': set(
+            (copy['source'], copy['dest']) for copy in schema['copyfields']
+        ),
+        'fieldtypes': set(
+            field_type['name'] for field_type in schema['fieldtypes']
+        )
+    }
+
+
+def schema_diff(operations, live_schema):
+    """Keeps only the operations changing a live SOLR schema.
+
+    Fields missing from SOLR are added, fields with different
+    properties are replaced; fields SOLR has but the index does not
+    are left alone, so that no data is lost. Copy fields to ``id``, that
+    earlier versions added for the key, are deleted.
+    """
+    diff = OrderedDict()
+    for field_type in operations.get('add-field-type', []):
+        if field_type['name'] not in live_schema['fieldtypes']:
+            diff.setdefault('add-field-type', []).append(field_type)
+    for rule in operations['add-field']:
+        live = live_schema['fields'].get(rule['name'])
+        if live is None:
+            diff.setdefault('add-field', []).append(rule)
+        elif any(live.get(k) != v for k, v in rule.items()):
+            diff.setdefault('replace-field', []).append(rule)
+    for copy in operations.get('add-copy-field', []):
+        if (copy['source'], copy['dest']) not in live_schema['copyfields']:
+            diff.setdefault('add-copy-field', []).append(copy)
+    for source, dest in sorted(live_schema['copyfields']):
+        if dest == 'id':
+            diff.setdefault('delete-copy-field', []).append({
+                'source': source,
+                'dest': dest
+            })
+    return diff
+
+
+async def sync_index(client, index, definition):
+    """Creates the core of an index if missing, and updates its schema.
+
+    Returns the schema operations that were applied.
+    """
+    if index not in await get_existing_indexes(client):
+        logger.info("Creating core {}".format(index))
+        if not await create_solr_index(client, index, definition):
+            raise SolrError('Failed to create core {}'.format(index), None)
+    operations = schema_diff(
+        schema_to_solrops(
+            definition['schema'], definition.get('suggesters', [])
+        ),
+        await get_schema(client, index)
+    )
+    if operations:
+        logger.info("Updating schema for {}: {}".format(index, operations))
+        if not await create_schema(client, index, operations):
+            raise SolrError(
+                'Failed to update schema for {}'.format(index), operations
+            )
+    return operations
+
+
+async def is_solr_ready(client):
+    """Whether SOLR answers to the core, or collections, admin API."""
+    url = URL_TEMPLATES['status'].format(solr_url=SOLR_URL.rstrip('/'))
+    if SOLR_CLOUD:
+        # It also needs ZooKeeper to answer
+        url = URL_TEMPLATES['collections'].format(
+            solr_url=SOLR_URL.rstrip('/')
+        ) + '?action=LIST'
+    try:
+        async with client.get(url) as resp:
+            await resp.read()
+            return resp.status == 200
+    except (ClientError, asyncio.TimeoutError):
+        return False
+
+
+async def wait_for_solr(client, timeout=BOOTSTRAP_TIMEOUT):
+    """Polls SOLR with an exponential backoff until it is ready."""
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main(loop, indexes))
+    deadline = loop.time() + timeout
+    delay = BACKOFF_INITIAL
+    while not await is_solr_ready(client):
+        if loop.time() + delay > deadline:
+            raise TimeoutError(
+                'SOLR at {} not ready after {} seconds'.format(
+                    SOLR_URL, timeout
+                )
+            )
+        logger.info('Cannot contact {}, waiting'.format(SOLR_URL))
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, BACKOFF_MAX)
+
+
+async def create_index(client, index, definition):
+    logger.info("Creating core {}".format(index))
+    if not await create_solr_index(client, index, definition):
+        raise SolrError('Failed to create core {}'.format(index), None)
+    logger.info("Created core {}".format(index))
+    operations = schema_to_solrops(
+        definition['schema'], definition.get('suggesters', [])
+    )
+    if not await create_schema(client, index, operations):
+        raise SolrError(
+            'Failed to update schema for {}'.format(index), operations
+        )
+    logger.info("Updated schema for {}".format(index))
+
+
+async def main(client, indexes):
+    await wait_for_solr(client)
+    existing_cores = await get_existing_indexes(client)
+    logger.debug("Existing cores: {}".format(existing_cores))
+    semaphore = asyncio.Semaphore(BOOTSTRAP_CONCURRENCY)
+
+    async def limited(index, definition):
+        async with semaphore:
+            if index in existing_cores:
+                # Brings the schema up to date with the index file
+                await sync_index(client, index, definition)
+            else:
+                await create_index(client, index, definition)
+
+    names = list(indexes)
+    # Every index is tried, even when another one fails
+    results = await asyncio.gather(
+        *[limited(index, indexes[index]) for index in names],
+        return_exceptions=True
+    )
+    failed = []
+    for index, result in zip(names, results):
+        if isinstance(result, Exception):
+            logger.critical('Failed to provision index {}: {}'.format(
+                index, result
+            ))
+            failed.append(index)
+    if failed:
+        raise SolrError(
+            'Failed to provision indexes {}'.format(', '.join(failed)), None
+        )
+
+
+def load_indexes(stream):
+    return json.load(stream)
+
+
+def primary_keys(indexes):
     return {
         index_id: [
             k for k, v in index_def['schema'].items()
@@ -165,3 +459,54 @@ def recreate_indexes(stream):
         ][0]
         for index_id, index_def in indexes.items()
     }
+
+
+def indexing_options(indexes):
+    return {
+        index_id: index_def.get('indexing', {})
+        for index_id, index_def in indexes.items()
+    }
+
+
+async def create_indexes(app):
+    try:
+        await app['backend'].create_indexes(app['indexes'])
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception('Failed to create the indexes')
+    else:
+        logger.info('Indexes ready')
+        app['ready'].set()
+
+
+async def recreate_indexes(app):
+    """Creates the indexes in the background, setting ``app['ready']``."""
+    logger.info('Checking indexes to re-create')
+    app['bootstrap'].append(asyncio.ensure_future(create_indexes(app)))
+
+
+async def stop_bootstrap(app):
+    for task in app['bootstrap']:
+        task.cancel()
+
+
+def bootstrap(indexes):
+    """Re-creates the indexes in a dedicated event loop.
+
+    Used when the indexes must be created before the application starts,
+    e.g. once for all the worker processes.
+    """
+    async def run():
+        session = create_session()
+        try:
+            await main(session, indexes)
+        finally:
+            await session.close()
+
+    logger.info('Checking indexes to re-create')
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
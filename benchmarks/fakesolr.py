@@ -0,0 +1,113 @@
+"""A fake SOLR server, answering with canned responses.
+
+It implements just enough of the SOLR API for the emulator to work
+(``/query``, ``/update`` and the core admin), with a configurable latency,
+so that the emulator itself can be benchmarked.
+
+Usage::
+
+    python benchmarks/fakesolr.py [--port 8983] [--latency MS] [--docs N]
+"""
+import asyncio
+import argparse
+from aiohttp import web
+
+
+def make_documents(count):
+    return [
+        {
+            'id': str(i),
+            'name': 'Book number {}'.format(i),
+            'description': 'A very interesting book about the number {}'
+                           .format(i),
+            'price': 10.0 + i,
+            'pages': 100 + i,
+            'paperback': i % 2 == 0,
+            'tags': ['tag{}'.format(i % 5), 'tag{}'.format(i % 7)],
+            'score': 1.0 / (i + 1),
+            '_version_': 1600000000000000000 + i
+        }
+        for i in range(count)
+    ]
+
+
+def make_app(latency=0.0, docs=10):
+    """Makes the fake SOLR application.
+
+    ``latency`` is in seconds, ``docs`` the number of documents
+    returned by each query.
+    """
+    documents = make_documents(docs)
+
+    async def wait():
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    async def root(request):
+        return web.Response(text='SOLR')
+
+    async def cores(request):
+        return web.Response(
+            text='<response><lst name="status"/></response>',
+            content_type='application/xml'
+        )
+
+    async def query(request):
+        body = await request.json()
+        await wait()
+        limit = body.get('limit', 10)
+        response = {
+            'responseHeader': {'status': 0, 'QTime': int(latency * 1000)},
+            'response': {
+                'numFound': 1000,
+                'start': body.get('offset', 0),
+                'docs': documents[:limit]
+            }
+        }
+        if 'facet' in body:
+            response['facets'] = {'count': 1000}
+            for name in body['facet']:
+                response['facets'][name] = {
+                    'buckets': [
+                        {'val': 'tag{}'.format(i), 'count': 100 - i}
+                        for i in range(5)
+                    ]
+                }
+        return web.json_response(response)
+
+    async def update(request):
+        await request.read()
+        await wait()
+        return web.json_response(
+            {'responseHeader': {'status': 0, 'QTime': int(latency * 1000)}}
+        )
+
+    async def schema(request):
+        await request.read()
+        return web.json_response({'responseHeader': {'status': 0}})
+
+    app = web.Application()
+    app.router.add_get('/solr/', root)
+    app.router.add_get('/solr/admin/cores', cores)
+    app.router.add_post('/solr/{core}/query', query)
+    app.router.add_post('/solr/{core}/update', update)
+    app.router.add_post('/solr/{core}/schema', schema)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8983)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Latency of each request, in milliseconds')
+    parser.add_argument('--docs', type=int, default=10,
+                        help='Documents returned by each query')
+    args = parser.parse_args()
+    web.run_app(
+        make_app(args.latency / 1000, args.docs),
+        port=args.port
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""Load test of the emulator against a fake SOLR.
+
+Starts the emulator application and the fake SOLR server of
+``fakesolr.py`` in the same process, then drives search and indexing
+workloads at a fixed concurrency and reports the throughput
+and latency percentiles of each.
+
+Usage::
+
+    python benchmarks/load.py [--concurrency 16] [--duration 10]
+                              [--solr-latency MS] [--workload search index]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import fakesolr
+from aiohttp import web, ClientSession
+
+
+INDEXES_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'example-indexes.json'
+)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    position = min(int(len(values) * fraction), len(values) - 1)
+    return values[position]
+
+
+def search_request(session, base_url, number):
+    return session.get(
+        '{}/indexes/booksample/docs'.format(base_url),
+        params={
+            'search': 'book',
+            '$filter': "price gt {} and tags eq 'tag{}'".format(
+                number % 100, number % 5
+            ),
+            '$top': '10',
+            '$count': 'true',
+            'facet': 'tags,count:5'
+        }
+    )
+
+
+def index_request(session, base_url, number, batch_size=100):
+    return session.post(
+        '{}/indexes/booksample/docs/index'.format(base_url),
+        json={
+            'value': [
+                {
+                    '@search.action': 'upload',
+                    'id': '{}-{}'.format(number, i),
+                    'name': 'Book {}'.format(i),
+                    'price': float(i)
+                }
+                for i in range(batch_size)
+            ]
+        }
+    )
+
+
+WORKLOADS = {
+    'search': search_request,
+    'index': index_request
+}
+
+
+async def drive(base_url, make_request, concurrency, duration):
+    latencies = []
+    errors = 0
+    counter = iter(range(sys.maxsize))
+    deadline = time.perf_counter() + duration
+
+    async def worker(session):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            async with make_request(session, base_url, next(counter)) as resp:
+                await resp.read()
+                if resp.status >= 300:
+                    errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    async with ClientSession() as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+        total = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / total,
+        'p50': percentile(latencies, 0.5) * 1000,
+        'p90': percentile(latencies, 0.9) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'max': latencies[-1] * 1000
+    }
+
+
+async def start_site(app, port):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+async def run(args):
+    runners = []
+    base_url = args.url
+    if base_url is None:
+        solr_port = free_port()
+        os.environ['SOLR_URL'] = 'http://127.0.0.1:{}/solr/'.format(
+            solr_port
+        )
+        # The emulator reads its configuration when imported
+        from AzureSearchEmulator.main import make_app
+        runners.append(await start_site(
+            fakesolr.make_app(args.solr_latency / 1000, args.docs), solr_port
+        ))
+        with open(INDEXES_FILE, 'r', encoding='utf-8') as stream:
+            indexes = json.load(stream)
+        emulator_port = free_port()
+        runners.append(await start_site(
+            make_app(indexes, create_indexes=False), emulator_port
+        ))
+        base_url = 'http://127.0.0.1:{}'.format(emulator_port)
+    try:
+        print('{:>8} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+            'workload', 'requests', 'errors', 'req/s',
+            'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'max (ms)'
+        ))
+        for workload in args.workload:
+            result = await drive(
+                base_url,
+                WORKLOADS[workload],
+                args.concurrency,
+                args.duration
+            )
+            print(
+                '{:>8} {requests:>9} {errors:>7} {throughput:>9.1f} '
+                '{p50:>9.2f} {p90:>9.2f} {p99:>9.2f} {max:>9.2f}'
+                .format(workload, **result)
+            )
+    finally:
+        for runner in reversed(runners):
+            await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Duration of each workload, in seconds')
+    parser.add_argument('--solr-latency', type=float, default=0.0,
+                        help='Latency of the fake SOLR, in milliseconds')
+    parser.add_argument('--docs', type=int, default=10,
+                        help='Documents returned by each fake SOLR query')
+    parser.add_argument('--workload', nargs='+', default=['search', 'index'],
+                        choices=sorted(WORKLOADS))
+    parser.add_argument('--url', default=None,
+                        help='Benchmark an already running emulator instead')
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run(args))
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
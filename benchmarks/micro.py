@@ -0,0 +1,71 @@
+"""Micro-benchmarks of the query translation and response formatting.
+
+Usage::
+
+    python benchmarks/micro.py [--repeat N]
+"""
+import time
+import argparse
+import fakesolr
+from aiohttp.test_utils import make_mocked_request
+from AzureSearchEmulator import azquery, azresponse
+
+
+SIMPLE_QUERY = 'wifi+luxury | "sea view" -smoking'
+FILTER = (
+    "price gt 100 and (tags eq 'wifi' or tags eq 'pool') "
+    "and not (rating lt 3) and category eq 'hotel'"
+)
+FACETS = ['tags,count:10', 'category,sort:value', 'rating,sort:count']
+
+
+def timeit(function, repeat):
+    function()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def formatting(docs):
+    request = make_mocked_request(
+        'GET', '/indexes/booksample/docs?search=book&$top=10&$count=true'
+    )
+    result = {
+        'response': {
+            'numFound': 1000,
+            'docs': fakesolr.make_documents(docs)
+        },
+        'facets': {
+            'count': 1000,
+            'top_tags': {
+                'buckets': [{'val': 'tag1', 'count': 10}]
+            }
+        }
+    }
+    return lambda: azresponse.format(request, result, request.query, False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=10000)
+    args = parser.parse_args()
+    benchmarks = [
+        ('simple_to_lucene', lambda: azquery.simple_to_lucene(SIMPLE_QUERY)),
+        ('odata_to_lucene (cached)', lambda: azquery.odata_to_lucene(FILTER)),
+        ('odata_to_lucene (cold)',
+         lambda: azquery.odata_to_lucene.__wrapped__(FILTER)),
+        ('az_facets_to_solr', lambda: azquery.az_facets_to_solr(FACETS)),
+        ('azresponse.format (10 docs)', formatting(10)),
+        ('azresponse.format (1000 docs)', formatting(1000))
+    ]
+    print('{:<32} {:>12}'.format('benchmark', 'time (us)'))
+    for name, function in benchmarks:
+        repeat = args.repeat if '1000 docs' not in name else args.repeat // 100
+        print('{:<32} {:>12.2f}'.format(
+            name, timeit(function, max(repeat, 1)) * 1e6
+        ))
+
+
+if __name__ == '__main__':
+    main()
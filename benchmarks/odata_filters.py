@@ -0,0 +1,52 @@
+"""Benchmark of the OData filter compilers.
+
+Times ``odata.translate`` and the reference pyparsing
+``azquery.ODataQueryParser`` on increasingly long filters;
+``tests/test_odata.py`` checks that they give the same output.
+
+Usage::
+
+    python benchmarks/odata_filters.py
+"""
+import time
+from AzureSearchEmulator import odata
+from AzureSearchEmulator.azquery import ODataQueryParser
+
+
+def long_filter(clauses):
+    return ' and '.join(
+        '({} or {})'.format(
+            'price gt {}'.format(i), "tags eq 'tag{}'".format(i)
+        )
+        for i in range(clauses)
+    )
+
+
+def timeit(function, query, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(query)
+    return (time.perf_counter() - start) / repeat
+
+
+def benchmark(parser):
+    print('{:>8} {:>14} {:>14} {:>9}'.format(
+        'clauses', 'pyparsing (ms)', 'compiler (ms)', 'speedup'
+    ))
+    for clauses in (1, 5, 20, 50):
+        query = long_filter(clauses)
+        assert parser.transform(query) == odata.translate(query)
+        repeat = max(5, 200 // clauses)
+        slow = timeit(parser.transform, query, repeat)
+        fast = timeit(odata.translate, query, repeat)
+        print('{:>8} {:>14.3f} {:>14.3f} {:>8.1f}x'.format(
+            clauses, slow * 1000, fast * 1000, slow / fast
+        ))
+
+
+def main():
+    benchmark(ODataQueryParser())
+
+
+if __name__ == '__main__':
+    main()
@@ -7,9 +7,12 @@ setup(
     packages=find_packages(),
     install_requires=[
         "aiohttp",
-        "pyparsing",
+        "pyparsing>=3",
         "defusedxml"
     ],
+    extras_require={
+        'fast': ["orjson"]
+    },
     entry_points={
         'console_scripts': [
             'AzureSearchEmulator = AzureSearchEmulator.main:main'
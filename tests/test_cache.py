@@ -0,0 +1,34 @@
+import multiprocessing
+from AzureSearchEmulator.cache import SharedGenerations, SearchCache
+
+
+def increment(generations, count):
+    for _ in range(count):
+        generations.increment('books')
+
+
+def test_shared_increments():
+    generations = SharedGenerations()
+    context = multiprocessing.get_context('fork')
+    processes = [
+        context.Process(target=increment, args=(generations, 5000))
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert generations.get('books') == 20000
+    # Also indexes unknown when the workers were started
+    cache = SearchCache(size=10, generations=generations)
+    key = cache.key('created-later', {})
+    cache.invalidate('created-later')
+    assert cache.key('created-later', {}) != key
+
+
+def test_definitions_changed():
+    generations = SharedGenerations()
+    assert not generations.definitions_changed()
+    generations.change_definitions()
+    assert generations.definitions_changed()
+    assert not generations.definitions_changed()
@@ -0,0 +1,220 @@
+import os
+import asyncio
+import pytest
+from AzureSearchEmulator import disk
+from AzureSearchEmulator.disk import DiskIndex, Segment, write_segment
+from AzureSearchEmulator.memory import Searcher
+
+
+SCHEMA = {
+    'id': {'type': 'Edm.String', 'tags': ['retrievable'], 'is_primary': True},
+    'name': {
+        'type': 'Edm.String',
+        'tags': ['searchable', 'retrievable', 'sortable']
+    },
+    'pages': {
+        'type': 'Edm.Int32',
+        'tags': ['retrievable', 'filterable', 'sortable', 'facetable']
+    },
+    'tags': {
+        'type': 'Collection(Edm.String)',
+        'tags': ['retrievable', 'filterable', 'facetable']
+    }
+}
+DOCUMENTS = [
+    ('b', {'id': 'b', 'name': 'blue whale', 'pages': 30, 'tags': ['sea']}),
+    ('a', {'id': 'a', 'name': 'red fox red', 'pages': 10, 'tags': []}),
+    ('c', {'id': 'c', 'name': 'blue fox', 'pages': 20, 'tags': ['x', 'y']}),
+    ('d', {'id': 'd', 'name': 'lazy dog'}),
+]
+
+
+@pytest.fixture
+def segment(tmp_path):
+    path = str(tmp_path / 'segment_00000000.seg')
+    write_segment(path, SCHEMA, DOCUMENTS)
+    segment = Segment(path)
+    yield segment
+    segment.close()
+
+
+def test_segment_round_trip(segment):
+    assert segment.name == 'segment_00000000'
+    assert segment.count() == 4
+    assert segment.keys() == ['a', 'b', 'c', 'd']
+    for key, document in DOCUMENTS:
+        assert segment.document(key) == document
+    assert segment.document('e') is None
+    assert segment.value('pages', 'c') == 20
+    assert segment.value('tags', 'c') == ['x', 'y']
+    assert segment.value('pages', 'd') is None
+    assert segment.get_postings('name', 'red') == {'a': [0, 2]}
+    assert segment.get_postings('name', 'fox') == {'a': [1], 'c': [1]}
+    assert segment.get_postings('name', 'cat') == {}
+    assert segment.prefix_terms('name', 'bl') == ['blue']
+    assert segment.field_length('name', 'a') == 3
+    assert segment.total_length('name') == 9
+    assert sorted(segment.range_keys('pages', 'gte', 20)) == ['b', 'c']
+    assert segment.value_keys('tags', 'y') == ['c']
+    assert sorted(segment.valued_keys('pages')) == ['a', 'b', 'c']
+
+
+def test_segment_delete(segment):
+    # Keys read before deleting must not be kept stale
+    assert segment.keys() == ['a', 'b', 'c', 'd']
+    assert segment.delete('a')
+    assert not segment.delete('a')
+    assert not segment.delete('e')
+    assert segment.count() == 3
+    assert segment.keys() == ['b', 'c', 'd']
+    assert segment.document('a') is None
+    assert segment.value('pages', 'a') is None
+    assert segment.get_postings('name', 'fox') == {'c': [1]}
+    assert segment.get_postings('name', 'red') == {}
+    assert segment.total_length('name') == 6
+    assert segment.range_keys('pages', 'lt', 30) == ['c']
+    assert segment.deleted == {0}
+
+
+def open_index(path):
+    disk_index = DiskIndex('books', SCHEMA, path)
+    disk_index.open()
+    return disk_index
+
+
+def documents(disk_index):
+    reader = disk_index.reader()
+    return {key: reader.document(key) for key in reader.keys()}
+
+
+def test_index_merge_and_reopen(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk, 'MERGE_FACTOR', 10)
+    path = str(tmp_path / 'books')
+
+    async def run():
+        disk_index = open_index(path)
+        for key, document in DOCUMENTS:
+            assert disk_index.update(document) is None
+            await disk_index.commit()
+        assert len(disk_index.segments) == 4
+        # Replaced and deleted documents are deleted from their segment
+        disk_index.update({'id': 'b', 'name': 'grey whale', 'pages': 31})
+        disk_index.delete('c')
+        await disk_index.commit()
+        expected = dict(DOCUMENTS)
+        expected['b'] = {'id': 'b', 'name': 'grey whale', 'pages': 31}
+        del expected['c']
+        assert documents(disk_index) == expected
+        disk_index.close()
+
+        disk_index = open_index(path)
+        assert documents(disk_index) == expected
+        assert sum(len(s.deleted) for s in disk_index.segments) == 2
+        await disk_index.merge()
+        assert len(disk_index.segments) == 1
+        assert disk_index.segments[0].deleted == set()
+        assert documents(disk_index) == expected
+        assert disk_index.reader().get_postings('name', 'whale') == {
+            'b': [1]
+        }
+        merged = disk_index.segments[0].name
+        disk_index.close()
+        # The merged segments are removed
+        assert sorted(os.listdir(path)) == [merged + '.seg', 'segments.json']
+
+        disk_index = open_index(path)
+        assert len(disk_index.segments) == 1
+        assert documents(disk_index) == expected
+        disk_index.delete('a')
+        await disk_index.commit()
+        disk_index.close()
+
+        disk_index = open_index(path)
+        del expected['a']
+        assert documents(disk_index) == expected
+        disk_index.close()
+    asyncio.run(run())
+
+
+def test_sort_across_segments(tmp_path):
+    async def run():
+        disk_index = open_index(str(tmp_path / 'books'))
+        for key, document in DOCUMENTS:
+            disk_index.update(document)
+            await disk_index.commit()
+        # Still in the buffer
+        disk_index.update({'id': 'e', 'name': 'red', 'pages': 20})
+        searcher = Searcher(SCHEMA, disk_index.reader())
+        keys = list(disk_index.reader().keys())
+        scores = dict.fromkeys(keys, 1.0)
+        assert searcher.sort(keys, scores, ['pages desc']) == [
+            'b', 'c', 'e', 'a', 'd'
+        ]
+        assert searcher.sort(keys, scores, ['pages asc']) == [
+            'a', 'c', 'e', 'b', 'd'
+        ]
+        assert searcher.sort(keys, scores, ['pages asc'], 2) == ['a', 'c']
+        assert searcher.sort(
+            keys, scores, ['pages asc', 'name desc'], 3
+        ) == ['a', 'e', 'c']
+        disk_index.close()
+    asyncio.run(run())
+
+
+def test_writes_during_merge(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk, 'MERGE_FACTOR', 10)
+
+    async def run():
+        disk_index = open_index(str(tmp_path / 'books'))
+        for key, document in DOCUMENTS:
+            disk_index.update(document)
+            await disk_index.commit()
+        written = asyncio.Event()
+        write = disk_index._write
+
+        async def paused_write(documents, tracker):
+            segment = await write(documents, tracker)
+            written.set()
+            return segment
+        disk_index._write = paused_write
+        # The merge waits for the lock once the merged segment is written
+        await disk_index.lock.acquire()
+        merge = asyncio.ensure_future(disk_index.merge())
+        await written.wait()
+        disk_index.update({'id': 'b', 'name': 'grey whale'})
+        disk_index.delete('c')
+        disk_index.lock.release()
+        await merge
+        assert len(disk_index.segments) == 1
+        reader = disk_index.reader()
+        assert sorted(reader.keys()) == ['a', 'b', 'd']
+        assert reader.count() == 3
+        assert reader.document('b') == {'id': 'b', 'name': 'grey whale'}
+        assert reader.document('c') is None
+        await disk_index.commit()
+        disk_index.close()
+
+        disk_index = open_index(str(tmp_path / 'books'))
+        assert sorted(disk_index.reader().keys()) == ['a', 'b', 'd']
+        disk_index.close()
+    asyncio.run(run())
+
+
+def test_segment_key_lookup(tmp_path, monkeypatch):
+    # Keys are found through a sample of the table, across blocks
+    monkeypatch.setattr(disk, 'KEY_INDEX_INTERVAL', 3)
+    keys = sorted(['é', 'a', 'ab', 'b', '10', '9', 'z', 'zz', 'Z', '日本'])
+    path = str(tmp_path / 'segment_00000000.seg')
+    write_segment(path, SCHEMA, [(k, {'id': k}) for k in keys])
+    segment = Segment(path)
+    assert segment.keys() == keys
+    for ordinal, key in enumerate(keys):
+        assert segment.ordinal(key) == ordinal
+    for missing in ('', '0', 'aa', 'y', 'zzz', '日'):
+        assert segment.ordinal(missing) is None
+    assert segment.delete('z')
+    assert segment.ordinal('z') is None
+    assert segment.key_index == [
+        k.encode('utf-8') for k in ('10', 'a', 'z', '日本')
+    ]
+    segment.close()
@@ -0,0 +1,43 @@
+from AzureSearchEmulator.index import to_solr_document
+from AzureSearchEmulator.tools import schema_to_solrops, schema_diff
+
+
+SCHEMA = {
+    'hotelId': {
+        'type': 'Edm.String',
+        'tags': ['retrievable', 'filterable'],
+        'is_primary': True
+    },
+    'name': {'type': 'Edm.String', 'tags': ['retrievable', 'searchable']}
+}
+
+
+def test_key_sent_as_id():
+    # SOLR rebuilds atomic updates from the stored fields: a copy field
+    # from the key would give id a second value
+    assert to_solr_document(
+        {'@search.action': 'upload', 'hotelId': '1', 'name': 'a'}, 'hotelId'
+    ) == {'hotelId': '1', 'id': '1', 'name': 'a'}
+    assert to_solr_document(
+        {'@search.action': 'merge', 'hotelId': '1', 'name': 'b'}, 'hotelId'
+    ) == {'hotelId': '1', 'id': '1', 'name': {'set': 'b'}, '_version_': 1}
+    assert to_solr_document(
+        {'@search.action': 'mergeOrUpload', 'hotelId': '1'}, 'hotelId'
+    ) == {'hotelId': '1', 'id': '1'}
+    operations = schema_to_solrops(SCHEMA)
+    assert 'add-copy-field' not in operations
+    assert [f['name'] for f in operations['add-field']] == ['hotelId', 'name']
+
+
+def test_key_copy_field_removed():
+    live_schema = {
+        'fields': {
+            field['name']: field
+            for field in schema_to_solrops(SCHEMA)['add-field']
+        },
+        'copyfields': {('hotelId', 'id'), ('name', 'name_suggest')},
+        'fieldtypes': set()
+    }
+    assert schema_diff(schema_to_solrops(SCHEMA), live_schema) == {
+        'delete-copy-field': [{'source': 'hotelId', 'dest': 'id'}]
+    }
@@ -0,0 +1,83 @@
+import json
+import asyncio
+import pytest
+from AzureSearchEmulator.jsonstream import ValueReader
+
+
+class ChunkedStream(object):
+    """A stream returning the payload in chunks of a fixed size."""
+
+    def __init__(self, payload, size):
+        self.payload = payload
+        self.size = size
+
+    async def read(self, n=-1):
+        chunk = self.payload[:self.size]
+        self.payload = self.payload[self.size:]
+        return chunk
+
+
+def read_all(payload, size, count=2):
+    async def run():
+        reader = ValueReader(ChunkedStream(payload, size), read_size=size)
+        batches = []
+        items = await reader.read(count)
+        while items:
+            batches.append(items)
+            items = await reader.read(count)
+        return batches
+    return asyncio.run(run())
+
+
+ITEMS = [
+    {'@search.action': 'upload', 'id': '1', 'name': 'a "quoted" \\ name'},
+    {'@search.action': 'upload', 'id': '2', 'name': 'café ☃ \U0001f600'},
+    {'@search.action': 'merge', 'id': '3', 'tags': [['a', 'b'], [], ['c']]},
+    {'@search.action': 'delete', 'id': '4', 'price': 12.5e3},
+    {'@search.action': 'upload', 'id': '5', 'nested': {'value': [1, [2]]}},
+]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 65536])
+@pytest.mark.parametrize('ensure_ascii', [True, False])
+def test_chunk_boundaries(size, ensure_ascii):
+    payload = json.dumps(
+        {'other': {'value': 'x'}, 'value': ITEMS, 'after': [1, 2]},
+        ensure_ascii=ensure_ascii,
+        indent=1
+    ).encode('utf-8')
+    batches = read_all(payload, size)
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert [item for batch in batches for item in batch] == ITEMS
+
+
+def test_number_at_chunk_end():
+    batches = read_all(b'{"value": [123456, 7]}', 14)
+    assert batches == [[123456, 7]]
+
+
+def test_empty_value():
+    assert read_all(b' { "value" : [ ] } ', 3) == []
+
+
+@pytest.mark.parametrize('payload', [
+    b'{"value": [{"id": "1"}, {"id": "2"',
+    b'{"value": [{"id": "1"}, {"id": "2"}',
+    b'{"value": [{"id": "1"}, {"id": "2\\',
+    b'{"value": [{"id": "1"} {"id": "2"}]}',
+])
+def test_truncated_or_invalid(payload):
+    async def run():
+        reader = ValueReader(ChunkedStream(payload, 5), read_size=5)
+        items = []
+        with pytest.raises(ValueError):
+            while True:
+                items.extend(await reader.read(1))
+        return items
+    assert asyncio.run(run())[0] == {'id': '1'}
+
+
+@pytest.mark.parametrize('payload', [b'', b'[]', b'{"values": []}'])
+def test_no_value_array(payload):
+    with pytest.raises(ValueError):
+        read_all(payload, 4)
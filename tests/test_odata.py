@@ -0,0 +1,97 @@
+import random
+import pytest
+from pyparsing import ParseException
+from AzureSearchEmulator import odata
+from AzureSearchEmulator.azquery import (
+    ODataQueryParser, ODataParseFailure, odata_to_lucene
+)
+
+
+FIELDS = ('name', 'price', 'pages', 'tags', 'meta.author', 'published')
+VALUES = ('3', '10.5', 'true', 'luxury', "'wifi'", '"free parking"',
+          "'a b c'", '2017')
+OPERATORS = ('eq', 'EQ', 'neq', 'lt', 'lte', 'gt', 'Gte')
+JUNK = ('', ' ', ')', ' foo', " 'x", ' and', ' or (', ' eq', '-')
+
+
+def random_condition(rnd):
+    return '{} {} {}'.format(
+        rnd.choice(FIELDS), rnd.choice(OPERATORS), rnd.choice(VALUES)
+    )
+
+
+def random_filter(rnd, depth=0):
+    choice = rnd.random()
+    if depth > 3 or choice < 0.35:
+        return random_condition(rnd)
+    if choice < 0.45:
+        return '{} {}'.format(
+            rnd.choice(('not', 'NOT')), random_filter(rnd, depth + 1)
+        )
+    if choice < 0.6:
+        return '({})'.format(random_filter(rnd, depth + 1))
+    if choice < 0.7:
+        # Implicit and, by juxtaposition
+        return '{} {}'.format(
+            random_filter(rnd, depth + 1), random_filter(rnd, depth + 1)
+        )
+    return '{} {} {}'.format(
+        random_filter(rnd, depth + 1),
+        rnd.choice(('and', 'or', 'AND', 'Or')),
+        random_filter(rnd, depth + 1)
+    )
+
+
+def mutate(rnd, query):
+    choice = rnd.random()
+    if choice < 0.6:
+        return query
+    if choice < 0.8:
+        return query + rnd.choice(JUNK)
+    position = rnd.randrange(len(query) + 1)
+    return query[:position] + rnd.choice(JUNK) + query[position:]
+
+
+@pytest.fixture(scope='module')
+def reference():
+    parser = ODataQueryParser()
+
+    def transform(query):
+        try:
+            return parser.transform(query)
+        except ParseException:
+            return None
+    return transform
+
+
+def translate(query):
+    try:
+        return odata.translate(query)
+    except odata.FilterSyntaxError:
+        return None
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_same_as_reference(reference, seed):
+    # The compiler accepts and emits exactly what the pyparsing grammar does
+    rnd = random.Random(seed)
+    for _ in range(500):
+        query = mutate(rnd, random_filter(rnd))
+        assert translate(query) == reference(query), query
+
+
+def test_long_filters():
+    clauses = ['price gt {}'.format(i) for i in range(2000)]
+    assert odata.translate(' and '.join(clauses)) == ' AND '.join(
+        '{}:{{{} TO *]'.format(*c.split(' gt ')) for c in clauses
+    )
+    assert odata.translate(' or '.join(clauses)).count(' OR ') == 1999
+    assert odata.translate(' '.join(clauses)).count(' AND ') == 1999
+    assert odata.translate('not ' * 2000 + 'a eq 1') == (
+        'NOT ' * 2000 + 'a:1'
+    )
+
+
+def test_too_deep():
+    with pytest.raises(ODataParseFailure):
+        odata_to_lucene('(' * 5000 + 'a eq 1' + ')' * 5000)